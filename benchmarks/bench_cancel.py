@@ -0,0 +1,63 @@
+"""测量停止指令的响应时间：大量慢速流同时进行时调用request_stop，统计run返回耗时和服务端被中断的流数
+
+用法：python benchmarks/bench_cancel.py --workers 100 --token-delay 2 --run-seconds 3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import engine
+from mock_gateway import start_mock_gateway
+
+
+def run_case(base_url, engine_name, workers, run_seconds, tmp_dir):
+    data_path = os.path.join(tmp_dir, "queries.jsonl")
+    with open(data_path, "w", encoding="utf-8") as f:
+        for i in range(workers * 10):
+            f.write(f'{{"query": "query {i}"}}\n')
+    yaml_config = {
+        "config": {"test": {"api_keys": {"gpt-4o": "bench-key"},
+                            "base_urls": {"claude": "", "gemini": "", "other": f"{base_url}/v1/chat/completions"}}},
+        "journal": {"dir": tmp_dir},
+    }
+    runner = engine.BatchRunner(yaml_config, data_path, "你是一个助手", "test", max_workers=workers,
+                                engine=engine_name, cache_mode="不使用缓存", log_func=lambda msg: None)
+    model_configs = engine.build_model_configs(yaml_config, "test", ["gpt-4o"])
+    thread = threading.Thread(target=runner.run, args=(model_configs,))
+    thread.start()
+    time.sleep(run_seconds)
+    start = time.perf_counter()
+    engine.request_stop()
+    thread.join()
+    elapsed = time.perf_counter() - start
+    runner.close(discard_journal=True)
+    return elapsed
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=100)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--token-delay", type=float, default=2.0, help="模拟每个token的生成间隔(秒)")
+    parser.add_argument("--run-seconds", type=float, default=3.0, help="运行多久后发出停止指令")
+    args = parser.parse_args()
+
+    print(f"{'引擎':<12}{'并发流':>8}{'停止耗时(s)':>14}{'服务端中断流数':>16}")
+    for engine_name in ["threading", "asyncio"]:
+        server, base_url = start_mock_gateway(tokens=args.tokens, token_delay=args.token_delay)
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                elapsed = run_case(base_url, engine_name, args.workers, args.run_seconds, tmp_dir)
+            # 客户端断开后服务端第一次写入仍会成功，第二次写入才报错，等两个token间隔
+            time.sleep(args.token_delay * 2 + 0.5)
+            print(f"{engine_name:<12}{args.workers:>8}{elapsed:>14.3f}{server.aborted:>16}")
+        finally:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main_bench()
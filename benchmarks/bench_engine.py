@@ -0,0 +1,152 @@
+"""端到端吞吐基准：用真实的BatchRunner压本地模拟网关，按并发数×数据量×引擎输出req/s、p50/p99、峰值RSS和每请求CPU
+
+用法：python benchmarks/bench_engine.py --concurrency 20,100,200 --rows 200,1000 --engines threading,asyncio \
+          --ttft 0.2 --tps 200 --tokens 50 --error-rate 0.01 --rate-429 0.01
+加 --capacity 30 让网关超出30个并发流时返回429，配合 --adaptive 对比固定并发与自适应并发的吞吐；
+--processes 1,4 对比单进程与多进程分片（模拟网关与引擎争用CPU，核数少的机器上多进程看不出收益）；
+--stall-rate 0.02 --stall-seconds 10 --hedge both 对比开关对冲时的长尾耗时；
+--long-rows 0.05 --long-factor 40 --length-ratio 0.5 --schedule both 在文件末尾放少量长query（回答随之变长），对比按行顺序与长任务优先的总耗时。
+模拟网关运行在父进程，每个用例在独立子进程中跑引擎，子进程只统计自身的RSS和CPU。
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from mock_gateway import start_mock_gateway, reset_stats
+
+BENCH_MODELS = ["gpt-4o", "claude-sonnet-4", "gemini-2.5-flash"]  # 覆盖三种SSE格式
+
+
+def child(case):
+    """子进程：生成数据，跑一次完整的BatchRunner，打印一行JSON结果"""
+    import engine
+    model_names = BENCH_MODELS[:case["models"]]
+    yaml_config = {
+        "config": {"test": {
+            "api_keys": {name: "bench-key" for name in model_names},
+            "base_urls": {
+                "claude": f"{case['base_url']}/claude/{{model}}",
+                "gemini": f"{case['base_url']}/gemini/{{model}}",
+                "other": f"{case['base_url']}/v1/chat/completions",
+            },
+        }},
+        "journal": {"dir": case["tmp_dir"]},
+        # 缩短退避，避免注入的错误让基准时间被重试等待主导
+        "retry": {"default": {"max_attempts": 3, "base_delay": 0.2, "max_retry_after": 1}},
+    }
+    data_path = os.path.join(case["tmp_dir"], "queries.jsonl")
+    with open(data_path, "w", encoding="utf-8") as f:
+        long_start = case["rows"] - int(case["rows"] * case["long_rows"])
+        for i in range(case["rows"]):
+            # 长query集中在文件末尾，按行顺序调度时它们最后才开始
+            repeat = case["long_factor"] if i >= long_start else 1
+            f.write(json.dumps({"query": f"基准测试第{i}条query" * repeat}, ensure_ascii=False) + "\n")
+
+    notes = []  # 只保留对冲和调度统计，随结果一起打印
+    runner = engine.BatchRunner(yaml_config, data_path, "你是一个助手", "test", max_workers=case["concurrency"],
+                                engine=case["engine"], cache_mode="不使用缓存",
+                                stream_save_path=os.path.join(case["tmp_dir"], "result.csv"),
+                                log_func=notes.append, log_rows=False, adaptive=case["adaptive"],
+                                processes=case["processes"], hedge=case["hedge"],
+                                schedule=engine.SCHEDULE_POLICIES[case["longest_first"]])
+    model_configs = engine.build_model_configs(yaml_config, "test", model_names)
+    # 多进程分片时子进程的CPU也要算进去（子进程结束并被join后才计入RUSAGE_CHILDREN）
+    usage_start = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    start = time.perf_counter()
+    runner.run(model_configs)
+    elapsed = time.perf_counter() - start
+    usage_end = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    runner.close(discard_journal=True)
+
+    stats = runner.latency_stats.snapshot()
+    finished = stats["ok"] + stats["errors"]
+    cpu = sum((end.ru_utime + end.ru_stime) - (start.ru_utime + start.ru_stime) for start, end in zip(usage_start, usage_end))
+    print(json.dumps({
+        "elapsed": elapsed,
+        "finished": finished,
+        "errors": stats["errors"],
+        "p50": engine.percentile(stats["total"], 50),
+        "p99": engine.percentile(stats["total"], 99),
+        "ttft_p99": engine.percentile(stats["ttft"], 99),
+        "cpu_ms_per_req": cpu * 1000 / finished if finished else None,
+        "peak_rss_kb": usage_end[0].ru_maxrss,
+        "notes": [msg for msg in notes if msg.startswith(("【对冲】", "【调度】"))],
+    }))
+
+
+def fmt(value, pattern):
+    return "-" if value is None else pattern.format(value)
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="20,100,200", help="逗号分隔的全局并发数")
+    parser.add_argument("--rows", default="200,1000", help="逗号分隔的数据行数（每个模型各请求一遍）")
+    parser.add_argument("--engines", default="threading,asyncio")
+    parser.add_argument("--models", type=int, default=3, choices=[1, 2, 3], help="同时请求的模型数，依次为OpenAI/Claude/Gemini格式")
+    parser.add_argument("--tokens", type=int, default=50, help="每个回答的token数")
+    parser.add_argument("--ttft", type=float, default=0.2, help="首token延迟(秒)")
+    parser.add_argument("--tps", type=float, default=200, help="每秒生成的token数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回500的请求比例")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="返回429的请求比例")
+    parser.add_argument("--capacity", type=int, default=None, help="网关同时进行的流数上限，超出返回429")
+    parser.add_argument("--adaptive", default="off", choices=["off", "on", "both"], help="是否使用自适应并发，both两种都跑")
+    parser.add_argument("--processes", default="1", help="逗号分隔的请求进程数")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="首token卡住的请求比例")
+    parser.add_argument("--stall-seconds", type=float, default=10.0, help="卡住的请求的首token延迟(秒)")
+    parser.add_argument("--hedge", default="off", choices=["off", "on", "both"], help="是否对冲慢请求，both两种都跑")
+    parser.add_argument("--schedule", default="off", choices=["off", "on", "both"], help="是否长任务优先调度，both两种都跑")
+    parser.add_argument("--long-rows", type=float, default=0.0, help="文件末尾长query的比例")
+    parser.add_argument("--long-factor", type=int, default=40, help="长query是普通query的倍数")
+    parser.add_argument("--length-ratio", type=float, default=0.0, help="网关按请求体每字节额外生成的token数")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(json.loads(args.child))
+        return
+
+    server, base_url = start_mock_gateway(tokens=args.tokens, token_delay=1 / args.tps, ttft=args.ttft,
+                                          error_rate=args.error_rate, rate_429=args.rate_429, retry_after=1,
+                                          capacity=args.capacity, stall_rate=args.stall_rate, stall_seconds=args.stall_seconds,
+                                          length_ratio=args.length_ratio)
+    print(f"模拟网关：TTFT {args.ttft}s，{args.tps} tokens/s × {args.tokens} tokens，500比例 {args.error_rate}，429比例 {args.rate_429}，"
+          f"并发容量 {args.capacity or '不限'}，卡住比例 {args.stall_rate}（{args.stall_seconds}s）")
+    switch_modes = {"off": [False], "on": [True], "both": [False, True]}
+    header = (f"{'引擎':<10}{'并发':>6}{'进程':>6}{'自适应':>6}{'对冲':>6}{'长优先':>6}{'行数':>8}{'请求数':>8}{'网关请求':>10}{'失败':>6}{'req/s':>9}"
+              f"{'p50(s)':>9}{'p99(s)':>9}{'首token p99':>12}{'峰值RSS(MB)':>13}{'CPU(ms/req)':>13}")
+    print(header)
+    try:
+        cases = itertools.product(args.engines.split(","), [int(c) for c in args.concurrency.split(",")],
+                                  [int(p) for p in args.processes.split(",")], [int(r) for r in args.rows.split(",")],
+                                  switch_modes[args.adaptive], switch_modes[args.hedge], switch_modes[args.schedule])
+        for engine_name, concurrency, processes, rows, adaptive, hedge, longest_first in cases:
+            reset_stats(server)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                case = {"engine": engine_name, "concurrency": concurrency, "rows": rows, "models": args.models,
+                        "base_url": base_url, "tmp_dir": tmp_dir, "adaptive": adaptive, "processes": processes,
+                        "hedge": hedge, "longest_first": longest_first, "long_rows": args.long_rows,
+                        "long_factor": args.long_factor}
+                cmd = [sys.executable, os.path.abspath(__file__), "--child", json.dumps(case)]
+                output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{engine_name:<10}{concurrency:>6}{processes:>6}{'是' if adaptive else '否':>6}{'是' if hedge else '否':>6}{'是' if longest_first else '否':>6}{rows:>8}{result['finished']:>8}{server.requests:>10}"
+                  f"{result['errors']:>6}{result['finished'] / result['elapsed']:>9.1f}{fmt(result['p50'], '{:.2f}'):>9}"
+                  f"{fmt(result['p99'], '{:.2f}'):>9}{fmt(result['ttft_p99'], '{:.2f}'):>12}{result['peak_rss_kb'] / 1024:>13.1f}"
+                  f"{fmt(result['cpu_ms_per_req'], '{:.2f}'):>13}")
+            for note in result["notes"]:
+                print(f"    {note}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,81 @@
+"""结果写出内存基准：对比结束后整表to_csv/to_excel与StreamingResultWriter边跑边写的峰值RSS
+
+用法：python benchmarks/bench_result_writer.py --rows 100000 --models 16 --answer-chars 2000
+每种方式在独立子进程中运行，子进程结束前打印自身的ru_maxrss作为峰值RSS（Linux下单位为KB）。
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def fake_answer(model_idx, row_idx, answer_chars):
+    """每次生成新的字符串对象，模拟请求返回的长回答"""
+    return (f"模型{model_idx}-第{row_idx}行回答：" + "测" * answer_chars)[:answer_chars]
+
+
+def run_legacy(path, rows, models, answer_chars):
+    """旧实现：全部结果留在RESULT_DICT，最后拼成DataFrame一次性写出"""
+    import pandas as pd
+    queries = [f"query {i}" for i in range(rows)]
+    result_dict = {f"model-{m}": [fake_answer(m, r, answer_chars) for r in range(rows)] for m in range(models)}
+    result_df = pd.DataFrame({"query": queries})
+    for model_name, res_list in result_dict.items():
+        result_df[model_name] = res_list
+    if path.endswith(".csv"):
+        result_df.to_csv(path, index=False, encoding="utf-8-sig")
+    else:
+        result_df.to_excel(path, index=False)
+
+
+def run_streaming(path, rows, models, answer_chars):
+    """新实现：按行完成顺序交给StreamingResultWriter"""
+    import engine
+    writer = engine.StreamingResultWriter(path, [f"model-{m}" for m in range(models)])
+    for r in range(rows):
+        writer.add_query(r, f"query {r}")
+        for m in range(models):
+            writer.set_result(f"model-{m}", r, fake_answer(m, r, answer_chars))
+    writer.close()
+
+
+def child(mode, path, rows, models, answer_chars):
+    {"legacy": run_legacy, "streaming": run_streaming}[mode](path, rows, models, answer_chars)
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--models", type=int, default=16)
+    parser.add_argument("--answer-chars", type=int, default=1000)
+    parser.add_argument("--format", choices=["csv", "xlsx"], default="csv")
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.rows, args.models, args.answer_chars)
+        return
+
+    print(f"{args.rows} 行 × {args.models} 个模型，每条回答 {args.answer_chars} 字，格式 {args.format}")
+    print(f"{'方式':<14}{'峰值RSS(MB)':>14}{'耗时(s)':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in ("legacy", "streaming"):
+            path = os.path.join(tmp_dir, f"{mode}.{args.format}")
+            cmd = [sys.executable, os.path.abspath(__file__), "--rows", str(args.rows), "--models", str(args.models),
+                   "--answer-chars", str(args.answer_chars), "--child", mode, path]
+            start = time.perf_counter()
+            output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            elapsed = time.perf_counter() - start
+            peak_kb = int(output.strip().splitlines()[-1])
+            print(f"{mode:<14}{peak_kb / 1024:>14.1f}{elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main_bench()
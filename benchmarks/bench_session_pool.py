@@ -0,0 +1,80 @@
+"""对比每次新建连接(requests.request)与共享连接池(get_shared_session)的握手次数和总耗时
+
+用法：python benchmarks/bench_session_pool.py --requests 300 --workers 8 --connect-delay 0.03
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import engine
+from mock_gateway import start_mock_gateway
+
+
+def legacy_request(model_ins, query):
+    """旧实现：每条query调用模块级requests.request，每次都新建连接"""
+    response = requests.request(
+        method="POST",
+        url=model_ins.base_url,
+        headers=model_ins.headers,
+        json=model_ins.build_payload(query),
+        stream=True,
+        timeout=engine.TIMEOUT
+    )
+    try:
+        return b"".join(response.iter_lines())
+    finally:
+        response.close()
+
+
+def run_case(server, request_func, total, workers):
+    server.connections = 0
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with counter_lock:
+                idx = next(counter, None)
+            if idx is None:
+                return
+            request_func(f"query {idx}")
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return server.connections, time.perf_counter() - start
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--connect-delay", type=float, default=0.03, help="模拟每次握手的耗时(秒)")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_gateway(connect_delay=args.connect_delay)
+    model_ins = engine.OtherModel("gpt-4o", "bench-key", f"{base_url}/v1/chat/completions", "你是一个助手")
+    engine.init_session_pool(args.workers)
+    try:
+        cases = [
+            ("requests.request(每次新建连接)", lambda q: legacy_request(model_ins, q)),
+            ("共享会话连接池", model_ins.request_model),
+        ]
+        print(f"{'方式':<30}{'握手次数':>10}{'总耗时(s)':>12}{'req/s':>10}")
+        for name, func in cases:
+            connections, elapsed = run_case(server, func, args.requests, args.workers)
+            print(f"{name:<30}{connections:>10}{elapsed:>12.2f}{args.requests / elapsed:>10.1f}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,108 @@
+"""SSE解析微基准：对比旧的逐行decode+字符串累加实现与SSEStreamParser的吞吐
+
+用法：python benchmarks/bench_sse_parser.py --size-mb 4 --rounds 3
+先按三种提供方格式生成多MB的SSE录制流（与mock_gateway输出一致），再分别解析计时。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import engine
+from mock_gateway import build_events
+
+
+def record_stream(provider, size_mb):
+    """生成约size_mb大小的SSE录制流，返回bytes行列表（含事件间空行）"""
+    tokens = []
+    total = 0
+    i = 0
+    while total < size_mb * 1024 * 1024:
+        tok = f"词{i} "
+        tokens.append(tok)
+        total += len(tok.encode("utf-8"))
+        i += 1
+    lines = []
+    for event in build_events(provider, tokens):
+        lines.append(f"data: {event}".encode("utf-8"))
+        lines.append(b"")
+    return lines
+
+
+def legacy_parse(provider, lines):
+    """旧实现：每行decode成str、json.loads、content += 文本块"""
+    content = ""
+    data = ""
+    for line in lines:
+        if line:
+            line = line.decode("utf-8")
+            if line.startswith("data:"):
+                data = line[5:].strip()
+            if provider == "claude":
+                try:
+                    json_data = json.loads(data)
+                    if json_data["type"] == "content_block_delta":
+                        content += json_data["delta"].get("text", "")
+                except json.JSONDecodeError:
+                    continue
+            elif provider == "gemini":
+                try:
+                    json_data = json.loads(data)
+                    content += json_data["candidates"][0].get("content", {}).get("parts", "")[0].get("text", "")
+                except (json.JSONDecodeError, IndexError):
+                    continue
+            elif data != "[DONE]":
+                try:
+                    json_data = json.loads(data)
+                    if "choices" in json_data:
+                        content += json_data["choices"][0].get("delta", {}).get("content", "")
+                except (json.JSONDecodeError, IndexError):
+                    continue
+    return content
+
+
+def new_parse(provider, lines):
+    decoder = {
+        "claude": engine.decode_claude_event,
+        "gemini": engine.decode_gemini_event,
+        "openai": engine.decode_openai_event,
+    }[provider]
+    parser = engine.SSEStreamParser(decoder)
+    for line in lines:
+        parser.feed(line)
+    return parser.result()
+
+
+def best_of(funcs, rounds):
+    """交替运行各实现、各取最快一次，机器负载的波动对两边的影响相同"""
+    best = [None] * len(funcs)
+    results = [None] * len(funcs)
+    for _ in range(rounds):
+        for i, func in enumerate(funcs):
+            start = time.perf_counter()
+            results[i] = func()
+            elapsed = time.perf_counter() - start
+            best[i] = elapsed if best[i] is None else min(best[i], elapsed)
+    return best, results
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'提供方':<10}{'流大小(MB)':>12}{'旧实现(MB/s)':>16}{'新解析器(MB/s)':>18}{'加速比':>10}")
+    for provider in ("claude", "gemini", "openai"):
+        lines = record_stream(provider, args.size_mb)
+        stream_mb = sum(len(line) + 1 for line in lines) / 1024 / 1024
+        (legacy_time, new_time), (legacy_res, new_res) = best_of(
+            [lambda: legacy_parse(provider, lines), lambda: new_parse(provider, lines)], args.rounds)
+        assert legacy_res == new_res, f"{provider} 解析结果不一致"
+        print(f"{provider:<10}{stream_mb:>12.1f}{stream_mb / legacy_time:>16.1f}{stream_mb / new_time:>18.1f}{legacy_time / new_time:>10.2f}x")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,112 @@
+"""启动耗时基准：冷启动导入engine/cli/main的耗时、导入时是否加载了重模块，以及GUI从进程启动到主窗口显示的耗时
+
+用法：python benchmarks/bench_startup.py --repeat 5 --budget-ms 300
+每次都在新的子进程中测量，模块不共享缓存；设置--budget-ms后任一模块导入耗时的中位数超出预算即返回1，可放进CI防止启动变慢。
+没有图形界面的环境（如未设置DISPLAY的服务器）跳过首窗口测量。
+"""
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_TARGETS = ["engine", "cli", "main"]
+HEAVY_MODULES = ["pandas", "numpy", "openpyxl", "requests", "yaml", "aiohttp"]  # 启动时不应加载，首次用到时再导入
+
+
+def child_import(name):
+    """子进程：导入一个入口模块，打印导入耗时和已加载的重模块"""
+    sys.path.insert(0, ROOT)
+    start = time.perf_counter()
+    importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"ms": elapsed * 1000, "heavy": [m for m in HEAVY_MODULES if m in sys.modules]}))
+
+
+def child_window(launched_at):
+    """子进程：创建主窗口，记录从进程启动到窗口显示、到全部控件构建完成的耗时"""
+    sys.path.insert(0, ROOT)
+    import tkinter as tk
+    try:
+        import main
+        app = main.XPengLLMRequestTools()
+    except tk.TclError as e:
+        print(json.dumps({"error": str(e)}))
+        return
+    marks = {}
+
+    def on_map(event):
+        if event.widget is app and "window" not in marks:
+            marks["window"] = (time.time() - launched_at) * 1000
+
+    def poll_ready():
+        # build_widgets在窗口显示后的空闲回调中执行，运行按钮创建出来即视为控件就绪
+        if "window" in marks and hasattr(app, "run_btn"):
+            marks["ready"] = (time.time() - launched_at) * 1000
+            app.destroy()
+        else:
+            app.after(5, poll_ready)
+
+    app.bind("<Map>", on_map, add="+")
+    app.after(5, poll_ready)
+    app.mainloop()
+    print(json.dumps(marks))
+
+
+def run_child(args, home):
+    """启动一个子进程跑测量，返回(子进程打印的结果, 进程总耗时ms)；HOME指向临时目录，避免GUI日志写进真实目录"""
+    cmd = [sys.executable, os.path.abspath(__file__)] + args
+    start = time.perf_counter()
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True, env={**os.environ, "HOME": home}).stdout
+    return json.loads(output.strip().splitlines()[-1]), (time.perf_counter() - start) * 1000
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="每项测量的次数，取中位数")
+    parser.add_argument("--budget-ms", type=float, default=None, help="导入耗时中位数的上限(毫秒)，超出时返回1")
+    parser.add_argument("--no-window", action="store_true", help="跳过首窗口测量")
+    parser.add_argument("--child-import", help=argparse.SUPPRESS)
+    parser.add_argument("--child-window", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_import:
+        child_import(args.child_import)
+        return 0
+    if args.child_window is not None:
+        child_window(args.child_window)
+        return 0
+
+    over_budget = []
+    with tempfile.TemporaryDirectory() as home:
+        print(f"{'模块':<10}{'导入(ms)':>10}{'进程总耗时(ms)':>16}  导入时加载的重模块")
+        for name in IMPORT_TARGETS:
+            runs = [run_child(["--child-import", name], home) for _ in range(args.repeat)]
+            import_ms = statistics.median(result["ms"] for result, _ in runs)
+            process_ms = statistics.median(wall for _, wall in runs)
+            heavy = sorted({m for result, _ in runs for m in result["heavy"]})
+            print(f"{name:<10}{import_ms:>10.1f}{process_ms:>16.1f}  {', '.join(heavy) or '无'}")
+            if args.budget_ms is not None and import_ms > args.budget_ms:
+                over_budget.append(name)
+
+        if not args.no_window:
+            marks = [run_child(["--child-window", str(time.time())], home)[0] for _ in range(args.repeat)]
+            if "error" in marks[0]:
+                print(f"首窗口：跳过，当前环境无法创建窗口（{marks[0]['error']}）")
+            else:
+                print(f"首窗口：进程启动到窗口显示 {statistics.median(m['window'] for m in marks):.1f} ms，"
+                      f"到全部控件就绪 {statistics.median(m['ready'] for m in marks):.1f} ms")
+
+    if over_budget:
+        print(f"【超出预算】{', '.join(over_budget)} 的导入耗时超过 {args.budget_ms} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -0,0 +1,363 @@
+"""本地模拟LLM网关：按路径返回Claude/Gemini/OpenAI三种SSE流式格式，供基准测试使用
+
+可配置首token延迟、token生成速度、5xx错误率、429注入比例、并发容量（超出时返回429）、卡住的长尾请求比例，
+以及回答长度随请求长度增长的比例（length_ratio）；
+同时模拟三家的离线批处理接口（OpenAI /v1/files+/v1/batches、Anthropic /v1/messages/batches、Gemini :batchGenerateContent），
+任务提交batch_delay秒后完成，每行按error_rate失败。也可单独启动，配合cli.py手动压测：
+python benchmarks/mock_gateway.py --port 8000 --ttft 0.3 --tps 50 --error-rate 0.01 --rate-429 0.02 --capacity 30 --stall-rate 0.02
+"""
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def build_events(provider, tokens):
+    """按提供方格式生成SSE事件列表（每个元素是一条 data: 行的内容）"""
+    if provider == "claude":
+        events = [json.dumps({"type": "message_start", "message": {}})]
+        events += [json.dumps({"type": "content_block_delta", "delta": {"type": "text_delta", "text": tok}}) for tok in tokens]
+        events.append(json.dumps({"type": "message_stop"}))
+    elif provider == "gemini":
+        events = [json.dumps({"candidates": [{"content": {"parts": [{"text": tok}]}}]}) for tok in tokens]
+    else:
+        events = [json.dumps({"choices": [{"delta": {"content": tok}}]}) for tok in tokens]
+        events.append("[DONE]")
+    return events
+
+
+def parse_multipart(content_type, body):
+    """解析multipart/form-data，返回{字段名: 字节内容}"""
+    message = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body)
+    return {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+            for part in message.iter_parts()}
+
+
+class MockGatewayHandler(BaseHTTPRequestHandler):
+    """每个连接一个handler实例，setup时计数，用于统计握手次数"""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # 与真实网关一致关闭Nagle，避免keep-alive连接上小包被延迟确认拖慢
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.stats_lock:
+            self.server.connections += 1
+        # 模拟TCP+TLS握手耗时
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self._is_batch_path():
+            self._batch_post(body)
+            return
+        with self.server.stats_lock:
+            self.server.requests += 1
+
+        # 同时进行的流达到容量时限流，模拟网关按并发配额拒绝
+        with self.server.stats_lock:
+            over_capacity = self.server.capacity is not None and self.server.active >= self.server.capacity
+            if not over_capacity:
+                self.server.active += 1
+        if over_capacity:
+            self._send_error(429, {"Retry-After": str(self.server.retry_after)})
+            return
+        try:
+            self._stream_response(len(body))
+        finally:
+            with self.server.stats_lock:
+                self.server.active -= 1
+
+    def _stream_response(self, body_len):
+        # 按比例注入429限流和5xx错误，在返回流之前失败，与真实网关一致
+        roll = random.random()
+        if roll < self.server.rate_429:
+            self._send_error(429, {"Retry-After": str(self.server.retry_after)})
+            return
+        if roll < self.server.rate_429 + self.server.error_rate:
+            self._send_error(500)
+            return
+
+        if "claude" in self.path:
+            provider = "claude"
+        elif "gemini" in self.path:
+            provider = "gemini"
+        else:
+            provider = "openai"
+        # 回答长度 = 固定token数 + 请求体每字节length_ratio个token，模拟长query对应长回答
+        tokens = [f"tok{i} " for i in range(self.server.tokens + int(body_len * self.server.length_ratio))]
+        # 长尾：少量请求的首token卡很久，模拟网关侧排队或后端实例异常
+        ttft = self.server.ttft
+        if random.random() < self.server.stall_rate:
+            ttft = self.server.stall_seconds
+            with self.server.stats_lock:
+                self.server.stalled += 1
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for idx, event in enumerate(build_events(provider, tokens)):
+                delay = ttft if idx == 0 else self.server.token_delay
+                if delay:
+                    time.sleep(delay)
+                self._write_chunk(f"data: {event}\n\n".encode("utf-8"))
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途断开（如停止时中断进行中的流），记录后结束，不再继续生成
+            self.close_connection = True
+            with self.server.stats_lock:
+                self.server.aborted += 1
+
+    # ========== 离线批处理接口 ==========
+    def _is_batch_path(self):
+        return any(key in self.path for key in ("/v1/files", "/batches", ":batchGenerateContent"))
+
+    def do_GET(self):
+        if not self._is_batch_path():
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        path = self.path.split("?")[0]
+        if path.endswith("/content"):
+            # OpenAI输出/错误文件
+            file_id = path.split("/")[-2]
+            content = self.server.batch_files.get(file_id)
+            if content is None:
+                self._send_json(404, {"error": {"message": f"file {file_id} not found"}})
+            else:
+                self._send_body(200, content, "application/jsonl")
+            return
+        if path.endswith("/results"):
+            job = self._find_job(path.split("/")[-2])
+            if job is None:
+                return
+            lines = [json.dumps(item, ensure_ascii=False) for item in self._job_results(job)]
+            self._send_body(200, "\n".join(lines).encode("utf-8"), "application/jsonl")
+            return
+        job = self._find_job(path.split("/")[-1])
+        if job is not None:
+            self._send_json(200, self._job_view(job))
+
+    def _batch_post(self, body):
+        path = self.path.split("?")[0]
+        if path.endswith("/v1/files"):
+            fields = parse_multipart(self.headers.get("Content-Type", ""), body)
+            file_id = f"file-{next(self.server.batch_ids)}"
+            self.server.batch_files[file_id] = fields["file"]
+            self._send_json(200, {"id": file_id, "purpose": fields.get("purpose", b"").decode()})
+            return
+        if path.endswith(":cancel") or path.endswith("/cancel"):
+            job = self._find_job(path.replace(":cancel", "").replace("/cancel", "").split("/")[-1])
+            if job is not None:
+                job["cancelled"] = True
+                self._send_json(200, self._job_view(job))
+            return
+        payload = json.loads(body or b"{}")
+        if path.endswith("/v1/batches"):
+            lines = self.server.batch_files.get(payload.get("input_file_id"), b"").decode("utf-8").splitlines()
+            items = [json.loads(line) for line in lines if line.strip()]
+            requests = [(item["custom_id"], item["body"]) for item in items]
+            provider = "openai"
+        elif path.endswith("/v1/messages/batches"):
+            requests = [(item["custom_id"], item["params"]) for item in payload["requests"]]
+            provider = "claude"
+        else:
+            inline = payload["batch"]["input_config"]["requests"]["requests"]
+            requests = [(item["metadata"]["key"], item["request"]) for item in inline]
+            provider = "gemini"
+        job_id = f"batch_{next(self.server.batch_ids)}"
+        job = {"id": job_id, "provider": provider, "requests": requests, "created": time.monotonic(),
+               "cancelled": False, "results": None}
+        with self.server.stats_lock:
+            self.server.batch_jobs[job_id] = job
+            self.server.batch_requests += len(requests)
+        self._send_json(200, self._job_view(job))
+
+    def _find_job(self, job_id):
+        job = self.server.batch_jobs.get(job_id)
+        if job is None:
+            self._send_json(404, {"error": {"message": f"batch {job_id} not found"}})
+        return job
+
+    def _job_results(self, job):
+        """任务结束时按error_rate一次性生成每行结果，请求体含block_marker的行返回被拦截的结果，取消的任务只返回已“完成”的前一半"""
+        if job["results"] is None:
+            requests = job["requests"][:len(job["requests"]) // 2] if job["cancelled"] else job["requests"]
+            marker = self.server.block_marker
+            job["results"] = [(custom_id, "blocked" if marker and marker in json.dumps(payload, ensure_ascii=False)
+                               else random.random() >= self.server.error_rate) for custom_id, payload in requests]
+        provider = job["provider"]
+        text = "".join(f"tok{i} " for i in range(self.server.tokens))
+        items = []
+        for custom_id, ok in job["results"]:
+            if ok == "blocked":
+                items.append(self._blocked_item(provider, custom_id))
+            elif provider == "claude":
+                result = ({"type": "succeeded", "message": {"content": [{"type": "text", "text": text}]}} if ok else
+                          {"type": "errored", "error": {"type": "error", "error": {"type": "api_error", "message": "mock batch error"}}})
+                items.append({"custom_id": custom_id, "result": result})
+            elif provider == "gemini":
+                items.append({"metadata": {"key": custom_id},
+                              **({"response": {"candidates": [{"content": {"parts": [{"text": text}]}}]}} if ok else
+                                 {"error": {"code": 500, "message": "mock batch error"}})})
+            else:
+                items.append({"custom_id": custom_id, "response": {
+                    "status_code": 200 if ok else 500,
+                    "body": {"choices": [{"message": {"content": text}}]} if ok else {"error": {"message": "mock batch error"}}
+                }})
+        return items
+
+    @staticmethod
+    def _blocked_item(provider, custom_id):
+        """被内容安全策略拦截的行：HTTP层面成功，但结果中没有正常的回答字段"""
+        if provider == "claude":
+            return {"custom_id": custom_id, "result": {"type": "succeeded", "message": {"content": [], "stop_reason": "refusal"}}}
+        if provider == "gemini":
+            return {"metadata": {"key": custom_id}, "response": {"promptFeedback": {"blockReason": "SAFETY"}}}
+        return {"custom_id": custom_id, "response": {"status_code": 200, "body": {"choices": [], "error": None}}}
+
+    def _job_view(self, job):
+        """按提供方格式返回任务状态；到期或被取消时视为结束"""
+        ended = job["cancelled"] or time.monotonic() - job["created"] >= self.server.batch_delay
+        if job["provider"] == "claude":
+            host = self.headers.get("Host")
+            return {"id": job["id"], "processing_status": "ended" if ended else "in_progress",
+                    "results_url": f"http://{host}/v1/messages/batches/{job['id']}/results" if ended else None}
+        if job["provider"] == "gemini":
+            view = {"name": f"batches/{job['id']}", "done": ended}
+            if ended:
+                view["response"] = {"inlinedResponses": {"inlinedResponses": self._job_results(job)}}
+            return view
+        view = {"id": job["id"], "status": ("cancelled" if job["cancelled"] else "completed") if ended else "in_progress"}
+        if ended:
+            items = self._job_results(job)
+            for key, keep in (("output_file_id", True), ("error_file_id", False)):
+                lines = [json.dumps(item) for item in items if (item["response"]["status_code"] == 200) == keep]
+                if lines:
+                    file_id = f"{job['id']}-{key}"
+                    self.server.batch_files[file_id] = "\n".join(lines).encode("utf-8")
+                    view[key] = file_id
+        return view
+
+    def _send_json(self, status, obj):
+        self._send_body(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), "application/json")
+
+    def _send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, headers=None):
+        body = json.dumps({"error": {"code": status, "message": "mock gateway injected error"}}).encode("utf-8")
+        with self.server.stats_lock:
+            self.server.injected[status] = self.server.injected.get(status, 0) + 1
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+class MockGatewayServer(ThreadingHTTPServer):
+    """默认监听队列只有5，高并发基准下客户端会卡在SYN重传上，这里放大"""
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_mock_gateway(connect_delay=0.0, tokens=20, token_delay=0.0, ttft=None, error_rate=0.0, rate_429=0.0,
+                       retry_after=1, capacity=None, stall_rate=0.0, stall_seconds=10.0, batch_delay=2.0,
+                       length_ratio=0.0, block_marker=None, port=0):
+    """后台启动模拟网关，返回(server, base_url)；用完调用server.shutdown()
+
+    ttft为响应头之后到第一个事件的延迟，默认与token_delay相同；error_rate/rate_429为返回500/429的请求比例；
+    capacity为同时进行的流数上限，超出的请求返回429，为None时不限；stall_rate比例的请求首token延迟stall_seconds秒；
+    batch_delay为批处理任务从提交到完成的秒数；length_ratio为请求体每字节额外生成的token数；
+    block_marker非空时，批处理任务中请求体含该字符串的行按被内容安全策略拦截返回
+    """
+    server = MockGatewayServer(("127.0.0.1", port), MockGatewayHandler)
+    server.stats_lock = threading.Lock()
+    server.connections = 0
+    server.requests = 0
+    server.aborted = 0
+    server.injected = {}  # 状态码 -> 注入次数
+    server.connect_delay = connect_delay
+    server.tokens = tokens
+    server.token_delay = token_delay
+    server.ttft = token_delay if ttft is None else ttft
+    server.error_rate = error_rate
+    server.rate_429 = rate_429
+    server.retry_after = retry_after
+    server.capacity = capacity
+    server.stall_rate = stall_rate
+    server.stall_seconds = stall_seconds
+    server.stalled = 0
+    server.active = 0
+    server.batch_delay = batch_delay
+    server.length_ratio = length_ratio
+    server.block_marker = block_marker
+    server.batch_ids = itertools.count(1)
+    server.batch_files = {}  # 文件ID -> 内容
+    server.batch_jobs = {}   # 任务ID -> 任务
+    server.batch_requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def reset_stats(server):
+    """基准测试在多轮之间清零计数"""
+    with server.stats_lock:
+        server.connections = 0
+        server.requests = 0
+        server.aborted = 0
+        server.injected = {}
+        server.stalled = 0
+        server.batch_requests = 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--ttft", type=float, default=0.3, help="首token延迟(秒)")
+    parser.add_argument("--tps", type=float, default=50, help="每秒生成的token数")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--capacity", type=int, default=None, help="同时进行的流数上限，超出返回429")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="首token卡住的请求比例")
+    parser.add_argument("--stall-seconds", type=float, default=10.0, help="卡住的请求的首token延迟(秒)")
+    parser.add_argument("--length-ratio", type=float, default=0.0, help="请求体每字节额外生成的token数")
+    parser.add_argument("--batch-delay", type=float, default=2.0, help="批处理任务从提交到完成的秒数")
+    args = parser.parse_args()
+    server, base_url = start_mock_gateway(tokens=args.tokens, token_delay=1 / args.tps, ttft=args.ttft, error_rate=args.error_rate,
+                                          rate_429=args.rate_429, retry_after=args.retry_after, capacity=args.capacity,
+                                          stall_rate=args.stall_rate, stall_seconds=args.stall_seconds,
+                                          batch_delay=args.batch_delay, length_ratio=args.length_ratio, port=args.port)
+    print(f"模拟网关已启动：{base_url}  （Claude: /claude/{{model}}，Gemini: /gemini/{{model}}，其余路径为OpenAI格式；"
+          f"批处理接口根地址即 {base_url}）")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,109 @@
+"""命令行批量运行入口：不加载任何界面库，适合服务器/定时任务/CI中直接跑批
+
+用法：python cli.py --config config.yaml --prompt prompt.txt --data data.xlsx --output result.csv \
+          --env 测试 --models gpt-4o,claude-sonnet-4 --workers 20 --engine asyncio
+"""
+import argparse
+import multiprocessing
+import signal
+import sys
+import time
+
+import engine
+
+CACHE_CHOICES = dict(zip(["use", "refresh", "off"], engine.CACHE_MODES))
+MODE_CHOICES = dict(zip(["stream", "batch"], engine.REQUEST_MODES))
+SCHEDULE_CHOICES = dict(zip(["row", "longest"], engine.SCHEDULE_POLICIES))
+ENV_CHOICES = {**engine.ENV_MAP, **{env: env for env in engine.ENV_MAP.values()}}  # 中英文环境名均可
+
+
+def log(msg):
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {msg}", file=sys.stderr, flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="XPengLLMRequestTools 命令行批量请求")
+    parser.add_argument("--config", required=True, help="yaml配置文件")
+    parser.add_argument("--prompt", required=True, help="System Prompt文本文件")
+    parser.add_argument("--data", required=True, help="数据文件(xlsx/csv/parquet/jsonl)，需包含query列")
+    parser.add_argument("--output", required=True, help="结果文件，按扩展名写出csv或xlsx")
+    parser.add_argument("--env", default="测试", choices=list(ENV_CHOICES), help="运行环境")
+    parser.add_argument("--models", default="all", help="逗号分隔的模型名，默认all为全部模型")
+    parser.add_argument("--workers", type=int, default=3, help="全局并发数")
+    parser.add_argument("--model-limit", type=int, default=None, help="单模型并发上限，默认不限（yaml的concurrency段优先）")
+    parser.add_argument("--engine", default="threading", choices=["threading", "asyncio"], help="请求引擎")
+    parser.add_argument("--cache", default="use", choices=list(CACHE_CHOICES), help="响应缓存：use使用/refresh刷新/off不使用")
+    parser.add_argument("--write-mode", default="stream", choices=["stream", "end"],
+                        help="stream边跑边写（默认）/ end结束后一次性保存")
+    parser.add_argument("--no-dedup", action="store_true", help="重复query逐条请求（默认同一模型下相同query只请求一次）")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="自适应并发：--workers和单模型上限只作为上限，各模型并发按延迟和429/5xx自动增减")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="请求进程数，大于1时数据按批分给多个子进程，--workers在各进程间均分")
+    parser.add_argument("--hedge", action="store_true",
+                        help="对冲慢请求：首token超过近期分位数仍未返回时向另一节点补发，额外请求受yaml hedging.budget限制")
+    parser.add_argument("--mode", default="stream", choices=list(MODE_CHOICES),
+                        help="stream流式请求（默认）/ batch提交提供方的离线批处理任务，需在yaml中配置batch_urls，结果完成后按行回填")
+    parser.add_argument("--schedule", default="row", choices=list(SCHEDULE_CHOICES),
+                        help="row按行顺序（默认）/ longest长任务优先：按估计耗时先发最长的请求，各模型列大致同时完成，结果仍按原行序写出")
+    parser.add_argument("--verbose", action="store_true", help="逐条输出成功日志（失败始终输出）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        yaml_config = engine.load_yaml_config(args.config)
+        with open(args.prompt, "r", encoding="utf-8") as f:
+            system_prompt = f.read()
+    except Exception as e:
+        log(f"【错误】读取配置/Prompt失败：{str(e)}")
+        return 2
+
+    model_names = engine.MODEL_LIST if args.models == "all" else [m.strip() for m in args.models.split(",") if m.strip()]
+    model_configs = engine.build_model_configs(yaml_config, ENV_CHOICES[args.env], model_names, args.model_limit, log)
+    if not model_configs:
+        log("❌ 无选中的有效模型")
+        return 2
+
+    # 第一次Ctrl+C优雅停止（已完成的结果照常写出、任务日志保留供续跑），第二次直接退出
+    def on_sigint(signum, frame):
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        engine.request_stop()
+        log("🔴 收到停止指令，正在终止所有模型请求任务...（再按一次Ctrl+C强制退出）")
+    signal.signal(signal.SIGINT, on_sigint)
+
+    # kill -USR1 <pid> 暂停/继续：暂停期间不再发起新请求，进行中的请求照常完成
+    def on_sigusr1(signum, frame):
+        if engine.is_paused():
+            engine.resume_requests()
+            log("▶️ 已继续，恢复发起请求")
+        else:
+            engine.pause_requests()
+            log("⏸️ 已暂停，再次发送SIGUSR1继续")
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, on_sigusr1)
+
+    stream = args.write_mode == "stream"
+    runner = engine.BatchRunner(
+        yaml_config, args.data, system_prompt, ENV_CHOICES[args.env],
+        max_workers=args.workers, engine=args.engine, cache_mode=CACHE_CHOICES[args.cache],
+        stream_save_path=args.output if stream else None, log_func=log, log_rows=args.verbose,
+        dedup=not args.no_dedup, adaptive=args.adaptive,
+        processes=args.processes, hedge=args.hedge, request_mode=MODE_CHOICES[args.mode],
+        schedule=SCHEDULE_CHOICES[args.schedule]
+    )
+    log("🚀 开始执行批量模型请求任务")
+    completed = runner.run(model_configs)
+    if not stream:
+        # 停止时也保存已完成的部分，未完成的行为“任务终止”；只有全部完成才删除任务日志
+        result_df = runner.build_result_frame()
+        saved = result_df is not None and runner.save_result_frame(result_df, args.output)
+        completed = completed and saved
+    runner.close(discard_journal=completed)
+    return 0 if completed else 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
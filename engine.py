@@ -0,0 +1,3093 @@
+"""批量请求引擎：模型请求、调度、缓存、续跑、结果写出，不依赖任何界面库，供GUI(main.py)和命令行(cli.py)共用
+
+pandas/openpyxl/requests/yaml/aiohttp导入耗时较长，只在首次用到的函数内导入，GUI和命令行启动时不加载
+"""
+import os
+import threading
+import time
+import json
+import math
+import asyncio
+import hashlib
+import heapq
+import itertools
+import sqlite3
+import csv
+import random
+import socket
+import queue
+import multiprocessing
+from array import array
+from email.utils import parsedate_to_datetime
+from collections import deque, OrderedDict
+from threading import Lock
+from urllib.parse import urlsplit
+
+# ========== 核心配置【不变】 ==========
+ENV_MAP = {
+    "测试": "test",
+    "预发": "pre",
+    "生产": "pro"
+}
+MODEL_LIST = [
+    'gpt-5', 'gpt-5-mini', 'gpt-4.1', 'gpt-4', 'gpt-35-turbo',
+    'gpt-4o', 'gpt-4o-mini', 'o3-mini', 'gemini-2.5-pro', 'gemini-2.5-flash-lite',
+    'gemini-2.5-flash', 'claude-opus-4-1', 'claude-opus-4', 'claude-sonnet-4',
+    'qwen-omni-turbo', 'deepseek-r1'
+]
+
+# ========== 全局变量+线程安全锁【核心修复：新增所有锁】 ==========
+IS_STOP = False  # 任务停止标识
+RUN_GATE = threading.Event()  # 暂停开关：清除时不再发起新请求，进行中的请求照常完成
+RUN_GATE.set()
+INFLIGHT_RESPONSES = set()  # 正在读取的流式响应，停止时统一中断
+INFLIGHT_LOCK = Lock()
+STOP_POLL_SECONDS = 0.1  # 等待/轮询时检查停止标识的间隔，决定停止的响应速度
+TIMEOUT = 60         # 请求超时时间
+SESSION_POOL = {}    # 按 scheme://host 共享的keep-alive会话
+SESSION_LOCK = Lock()  # 会话池的线程锁
+SESSION_POOL_SIZE = 10  # 每个会话的连接池大小，运行时按全局并发数调整
+
+# ========== 停止/暂停：停止时立即中断进行中的流，暂停时只是不再发起新请求 ==========
+def request_stop():
+    """GUI停止按钮/命令行Ctrl+C调用：中断所有进行中的流，工作线程和协程在下一个检查点退出"""
+    global IS_STOP
+    IS_STOP = True
+    RUN_GATE.set()  # 唤醒暂停中的线程，让它们看到停止标识后退出
+    with INFLIGHT_LOCK:
+        responses = list(INFLIGHT_RESPONSES)
+    for response in responses:
+        abort_response(response)
+
+def reset_stop():
+    """新一轮运行开始前清除停止/暂停状态"""
+    global IS_STOP
+    IS_STOP = False
+    RUN_GATE.set()
+
+def pause_requests():
+    RUN_GATE.clear()
+
+def resume_requests():
+    RUN_GATE.set()
+
+def is_paused():
+    return not RUN_GATE.is_set()
+
+def wait_while_paused():
+    """暂停期间阻塞，恢复或停止后返回"""
+    while not IS_STOP and not RUN_GATE.wait(STOP_POLL_SECONDS):
+        pass
+
+async def async_wait_while_paused():
+    while not IS_STOP and not RUN_GATE.is_set():
+        await asyncio.sleep(STOP_POLL_SECONDS)
+
+def abort_response(response):
+    """中断一个流式响应：先shutdown底层socket唤醒阻塞在recv上的读取线程，只调用close会一直等到下一块数据到达"""
+    try:
+        sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    try:
+        response.close()
+    except Exception:
+        pass
+
+# ========== 连接池：同一网关复用TCP+TLS连接 ==========
+def init_session_pool(pool_size):
+    """按调度器并发数设置连接池大小；大小变化时关闭旧会话，下次请求时重建"""
+    global SESSION_POOL_SIZE
+    with SESSION_LOCK:
+        if pool_size == SESSION_POOL_SIZE:
+            return
+        SESSION_POOL_SIZE = pool_size
+        for session in SESSION_POOL.values():
+            session.close()
+        SESSION_POOL.clear()
+
+def get_shared_session(base_url):
+    """获取base_url所在网关的共享会话，所有模型实例复用同一个连接池"""
+    parts = urlsplit(base_url)
+    pool_key = f"{parts.scheme}://{parts.netloc}"
+    with SESSION_LOCK:
+        session = SESSION_POOL.get(pool_key)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SESSION_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            SESSION_POOL[pool_key] = session
+        return session
+
+# ========== SSE解析：统一的增量解析器 + 按提供方的事件解码器 ==========
+def decode_claude_event(json_data):
+    """Claude：只取content_block_delta事件中的文本"""
+    if json_data.get("type") == "content_block_delta":
+        return json_data["delta"].get("text", "")
+    return ""
+
+def decode_gemini_event(json_data):
+    """Gemini：candidates[0].content.parts[0].text；缺少字段的事件（如只带finishReason的结束事件）抛KeyError，由解析器按无文本跳过"""
+    return json_data["candidates"][0]["content"]["parts"][0].get("text", "")
+
+def decode_openai_event(json_data):
+    """OpenAI兼容格式：choices[0].delta.content"""
+    choices = json_data.get("choices")
+    if not choices:
+        return ""
+    return choices[0].get("delta", {}).get("content") or ""
+
+JSON_RAW_DECODE = json.JSONDecoder().raw_decode  # 跳过json.loads的类型判断和编码探测
+
+class SSEStreamParser:
+    """增量SSE解析器：逐行喂入bytes，只解析data:行，文本块先收集到列表，结束时一次性拼接"""
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.chunks = []
+        self.first_chunk_time = None  # 首个非空文本块到达的时间(perf_counter)
+
+    def feed(self, line):
+        if not line.startswith(b"data:"):
+            return
+        try:
+            # data:后通常只有一个空格，直接从JSON起始位置解析，省去切片和strip；[DONE]、空行和不规范的空白走下面的慢路径
+            data = line.decode("utf-8")
+            try:
+                json_data = JSON_RAW_DECODE(data, 6 if data.startswith(" ", 5) else 5)[0]
+            except ValueError:
+                data = data[5:].strip()
+                if not data or data == "[DONE]":
+                    return
+                json_data = JSON_RAW_DECODE(data)[0]
+            text = self.decoder(json_data)
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+            return
+        if text:
+            if self.first_chunk_time is None:
+                self.first_chunk_time = time.perf_counter()
+            self.chunks.append(text)
+
+    def result(self):
+        return "".join(self.chunks)
+
+# ========== 响应缓存：SQLite本地持久化，相同(模型, payload, 环境)直接返回 ==========
+CACHE_MODES = ["使用缓存", "刷新缓存", "不使用缓存"]
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".xpeng_llm_cache.sqlite")
+
+class ResponseCache:
+    """本地响应缓存：key为(模型名, payload, 环境)的sha256，按TTL过期，超出容量时按最近访问淘汰"""
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl_hours=24 * 7, max_size_mb=500, refresh=False):
+        self.path = path
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.refresh = refresh  # 刷新模式：不读缓存，只写入最新结果
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._accessed = {}  # 命中的key -> 最近访问时间，不在每次命中时写库，淘汰/关闭前批量写回
+        # 多进程模式下各分片共用同一个缓存文件，写锁等待时间放宽，避免写缓存失败把成功的响应变成错误
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model_name TEXT, response TEXT, size INTEGER, created_at REAL, accessed_at REAL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_name, payload, env):
+        raw = json.dumps([model_name, payload, env], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """命中且未过期时返回缓存内容，否则返回None"""
+        with self._lock:
+            if self.refresh:
+                self.misses += 1
+                return None
+            row = self._conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._accessed[key] = now
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model_name, response):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model_name, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, response, len(response.encode("utf-8")), now, now)
+            )
+            self._conn.commit()
+
+    def output_stats(self):
+        """各模型缓存的条数和平均回答长度(字符)，用于估计请求耗时"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT model_name, COUNT(*), AVG(LENGTH(response)) FROM responses GROUP BY model_name"
+            ).fetchall()
+
+    def _flush_accessed(self):
+        """把攒下的访问时间一次性写回，调用方需持有self._lock"""
+        if not self._accessed:
+            return
+        self._conn.executemany(
+            "UPDATE responses SET accessed_at = ? WHERE key = ?",
+            [(accessed_at, key) for key, accessed_at in self._accessed.items()]
+        )
+        self._conn.commit()
+        self._accessed.clear()
+
+    def evict(self):
+        """删除过期条目，总大小超过上限时从最久未访问的开始删除"""
+        with self._lock:
+            self._flush_accessed()  # 先写回访问时间，按最新的访问顺序淘汰
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC) AS total FROM responses) "
+                "WHERE total > ?)",
+                (self.max_size_bytes,)
+            )
+            self._conn.commit()
+
+    def close(self, evict=True):
+        """多进程模式下子进程只关闭连接，淘汰由主进程统一做一次"""
+        if evict:
+            self.evict()
+        with self._lock:
+            self._flush_accessed()
+            self._conn.close()
+
+# ========== 断点续跑：逐条追加的JSONL任务日志 ==========
+DEFAULT_JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".xpeng_llm_journal")
+
+def is_failed_result(res):
+    """请求失败/被终止/空内容的结果不算完成，续跑时需要重新请求"""
+    return res is None or isinstance(res, RequestError) or res in ("任务已终止", "任务终止", "模型返回空内容")
+
+class RunJournal:
+    """任务日志：每完成一个(模型, 行)立即追加一行JSON，重启同一份数据+配置时据此跳过已完成的行；
+    批处理模式下还记录已提交、尚未回填的任务，续跑时继续轮询而不是重新提交"""
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}  # 打开时已存在的结果：(model_name, 行号) -> 结果
+        self.batch_jobs = {}  # 打开时尚未回填的批处理任务：任务ID -> (model_name, {custom_id: (行号, 缓存key)})
+        self._lock = Lock()
+        needs_newline = False
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    needs_newline = not line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                        if "batch_job" not in record:
+                            self.completed[(record["model"], record["row"])] = record["result"]
+                        elif record.get("done"):
+                            self.batch_jobs.pop(record["batch_job"], None)
+                        else:
+                            self.batch_jobs[record["batch_job"]] = (
+                                record["model"], {custom_id: tuple(row) for custom_id, row in record["rows"].items()})
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        continue  # 崩溃时写了一半的行直接丢弃
+        self._file = open(path, "a", encoding="utf-8")
+        if needs_newline:
+            self._file.write("\n")
+
+    @staticmethod
+    def make_run_key(data_path, env, system_prompt):
+        """同一份数据文件(按内容)+环境+系统提示词对应同一份任务日志"""
+        digest = hashlib.sha256()
+        digest.update(json.dumps([env, system_prompt.strip()], ensure_ascii=False).encode("utf-8"))
+        with open(data_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()[:32]
+
+    def record(self, model_name, row_idx, res):
+        self._append({"model": model_name, "row": row_idx, "result": res})
+
+    def record_batch_job(self, model_name, job_id, rows):
+        """批处理任务提交成功后立即记录，rows为custom_id -> (行号, 缓存key)"""
+        self._append({"batch_job": job_id, "model": model_name, "rows": rows})
+
+    def finish_batch_job(self, job_id):
+        """任务的结果已全部回填（行结果已先于此记录）"""
+        self._append({"batch_job": job_id, "done": True})
+
+    def _append(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def discard(self):
+        """结果文件保存成功后删除日志"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# ========== 数据读取：按块惰性读取query列，边读边分发 ==========
+DATA_CHUNK_SIZE = 1000  # 每块读取的行数，内存占用与之成正比
+DATA_FILETYPES = [("Excel", "*.xlsx *.xls"), ("CSV", "*.csv"), ("Parquet", "*.parquet"), ("JSONL", "*.jsonl"), ("所有文件", "*.*")]
+MISSING_QUERY_MSG = "数据文件必须包含'query'列作为模型输入！"
+
+def normalize_query(value):
+    """空单元格(None/NaN)转为空串，其它值统一转为字符串"""
+    if value is None or value != value:
+        return ""
+    return value if isinstance(value, str) else str(value)
+
+def iter_query_chunks(path, chunk_size=DATA_CHUNK_SIZE):
+    """按块读取数据文件的query列，每次产出一个query列表；缺少query列时抛出ValueError"""
+    lower_path = path.lower()
+    if lower_path.endswith(".csv"):
+        import pandas as pd
+        if "query" not in pd.read_csv(path, encoding="utf-8", nrows=0).columns:
+            raise ValueError(MISSING_QUERY_MSG)
+        with pd.read_csv(path, encoding="utf-8", usecols=["query"], dtype={"query": object}, chunksize=chunk_size) as reader:
+            for chunk in reader:
+                yield [normalize_query(v) for v in chunk["query"].tolist()]
+
+    elif lower_path.endswith(".xlsx"):
+        # openpyxl只读模式逐行解析，与pd.read_excel一样读取第一个sheet
+        import openpyxl
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = list(next(rows, ()))
+            if "query" not in header:
+                raise ValueError(MISSING_QUERY_MSG)
+            col = header.index("query")
+            chunk = []
+            for row in rows:
+                chunk.append(normalize_query(row[col] if col < len(row) else None))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            workbook.close()
+
+    elif lower_path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("读取Parquet文件需要先安装pyarrow")
+        parquet_file = pq.ParquetFile(path)
+        if "query" not in parquet_file.schema_arrow.names:
+            raise ValueError(MISSING_QUERY_MSG)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=["query"]):
+            yield [normalize_query(v) for v in batch.column(0).to_pylist()]
+
+    elif lower_path.endswith((".jsonl", ".ndjson")):
+        with open(path, "r", encoding="utf-8") as f:
+            chunk = []
+            header_checked = False
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"JSONL文件第 {line_no} 行不是合法的JSON：{str(e)}") from None
+                if not isinstance(record, dict):
+                    raise ValueError(f"JSONL文件第 {line_no} 行不是JSON对象，每行应为{{\"query\": ...}}形式的对象")
+                # 以第一条非空记录代替表头检查query列
+                if not header_checked:
+                    if "query" not in record:
+                        raise ValueError(MISSING_QUERY_MSG)
+                    header_checked = True
+                chunk.append(normalize_query(record.get("query")))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    else:
+        # xls等旧格式无法流式解析，整表读入后分块产出
+        import pandas as pd
+        df = pd.read_excel(path)
+        if "query" not in df.columns:
+            raise ValueError(MISSING_QUERY_MSG)
+        queries = df["query"].tolist()
+        del df
+        for start in range(0, len(queries), chunk_size):
+            yield [normalize_query(v) for v in queries[start:start + chunk_size]]
+
+# ========== 流式结果写出：行完成即落盘，内存不随数据量增长 ==========
+WRITE_MODES = ["结束后保存", "边跑边写"]
+
+class StreamingResultWriter:
+    """按原始行序边跑边写结果：某行所有模型都完成后立即写出并释放，csv直接追加，xlsx走openpyxl只写模式"""
+    def __init__(self, path, model_names):
+        self.path = path
+        self.model_names = list(model_names)
+        self.total_rows = 0
+        self.rows_written = 0
+        self.unfinished = 0  # 写出时仍没有结果、标记为任务终止的(行, 模型)数
+        self.closed = False
+        self._pending = {}  # 行号 -> {model_name: (结果, 指标)}，只缓存尚未写出的行
+        self._queries = {}  # 行号 -> query，只缓存尚未写出的行
+        self._lock = Lock()
+        header = ["query"]
+        for name in self.model_names:
+            header += [name] + metric_column_names(name)
+        if path.endswith(".csv"):
+            self._file = open(path, "w", encoding="utf-8-sig", newline="")
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(header)
+            self._workbook = None
+        else:
+            import openpyxl
+            self._file = None
+            self._workbook = openpyxl.Workbook(write_only=True)
+            self._sheet = self._workbook.create_sheet()
+            self._sheet.append(header)
+
+    def add_query(self, row_idx, query):
+        """读取数据时按行序登记query，行号必须连续递增"""
+        with self._lock:
+            self._queries[row_idx] = query
+            self.total_rows = row_idx + 1
+            self._flush_ready()
+
+    def set_result(self, model_name, row_idx, res, metrics=None):
+        with self._lock:
+            if self.closed:
+                return  # 停止后仍在返回的请求结果直接丢弃
+            self._pending.setdefault(row_idx, {})[model_name] = (res, metrics)
+            self._flush_ready()
+
+    def _flush_ready(self):
+        """从下一个待写行开始，连续写出所有模型都已完成的行"""
+        while self.rows_written in self._queries and len(self._pending.get(self.rows_written, ())) == len(self.model_names):
+            self._write_row(self.rows_written, self._pending.pop(self.rows_written))
+
+    def _write_row(self, row_idx, row_results):
+        row = [self._queries.pop(row_idx)]
+        for name in self.model_names:
+            if name not in row_results:
+                self.unfinished += 1
+            res, metrics = row_results.get(name, ("任务终止", None))
+            row += [result_text(res)] + (metrics.row_values() if metrics is not None else [None] * len(METRIC_COLUMNS))
+        if self._workbook is None:
+            self._csv.writerow(row)
+        else:
+            self._sheet.append(row)
+        self.rows_written += 1
+
+    def close(self):
+        """写出剩余行（未完成的模型列标记为任务终止）并保存文件"""
+        with self._lock:
+            while self.rows_written < self.total_rows:
+                self._write_row(self.rows_written, self._pending.pop(self.rows_written, {}))
+            if self._workbook is None:
+                self._file.close()
+            else:
+                self._workbook.save(self.path)
+            self.closed = True
+
+# ========== 重试策略：指数退避+抖动+Retry-After，失败结果结构化 ==========
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}  # 其余4xx视为永久错误，不重试
+
+class RequestError(Exception):
+    """结构化的请求失败：重试循环中作为异常抛出，最终失败时直接作为该行结果，写表时转为文本"""
+    def __init__(self, kind, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.kind = kind                # http / timeout / connection / cancelled / error
+        self.message = message
+        self.status = status            # HTTP状态码，非HTTP错误为None
+        self.retry_after = retry_after  # 服务端要求的等待秒数
+        self.attempts = 1
+
+    @property
+    def transient(self):
+        return self.kind in ("timeout", "connection") or self.status in RETRYABLE_STATUS
+
+    @property
+    def label(self):
+        return f"HTTP {self.status}" if self.status else self.kind
+
+    def __str__(self):
+        return f"请求异常[{self.label}]: {self.message[:100]}（共尝试{self.attempts}次）"
+
+    def __reduce__(self):
+        # 多进程模式下结果要跨进程传回，Exception默认只按args重建，会丢失结构化字段
+        return self.__class__, (self.kind, self.message, self.status, self.retry_after), {"attempts": self.attempts}
+
+def parse_retry_after(value):
+    """Retry-After支持秒数和HTTP日期两种格式，解析失败返回None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def http_request_error(status, retry_after, body):
+    return RequestError("http", f"HTTP {status}: {body[:100]}", status=status, retry_after=parse_retry_after(retry_after))
+
+def to_request_error(exc, attempts=1):
+    """把requests/asyncio等异常统一转换为RequestError，并记录已尝试次数"""
+    import requests
+    if isinstance(exc, RequestError):
+        error = exc
+    elif isinstance(exc, (requests.Timeout, asyncio.TimeoutError, TimeoutError)):
+        error = RequestError("timeout", str(exc) or "请求超时")
+    elif isinstance(exc, (requests.ConnectionError, requests.exceptions.ChunkedEncodingError, ConnectionError)):
+        error = RequestError("connection", str(exc))
+    else:
+        error = RequestError("error", str(exc) or type(exc).__name__)
+    error.attempts = attempts
+    return error
+
+def result_text(res):
+    """写表用：RequestError转为可读文本，其余结果原样返回"""
+    return str(res) if isinstance(res, RequestError) else res
+
+class RetryPolicy:
+    """重试策略：只重试超时/连接错误/429/5xx，指数退避+随机抖动，服务端给出Retry-After时优先遵循"""
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=30.0, jitter=0.5, max_retry_after=120.0):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter                    # 退避时间随机缩短的最大比例，打散同时失败的请求
+        self.max_retry_after = max_retry_after  # Retry-After的上限，防止服务端给出过长等待
+
+    @classmethod
+    def from_config(cls, cfg):
+        keys = ("max_attempts", "base_delay", "max_delay", "jitter", "max_retry_after")
+        return cls(**{k: cfg[k] for k in keys if k in cfg})
+
+    def should_retry(self, error):
+        return error.transient and error.attempts < self.max_attempts
+
+    def next_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return delay * (1 - self.jitter * random.random())
+
+def sleep_unless_stopped(seconds):
+    """分段sleep，收到停止指令立即返回"""
+    deadline = time.time() + seconds
+    while not IS_STOP and time.time() < deadline:
+        time.sleep(max(0, min(STOP_POLL_SECONDS, deadline - time.time())))
+
+async def async_sleep_unless_stopped(seconds):
+    deadline = time.time() + seconds
+    while not IS_STOP and time.time() < deadline:
+        await asyncio.sleep(max(0, min(STOP_POLL_SECONDS, deadline - time.time())))
+
+# ========== 客户端限流：按模型的RPM/TPM令牌桶，所有工作线程共享 ==========
+CHARS_PER_TOKEN = 2  # 估算token数用的平均字符数，中英文混合取偏保守的值
+
+def estimate_tokens(payload, output_tokens=None):
+    """粗略估算一次请求消耗的token：输入按字符数折算，输出取配置值或payload中的max_tokens"""
+    input_tokens = len(json.dumps(payload, ensure_ascii=False)) // CHARS_PER_TOKEN
+    if output_tokens is None:
+        output_tokens = payload.get("max_tokens", 0)
+    return input_tokens + output_tokens
+
+class TokenBucket:
+    """令牌桶：容量capacity，每秒补充rate个；预约制，余额可以为负，返回需要等待的秒数"""
+    def __init__(self, capacity, rate, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self.clock = clock
+        self.tokens = capacity
+        self.updated_at = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount):
+        self.refill()
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class RateLimiter:
+    """单模型限流器：RPM桶按请求计数，TPM桶按估算token计数；burst_seconds控制允许的突发量"""
+    def __init__(self, rpm=None, tpm=None, burst_seconds=10, output_tokens=None, clock=time.monotonic):
+        self.output_tokens = output_tokens
+        self._lock = Lock()
+        self._buckets = []  # [(桶, 是否按token计)]
+        if rpm:
+            self._buckets.append((TokenBucket(max(1.0, rpm * burst_seconds / 60), rpm / 60, clock), False))
+        if tpm:
+            self._buckets.append((TokenBucket(max(1.0, tpm * burst_seconds / 60), tpm / 60, clock), True))
+
+    @classmethod
+    def from_config(cls, cfg):
+        """yaml rate_limits段：rpm/tpm/burst_seconds/output_tokens，未配置rpm和tpm时返回None"""
+        if not cfg.get("rpm") and not cfg.get("tpm"):
+            return None
+        keys = ("rpm", "tpm", "burst_seconds", "output_tokens")
+        return cls(**{k: cfg[k] for k in keys if k in cfg})
+
+    def reserve(self, payload):
+        """为一次请求预约额度，返回发送前需要等待的秒数"""
+        tokens = estimate_tokens(payload, self.output_tokens)
+        with self._lock:
+            return max(bucket.reserve(tokens if by_token else 1) for bucket, by_token in self._buckets)
+
+    def try_reserve(self, payload):
+        """可有可无的请求（如对冲）用：各桶余额都够时立即预约并返回True，需要等待时不预约、返回False"""
+        tokens = estimate_tokens(payload, self.output_tokens)
+        with self._lock:
+            needs = [(bucket, tokens if by_token else 1) for bucket, by_token in self._buckets]
+            for bucket, _ in needs:
+                bucket.refill()
+            if any(bucket.tokens < amount for bucket, amount in needs):
+                return False
+            for bucket, amount in needs:
+                bucket.tokens -= amount
+            return True
+
+def merge_model_config(section_cfg, model_name):
+    """yaml中按模型配置的段落：default为公共配置，模型名下的配置覆盖default"""
+    section_cfg = section_cfg or {}
+    return {**(section_cfg.get("default") or {}), **(section_cfg.get(model_name) or {})}
+
+# ========== 耗时指标：每次请求的响应头/首token/总耗时/吞吐，结束时按模型汇总分位数 ==========
+METRIC_COLUMNS = ["响应头(s)", "首token(s)", "总耗时(s)", "输出字数", "tokens/s"]
+
+def metric_column_names(model_name):
+    """结果表中紧跟在模型列后面的指标列"""
+    return [f"{model_name}_{col}" for col in METRIC_COLUMNS]
+
+class RequestMetrics:
+    """单次请求的耗时指标（秒）；connect为发出请求到收到响应头，多次重试时记录最后一次尝试"""
+    __slots__ = ("connect", "ttft", "total", "chars", "attempts", "cached", "deduped")
+
+    def __init__(self):
+        self.connect = None
+        self.ttft = None
+        self.total = None
+        self.chars = 0
+        self.attempts = 0
+        self.cached = False
+        self.deduped = False  # 与前面某行query相同，直接复用其结果，未发请求
+
+    def finish(self, start, first_chunk_time, content):
+        now = time.perf_counter()
+        self.total = now - start
+        self.ttft = first_chunk_time - start if first_chunk_time is not None else None
+        self.chars = len(content)
+
+    @property
+    def tokens_per_second(self):
+        """按估算的输出token数除以生成阶段耗时(总耗时-首token)"""
+        if self.ttft is None or self.total is None or self.total <= self.ttft:
+            return None
+        return self.chars / CHARS_PER_TOKEN / (self.total - self.ttft)
+
+    def row_values(self):
+        def fmt(value, digits):
+            return None if value is None else round(value, digits)
+        return [fmt(self.connect, 3), fmt(self.ttft, 3), fmt(self.total, 3), self.chars, fmt(self.tokens_per_second, 1)]
+
+def percentile(sorted_values, pct):
+    """最近秩法分位数，sorted_values需已升序"""
+    if not sorted_values:
+        return None
+    # 第ceil(pct×N/100)个值；先乘后除，避免pct/100的浮点误差让整数秩多进一位
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct * len(sorted_values) / 100) - 1))
+    return sorted_values[rank]
+
+class LatencyStats:
+    """按模型累计请求指标，耗时用array存储以控制大批量时的内存"""
+    def __init__(self):
+        self._lock = Lock()
+        self._models = {}
+
+    def add(self, model_name, res, metrics):
+        with self._lock:
+            stats = self._models.setdefault(model_name, {
+                "ok": 0, "errors": 0, "cached": 0, "deduped": 0,
+                "ttft": array("d"), "total": array("d"), "tps": array("d")
+            })
+            if metrics.deduped:
+                stats["deduped"] += 1
+            elif isinstance(res, RequestError):
+                stats["errors"] += 1
+            elif metrics.cached:
+                stats["cached"] += 1
+            elif metrics.total is not None:
+                stats["ok"] += 1
+                stats["total"].append(metrics.total)
+                if metrics.ttft is not None:
+                    stats["ttft"].append(metrics.ttft)
+                if metrics.tokens_per_second is not None:
+                    stats["tps"].append(metrics.tokens_per_second)
+
+    def snapshot(self):
+        """所有模型合计的计数及升序耗时，供基准测试等汇总使用"""
+        merged = {"ok": 0, "errors": 0, "cached": 0, "deduped": 0, "ttft": [], "total": []}
+        with self._lock:
+            for stats in self._models.values():
+                for key in ("ok", "errors", "cached", "deduped"):
+                    merged[key] += stats[key]
+                merged["ttft"].extend(stats["ttft"])
+                merged["total"].extend(stats["total"])
+        merged["ttft"].sort()
+        merged["total"].sort()
+        return merged
+
+    def summary_lines(self):
+        """每个模型一行：请求数、错误率、首token与总耗时的p50/p90/p99、平均吞吐"""
+        def fmt_pcts(values):
+            values = sorted(values)
+            return "/".join("-" if percentile(values, p) is None else f"{percentile(values, p):.2f}" for p in (50, 90, 99))
+        lines = []
+        with self._lock:
+            for model_name, stats in self._models.items():
+                requested = stats["ok"] + stats["errors"]
+                error_rate = stats["errors"] / requested * 100 if requested else 0.0
+                avg_tps = sum(stats["tps"]) / len(stats["tps"]) if stats["tps"] else 0.0
+                lines.append(
+                    f"{model_name}：成功 {stats['ok']}，失败 {stats['errors']}（错误率 {error_rate:.1f}%），缓存 {stats['cached']}，去重 {stats['deduped']}；"
+                    f"首token p50/p90/p99 = {fmt_pcts(stats['ttft'])}s；总耗时 p50/p90/p99 = {fmt_pcts(stats['total'])}s；"
+                    f"平均 {avg_tps:.1f} tokens/s"
+                )
+        return lines
+
+# ========== 多节点负载均衡：同一模型配置多个网关/Key，按进行中请求数或近期耗时选择，出错摘除 ==========
+BALANCE_STRATEGIES = ("least_inflight", "latency")
+
+def as_list(value):
+    """yaml中既可写单个值也可写列表"""
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+def is_endpoint_fault(error):
+    """超时/连接/429/5xx以及401/403（Key失效）归咎于节点，其余4xx是请求本身的问题，换节点也没用"""
+    return error.transient or error.status in (401, 403)
+
+class Endpoint:
+    """一个(base_url, api_key)节点及其运行时状态，由EndpointBalancer加锁修改"""
+    __slots__ = ("base_url", "api_key", "headers", "inflight", "latency", "requests", "failures",
+                 "consecutive_failures", "ejections", "ejected_until")
+
+    def __init__(self, base_url, api_key, headers):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.headers = headers
+        self.inflight = 0
+        self.latency = None  # 成功请求总耗时的指数滑动平均（秒）
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    @property
+    def label(self):
+        """日志中只显示网关地址和Key末4位"""
+        return f"{urlsplit(self.base_url).netloc}#{str(self.api_key)[-4:]}"
+
+class EndpointBalancer:
+    """单模型的节点选择器：跳过摘除中的节点按策略选择；连续失败eject_after次或收到Retry-After时摘除该节点"""
+    def __init__(self, endpoints, strategy="least_inflight", eject_after=3, eject_seconds=30, latency_alpha=0.3, clock=time.monotonic):
+        if strategy not in BALANCE_STRATEGIES:
+            raise ValueError(f"未知的负载均衡策略：{strategy}，可选：{'/'.join(BALANCE_STRATEGIES)}")
+        self.endpoints = list(endpoints)
+        self.strategy = strategy
+        self.eject_after = max(1, int(eject_after))
+        self.eject_seconds = eject_seconds
+        self.latency_alpha = latency_alpha
+        self.log_func = None  # 摘除节点时的日志回调，由BatchRunner设置
+        self._clock = clock
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, endpoints, cfg):
+        """yaml balancer段：strategy/eject_after/eject_seconds/latency_alpha"""
+        keys = ("strategy", "eject_after", "eject_seconds", "latency_alpha")
+        return cls(endpoints, **{k: cfg[k] for k in keys if k in cfg})
+
+    def _score(self, endpoint):
+        if self.strategy == "latency":
+            # 还没有耗时数据的节点得分最低，先试探；乘以(进行中+1)避免所有请求挤到同一个最快节点
+            return ((endpoint.latency or 0.0) * (endpoint.inflight + 1), endpoint.inflight)
+        return (endpoint.inflight, endpoint.latency or 0.0)
+
+    def _healthy(self, now):
+        return [ep for ep in self.endpoints if ep.ejected_until <= now]
+
+    def acquire(self, avoid=None):
+        """选出一个节点并计入进行中；avoid为上一次失败的节点，有其他可用节点时不再选它"""
+        with self._lock:
+            candidates = self._healthy(self._clock())
+            if avoid is not None and len(candidates) > 1:
+                candidates = [ep for ep in candidates if ep is not avoid]
+            if not candidates:
+                # 全部被摘除时选最早恢复的节点，请求不会卡住
+                candidates = [min(self.endpoints, key=lambda ep: ep.ejected_until)]
+            endpoint = min(candidates, key=self._score)
+            endpoint.inflight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def has_alternative(self, endpoint):
+        """除endpoint外是否还有可用节点，有则失败后立即换节点重试而不退避等待"""
+        with self._lock:
+            return any(ep is not endpoint for ep in self._healthy(self._clock()))
+
+    def release(self, endpoint, elapsed=None, error=None):
+        """请求结束时回报：成功时更新耗时均值；节点类错误累计，达到阈值或服务端要求等待时摘除"""
+        ejected_for = 0
+        with self._lock:
+            endpoint.inflight -= 1
+            if error is None:
+                endpoint.consecutive_failures = 0
+                if elapsed is not None:
+                    endpoint.latency = elapsed if endpoint.latency is None else endpoint.latency + self.latency_alpha * (elapsed - endpoint.latency)
+                return
+            if not is_endpoint_fault(error):
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if len(self.endpoints) > 1:
+                if endpoint.consecutive_failures >= self.eject_after:
+                    ejected_for = self.eject_seconds
+                if error.retry_after:
+                    ejected_for = max(ejected_for, error.retry_after)
+            if ejected_for:
+                endpoint.ejected_until = self._clock() + ejected_for
+                endpoint.ejections += 1
+                endpoint.consecutive_failures = 0
+        if ejected_for and self.log_func is not None:
+            self.log_func(f"【节点】{endpoint.label} {error.label}，摘除 {ejected_for:.0f}s，请求转到其他节点")
+
+    def stats(self):
+        """各节点计数，多进程模式下子进程结束时发回主进程合并"""
+        with self._lock:
+            return [(ep.requests, ep.failures, ep.ejections, ep.latency) for ep in self.endpoints]
+
+    def merge_stats(self, stats):
+        """合并子进程的节点计数，平均耗时按请求数加权"""
+        with self._lock:
+            for ep, (count, failures, ejections, latency) in zip(self.endpoints, stats):
+                if latency is not None and count:
+                    if ep.latency is None:
+                        ep.latency = latency
+                    else:
+                        ep.latency = (ep.latency * ep.requests + latency * count) / (ep.requests + count)
+                ep.requests += count
+                ep.failures += failures
+                ep.ejections += ejections
+
+    def summary_lines(self):
+        with self._lock:
+            return [
+                f"{ep.label}：请求 {ep.requests}，失败 {ep.failures}，摘除 {ep.ejections} 次，"
+                f"平均耗时 {'-' if ep.latency is None else f'{ep.latency:.2f}'}s"
+                for ep in self.endpoints
+            ]
+
+# ========== 自适应并发：按模型AIMD，健康时加性增加上限，429/5xx或首token变慢时乘性减少 ==========
+CONCURRENCY_MODES = ["固定并发", "自适应并发"]
+
+def is_overload_error(error):
+    """服务端过载的信号：限流429、5xx和超时；400等请求本身的错误与并发无关"""
+    return error.kind == "timeout" or error.status == 429 or (error.status or 0) >= 500
+
+class AIMDController:
+    """单模型的自适应并发上限：首次过载前每个成功请求上限+1（慢启动，每轮翻倍），之后每成功约limit个请求+increase；
+    过载错误或首token超过基线latency_tolerance倍时乘以decrease，cooldown_seconds内只减一次，避免同一波拥塞中在途请求的错误把上限连续砍到底"""
+    def __init__(self, model_name, max_limit, initial=2, min_limit=1, increase=1.0, decrease=0.75, latency_tolerance=2.0,
+                 cooldown_seconds=2.0, ttft_alpha=0.2, warmup_samples=5, log_interval=5.0, clock=time.monotonic):
+        self.model_name = model_name
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown_seconds = cooldown_seconds
+        self.ttft_alpha = ttft_alpha
+        self.warmup_samples = warmup_samples  # 前几个首token样本只用于建立基线，不触发减少
+        self.log_interval = log_interval      # 上调的日志最短间隔，下调每次都记录
+        self.log_func = None  # 上限变化时的日志回调，由BatchRunner设置
+        self._clock = clock
+        self._lock = Lock()
+        self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self._ttft = None           # 首token耗时的指数滑动平均（秒）
+        self._ttft_baseline = None  # 滑动平均出现过的最小值，视为无排队时的首token耗时
+        self._samples = 0
+        self._decreased_at = None
+        self._slow_start = True
+        self._logged_at = clock()
+        self._logged_limit = self.limit
+        self.peak = self.limit
+        self.decreases = 0
+
+    @classmethod
+    def from_config(cls, model_name, max_limit, cfg):
+        """yaml adaptive段：initial/min/max/increase/decrease/latency_tolerance/cooldown_seconds，max不超过全局并发数"""
+        keys = ("initial", "increase", "decrease", "latency_tolerance", "cooldown_seconds")
+        kwargs = {k: cfg[k] for k in keys if k in cfg}
+        if "min" in cfg:
+            kwargs["min_limit"] = cfg["min"]
+        return cls(model_name, min(max_limit, cfg.get("max", max_limit)), **kwargs)
+
+    @property
+    def limit(self):
+        """调度器使用的当前并发上限"""
+        return max(self.min_limit, int(self._limit))
+
+    def observe(self, error=None, ttft=None):
+        """每次尝试结束时回报：error为None表示成功，ttft为该次首token耗时"""
+        now = self._clock()
+        with self._lock:
+            before = self.limit
+            reason = None
+            if error is not None:
+                if not is_overload_error(error):
+                    return
+                reason = error.label
+            elif ttft is not None:
+                self._ttft = ttft if self._ttft is None else self._ttft + self.ttft_alpha * (ttft - self._ttft)
+                self._samples += 1
+                if self._samples >= self.warmup_samples:
+                    self._ttft_baseline = self._ttft if self._ttft_baseline is None else min(self._ttft_baseline, self._ttft)
+                    if self._ttft > self._ttft_baseline * self.latency_tolerance:
+                        reason = f"首token {self._ttft:.2f}s，基线 {self._ttft_baseline:.2f}s"
+            if reason is None:
+                step = 1.0 if self._slow_start else self.increase / max(1, self.limit)
+                self._limit = min(self.max_limit, self._limit + step)
+                self.peak = max(self.peak, self.limit)
+                if self.limit == before or now - self._logged_at < self.log_interval:
+                    return
+                msg = f"【自适应并发】{self.model_name}：上限 {self._logged_limit} → {self.limit}"
+            else:
+                if self._decreased_at is not None and now - self._decreased_at < self.cooldown_seconds:
+                    return
+                self._decreased_at = now
+                self._slow_start = False
+                self._limit = max(self.min_limit, self._limit * self.decrease)
+                self.decreases += 1
+                msg = f"【自适应并发】{self.model_name}：上限 {before} → {self.limit}（{reason}）"
+            self._logged_at = now
+            self._logged_limit = self.limit
+        if self.log_func is not None:
+            self.log_func(msg)
+
+    def summary_line(self):
+        with self._lock:
+            return f"{self.model_name}：当前上限 {self.limit}，峰值 {self.peak}，下调 {self.decreases} 次（上限范围 {self.min_limit}~{self.max_limit}）"
+
+# ========== 对冲请求：首token迟迟不来时向另一节点补发一份，先出首token的一路保留，另一路关闭 ==========
+HEDGE_MODES = ["不对冲", "对冲慢请求"]
+
+def censored_percentile(samples, pct):
+    """Kaplan-Meier估计含右删失样本的分位数：samples为[(耗时, 是否观测到完成)]，数据不足以估计时返回None"""
+    samples = sorted(samples)
+    at_risk = len(samples)
+    survival = 1.0
+    target = 1 - pct / 100
+    i = 0
+    while i < len(samples):
+        t = samples[i][0]
+        events = removed = 0
+        while i < len(samples) and samples[i][0] == t:
+            events += samples[i][1]
+            removed += 1
+            i += 1
+        if events:
+            survival *= 1 - events / at_risk
+            if survival <= target + 1e-12:
+                return t
+        at_risk -= removed
+    return None
+
+class HedgeRace:
+    """同一次尝试的主请求(primary)与对冲请求(hedge)：先收到首token的一路胜出，另一路被中断"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.winner = None       # "primary" / "hedge"
+        self.claimed_at = None   # 胜出一路收到首token时距主请求发出的秒数
+        self.hedge_offset = 0.0  # 对冲请求比主请求晚发出的秒数
+        self.hedge_result = None  # (内容或RequestError, RequestMetrics)
+        self.hedge_done = threading.Event()
+        self._lock = Lock()
+        self._cancel = {}  # 路 -> 中断该路的回调
+        self._hedge_started = False
+        self._finished = False
+
+    def register(self, route, cancel):
+        """登记中断该路的回调；另一路已胜出时返回False，调用方直接放弃该路"""
+        with self._lock:
+            if self.winner is not None and self.winner != route:
+                return False
+            self._cancel[route] = cancel
+            return True
+
+    def claim(self, route):
+        """该路收到首token：尚无胜者时胜出并中断另一路，返回该路是否应继续读取"""
+        with self._lock:
+            if self.winner is not None:
+                return self.winner == route
+            self.winner = route
+            self.claimed_at = time.perf_counter() - self.started
+            loser = self._cancel.get("hedge" if route == "primary" else "primary")
+        if loser is not None:
+            loser()
+        return True
+
+    def waiting(self):
+        """主请求仍未出首token且未结束、对冲尚未发出"""
+        with self._lock:
+            return self.winner is None and not self._finished and not self._hedge_started
+
+    def start_hedge(self):
+        """计时到期时调用：主请求仍未出首token且未结束才发出对冲"""
+        with self._lock:
+            if self.winner is not None or self._finished or self._hedge_started:
+                return False
+            self._hedge_started = True
+            self.hedge_offset = time.perf_counter() - self.started
+            return True
+
+    def finish(self):
+        """主请求一方结束，之后不再发出对冲；返回对冲是否已经发出"""
+        with self._lock:
+            self._finished = True
+            return self._hedge_started
+
+class Hedger:
+    """单模型的对冲控制：补发阈值取最近window个成功请求首token耗时的percentile分位数，对冲次数不超过主请求的budget比例；
+    被对冲胜出的主请求只知道首token晚于被关闭的时刻，按删失样本记录，结束时用Kaplan-Meier估计不对冲时的首token p99"""
+    def __init__(self, model_name, percentile=95, budget=0.05, min_samples=20, window=500, min_delay=0.2):
+        self.model_name = model_name
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples  # 首token样本不足时不对冲
+        self.min_delay = min_delay      # 阈值下限，首token普遍很快时避免对冲过于频繁
+        self._lock = Lock()
+        self._ttfts = deque(maxlen=window)
+        self._delay = None
+        self._stale = 0  # 上次计算阈值后新增的样本数，攒够一批再重新排序
+        self.primaries = 0
+        self.hedges = 0
+        self.wins = 0
+        self.throttled = 0  # 因限流额度不足跳过的对冲次数
+        self._primary_ttfts = array("d")  # 主请求首token耗时，对冲胜出的为被关闭时已等待的时间
+        self._primary_done = bytearray()  # 对应样本是否观测到首token（0为删失）
+        self._actual_ttfts = array("d")   # 该行实际拿到首token的耗时（从主请求发出算起）
+        self._cond = threading.Condition(self._lock)
+        self._timers = []  # [(到期时间, 序号, 回调)]
+        self._timer_seq = itertools.count()
+        self._timer_thread = None
+
+    @classmethod
+    def from_config(cls, model_name, cfg):
+        """yaml hedging段：percentile/budget/min_samples/window/min_delay"""
+        keys = ("percentile", "budget", "min_samples", "window", "min_delay")
+        return cls(model_name, **{k: cfg[k] for k in keys if k in cfg})
+
+    def begin(self):
+        """一次主请求开始：计数并返回补发阈值（秒），样本不足时返回None"""
+        with self._lock:
+            self.primaries += 1
+            if len(self._ttfts) < self.min_samples:
+                return None
+            if self._delay is None or self._stale >= 20:
+                self._delay = max(self.min_delay, percentile(sorted(self._ttfts), self.percentile))
+                self._stale = 0
+            return self._delay
+
+    def try_start(self, race, rate_limiter=None, payload=None):
+        """预算允许且主请求仍在等首token时占用一次对冲额度；对冲同样计入RPM/TPM限流，额度不足需要等待时不对冲"""
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.primaries or not race.waiting():
+                return False
+            if rate_limiter is not None and not rate_limiter.try_reserve(payload):
+                self.throttled += 1
+                return False
+            if not race.start_hedge():
+                return False
+            self.hedges += 1
+            return True
+
+    def record(self, race, metrics):
+        """一次成功的尝试：记录阈值样本、主请求首token（对冲胜出时为删失）和实际首token耗时"""
+        with self._lock:
+            if race is not None and race.winner == "hedge":
+                self.wins += 1
+                self._primary_ttfts.append(race.claimed_at)
+                self._primary_done.append(0)
+            elif metrics.ttft is not None:
+                self._ttfts.append(metrics.ttft)
+                self._stale += 1
+                self._primary_ttfts.append(metrics.ttft)
+                self._primary_done.append(1)
+            if metrics.ttft is not None:
+                self._actual_ttfts.append(metrics.ttft)
+
+    def schedule(self, delay, callback):
+        """delay秒后在计时线程中调用callback；所有请求共用一个计时线程，空闲一段时间后自动退出"""
+        with self._cond:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_seq), callback))
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._run_timers, daemon=True)
+                self._timer_thread.start()
+            self._cond.notify()
+
+    def _run_timers(self):
+        while True:
+            with self._cond:
+                if not self._timers and not self._cond.wait(timeout=5):
+                    self._timer_thread = None
+                    return
+                if not self._timers:
+                    continue
+                due, _, callback = self._timers[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(timeout=wait)
+                    continue
+                heapq.heappop(self._timers)
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def summary_line(self):
+        with self._lock:
+            rate = self.hedges / self.primaries * 100 if self.primaries else 0.0
+            actual = censored_percentile([(t, 1) for t in self._actual_ttfts], 99)
+            primary_samples = list(zip(self._primary_ttfts, self._primary_done))
+        line = (f"{self.model_name}：对冲 {self.hedges} 次（主请求的 {rate:.1f}%，预算 {self.budget * 100:.0f}%），"
+                f"对冲胜出 {self.wins} 次")
+        if self.throttled:
+            line += f"，因限流跳过 {self.throttled} 次"
+        if actual is None:
+            return line
+        baseline = censored_percentile(primary_samples, 99)
+        if baseline is None:
+            # 没有观测到比被关闭时刻更慢的主请求，不对冲时的p99只能给出下限
+            return f"{line}；首token p99 {actual:.2f}s，不对冲估计 > {max(t for t, _ in primary_samples):.2f}s"
+        return f"{line}；首token p99 {actual:.2f}s，不对冲估计 {baseline:.2f}s（改善 {baseline - actual:.2f}s）"
+
+# ========== 第一步：分模型封装请求类【原封不动+小优化，兼容所有模型】 ==========
+class BaseModelRequest:
+    """所有模型请求的基类"""
+    sse_decoder = None  # 子类指定的SSE事件解码器：json_data -> 文本块
+    def __init__(self, model_name, api_key, base_url, system_prompt, env="", cache=None, retry_policy=None, rate_limiter=None,
+                 endpoints=None, balancer_cfg=None, prompt_cache=False):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.base_url = base_url
+        self.system_prompt = system_prompt.strip()
+        self.prompt_cache = prompt_cache  # 是否给system prompt加提供方的前缀缓存标记
+        # 与query无关的部分只构建一次，build_payload只拼入query，system prompt等嵌套结构在各请求间共享
+        self.payload_template = self.build_template()
+        self.env = env      # 所属环境，参与缓存key
+        self.cache = cache  # ResponseCache，为None时不走缓存
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter  # RateLimiter，为None时不限流
+        self.headers = self.make_headers(api_key)
+        # 多节点：endpoints为[(base_url, api_key)]，未配置时只有构造参数中的一个节点
+        endpoints = endpoints or [(base_url, api_key)]
+        self.balancer = EndpointBalancer.from_config(
+            [Endpoint(url, key, self.make_headers(key)) for url, key in endpoints], balancer_cfg or {}
+        )
+        self.concurrency_controller = None  # AIMDController，自适应并发模式下由BatchRunner设置
+        self.hedger = None  # Hedger，对冲模式下由BatchRunner设置
+
+    def make_headers(self, api_key):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+
+    def build_template(self):
+        """payload中与query无关的公共部分，子类按各自格式实现"""
+        return {}
+
+    def build_payload(self, query):
+        raise NotImplementedError("子类必须实现该方法")
+
+    @property
+    def saved_prompt_tokens(self):
+        """相比旧版payload每次请求少发送的输入token估算，用于运行结束时的统计"""
+        return 0
+
+    def finish_attempt(self, endpoint, metrics, error, lost=False):
+        """一次尝试结束：回报给负载均衡器和自适应并发控制；停止时被中断的尝试、对冲落败被关闭的一路不计成败"""
+        if lost:
+            self.balancer.release(endpoint)
+            return
+        self.balancer.release(endpoint, metrics.total if error is None else None, error)
+        if self.concurrency_controller is not None and not IS_STOP:
+            self.concurrency_controller.observe(error, metrics.ttft if error is None else None)
+
+    def cache_lookup(self, payload):
+        """返回(缓存key, 缓存内容)；未启用缓存时key为None"""
+        if self.cache is None:
+            return None, None
+        cache_key = ResponseCache.make_key(self.model_name, payload, self.env)
+        return cache_key, self.cache.get(cache_key)
+
+    def cache_store(self, cache_key, content):
+        """只缓存成功且非空的响应"""
+        if cache_key is not None and content:
+            self.cache.put(cache_key, self.model_name, content)
+
+    def request_model(self, query):
+        """流式POST请求，返回完整拼接结果，核心：requests.request POST stream=True；失败按retry_policy重试，最终失败返回RequestError"""
+        return self.request_with_metrics(query)[0]
+
+    def request_with_metrics(self, query):
+        """同request_model，额外返回最后一次尝试的RequestMetrics"""
+        metrics = RequestMetrics()
+        if IS_STOP:
+            return "任务已终止", metrics
+        try:
+            payload = self.build_payload(query)
+            cache_key, cached = self.cache_lookup(payload)
+        except Exception as e:
+            return to_request_error(e), metrics
+        if cached is not None:
+            metrics.cached = True
+            metrics.chars = len(cached)
+            return cached, metrics
+        attempt = 0
+        endpoint = None
+        while True:
+            attempt += 1
+            metrics.attempts = attempt
+            wait_while_paused()
+            if self.rate_limiter is not None:
+                sleep_unless_stopped(self.rate_limiter.reserve(payload))
+            if IS_STOP:
+                return "任务已终止", metrics
+            endpoint = self.balancer.acquire(avoid=endpoint)
+            error = None
+            try:
+                if self.hedger is not None:
+                    content = self.hedged_stream_once(payload, metrics, endpoint)
+                else:
+                    content = self.stream_once(payload, metrics, endpoint)
+                if IS_STOP:
+                    return "任务已终止", metrics  # 停止时读到的可能是被截断的内容，不缓存
+                self.cache_store(cache_key, content)
+                return (content if content else "模型返回空内容"), metrics
+            except Exception as e:
+                # 停止时被主动中断的流不计入失败
+                if IS_STOP:
+                    return "任务已终止", metrics
+                error = to_request_error(e, attempt)
+            finally:
+                self.finish_attempt(endpoint, metrics, error)
+            if not self.retry_policy.should_retry(error):
+                return error, metrics
+            # 还有其他可用节点时立即换节点重试，只有单节点或全部摘除时才退避等待
+            if not self.balancer.has_alternative(endpoint):
+                sleep_unless_stopped(self.retry_policy.next_delay(attempt, error.retry_after))
+
+    def stream_once(self, payload, metrics, endpoint, race=None, route=None):
+        """向endpoint发起一次流式请求并解析，记录响应头/首token/总耗时，HTTP错误抛出RequestError；
+        race非空时为对冲中的一路，收到首token时争夺胜出，落败则放弃"""
+        start = time.perf_counter()
+        # 严格按照你的要求：requests.request("POST", url, headers=headers, data=payload, stream=True, timeout=60)
+        # 走共享会话，同一网关的请求复用keep-alive连接，省去每条query的握手
+        response = get_shared_session(endpoint.base_url).request(
+            method="POST",
+            url=endpoint.base_url,
+            headers=endpoint.headers,
+            json=payload,  # 接口都是json格式，比data更适配，原data会导致请求失败
+            stream=True,
+            timeout=TIMEOUT
+        )
+        metrics.connect = time.perf_counter() - start
+        # 登记为进行中的流，停止时由request_stop中断；登记前已停止的（如等待响应头期间）立即关闭
+        with INFLIGHT_LOCK:
+            INFLIGHT_RESPONSES.add(response)
+        try:
+            if IS_STOP:
+                raise RequestError("cancelled", "任务已终止")
+            if race is not None and not race.register(route, lambda: abort_response(response)):
+                raise RequestError("cancelled", "另一路请求已先返回")
+            if response.status_code >= 400:
+                raise http_request_error(response.status_code, response.headers.get("Retry-After"), response.text)
+            parser = SSEStreamParser(self.sse_decoder)
+            lines = response.iter_lines()
+            if race is not None:
+                for line in lines:
+                    parser.feed(line)
+                    if parser.first_chunk_time is not None:
+                        if not race.claim(route):
+                            raise RequestError("cancelled", "另一路请求已先返回")
+                        break
+            for line in lines:
+                parser.feed(line)
+            # 停止时socket被shutdown，流可能以正常EOF结束而不报错，读到的只是部分内容
+            if IS_STOP:
+                raise RequestError("cancelled", "任务已终止")
+            if race is not None and race.winner not in (None, route):
+                raise RequestError("cancelled", "另一路请求已先返回")  # 对冲落败被中断，同样可能以EOF结束
+            content = parser.result()
+        finally:
+            with INFLIGHT_LOCK:
+                INFLIGHT_RESPONSES.discard(response)
+            response.close()
+        metrics.finish(start, parser.first_chunk_time, content)
+        return content
+
+    def hedged_stream_once(self, payload, metrics, endpoint):
+        """对冲模式下的一次尝试：主请求在本线程读取，超过阈值仍无首token时由计时线程向另一节点补发，返回先出首token一路的结果"""
+        delay = self.hedger.begin()
+        if delay is None:
+            content = self.stream_once(payload, metrics, endpoint)
+            self.hedger.record(None, metrics)
+            return content
+        race = HedgeRace()
+        self.hedger.schedule(delay, lambda: self.launch_hedge(race, payload, endpoint))
+        try:
+            content = self.stream_once(payload, metrics, endpoint, race, "primary")
+        except Exception as e:
+            primary_error = e
+        else:
+            # 主请求没有输出任何内容就结束时，仍在进行的对冲也要关闭；对冲已先出首token时主请求是被中断的，内容不完整
+            if race.claim("primary"):
+                race.finish()
+                self.hedger.record(race, metrics)
+                return content
+            primary_error = RequestError("cancelled", "另一路请求已先返回")
+        # 主请求失败或被对冲中断：对冲已发出且主请求没有先出首token时改用对冲的结果
+        if not race.finish() or race.winner == "primary":
+            raise primary_error
+        while not race.hedge_done.wait(STOP_POLL_SECONDS):
+            if IS_STOP:
+                raise RequestError("cancelled", "任务已终止")
+        return self.take_hedge_result(race, metrics, primary_error)
+
+    def launch_hedge(self, race, payload, primary_endpoint):
+        """计时线程回调：预算允许时起一个线程发出对冲请求"""
+        if IS_STOP or not self.hedger.try_start(race, self.rate_limiter, payload):
+            return
+        threading.Thread(target=self.run_hedge, args=(race, payload, primary_endpoint), daemon=True).start()
+
+    def run_hedge(self, race, payload, primary_endpoint):
+        metrics = RequestMetrics()
+        endpoint = self.balancer.acquire(avoid=primary_endpoint)
+        error = None
+        try:
+            race.hedge_result = (self.stream_once(payload, metrics, endpoint, race, "hedge"), metrics)
+        except Exception as e:
+            error = to_request_error(e)
+            race.hedge_result = (error, metrics)
+        finally:
+            self.finish_attempt(endpoint, metrics, error, lost=(race.winner == "primary"))
+            race.hedge_done.set()
+
+    def take_hedge_result(self, race, metrics, primary_error):
+        """对冲结果转为本次尝试的结果，耗时从主请求发出时算起；对冲也失败时按主请求的错误处理"""
+        res, hedge_metrics = race.hedge_result
+        if isinstance(res, RequestError):
+            raise res if race.winner == "hedge" else primary_error
+        offset = race.hedge_offset
+        metrics.connect = hedge_metrics.connect + offset if hedge_metrics.connect is not None else None
+        metrics.ttft = hedge_metrics.ttft + offset if hedge_metrics.ttft is not None else None
+        metrics.total = hedge_metrics.total + offset
+        metrics.chars = hedge_metrics.chars
+        self.hedger.record(race, metrics)
+        return res
+
+    async def async_request_model(self, query, session):
+        """asyncio版流式请求：在事件循环中读取SSE流，解析与重试逻辑与request_model一致"""
+        return (await self.async_request_with_metrics(query, session))[0]
+
+    async def async_request_with_metrics(self, query, session):
+        metrics = RequestMetrics()
+        if IS_STOP:
+            return "任务已终止", metrics
+        try:
+            payload = self.build_payload(query)
+            cache_key, cached = self.cache_lookup(payload)
+        except Exception as e:
+            return to_request_error(e), metrics
+        if cached is not None:
+            metrics.cached = True
+            metrics.chars = len(cached)
+            return cached, metrics
+        attempt = 0
+        endpoint = None
+        while True:
+            attempt += 1
+            metrics.attempts = attempt
+            await async_wait_while_paused()
+            if self.rate_limiter is not None:
+                await async_sleep_unless_stopped(self.rate_limiter.reserve(payload))
+            if IS_STOP:
+                return "任务已终止", metrics
+            endpoint = self.balancer.acquire(avoid=endpoint)
+            error = None
+            try:
+                if self.hedger is not None:
+                    content = await self.async_hedged_stream_once(payload, session, metrics, endpoint)
+                else:
+                    content = await self.async_stream_once(payload, session, metrics, endpoint)
+                if IS_STOP:
+                    return "任务已终止", metrics  # 停止时读到的可能是被截断的内容，不缓存
+                self.cache_store(cache_key, content)
+                return (content if content else "模型返回空内容"), metrics
+            except Exception as e:
+                if IS_STOP:
+                    return "任务已终止", metrics
+                error = to_request_error(e, attempt)
+            finally:
+                self.finish_attempt(endpoint, metrics, error)
+            if not self.retry_policy.should_retry(error):
+                return error, metrics
+            if not self.balancer.has_alternative(endpoint):
+                await async_sleep_unless_stopped(self.retry_policy.next_delay(attempt, error.retry_after))
+
+    async def async_stream_once(self, payload, session, metrics, endpoint, race=None, route=None):
+        """race非空时为对冲中的一路，中断回调由调用方按task登记"""
+        import aiohttp
+        parser = SSEStreamParser(self.sse_decoder)
+        start = time.perf_counter()
+        try:
+            async with session.post(endpoint.base_url, headers=endpoint.headers, json=payload) as response:
+                metrics.connect = time.perf_counter() - start
+                if response.status >= 400:
+                    raise http_request_error(response.status, response.headers.get("Retry-After"), await response.text())
+                # 按块读取后自行切行，避免超长data行触发StreamReader的行长度限制
+                buffer = b""
+                async for chunk in response.content.iter_any():
+                    buffer += chunk
+                    *complete, buffer = buffer.split(b"\n")
+                    for line in complete:
+                        parser.feed(line.rstrip(b"\r"))
+                    if race is not None and parser.first_chunk_time is not None:
+                        if not race.claim(route):
+                            raise RequestError("cancelled", "另一路请求已先返回")
+                        race = None
+                if buffer:
+                    parser.feed(buffer.rstrip(b"\r"))
+                if IS_STOP:
+                    raise RequestError("cancelled", "任务已终止")
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+            raise RequestError("connection", str(e) or type(e).__name__)
+        content = parser.result()
+        metrics.finish(start, parser.first_chunk_time, content)
+        return content
+
+    async def async_hedged_stream_once(self, payload, session, metrics, endpoint):
+        """asyncio版对冲：主请求作为子任务运行，等到阈值仍未结束时补发，先出首token的一路胜出并取消另一路"""
+        delay = self.hedger.begin()
+        if delay is None:
+            content = await self.async_stream_once(payload, session, metrics, endpoint)
+            self.hedger.record(None, metrics)
+            return content
+        race = HedgeRace()
+        primary = asyncio.ensure_future(self.async_stream_once(payload, session, metrics, endpoint, race, "primary"))
+        race.register("primary", primary.cancel)
+        hedge = None
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if not done and not IS_STOP and self.hedger.try_start(race, self.rate_limiter, payload):
+            hedge = asyncio.ensure_future(self.async_run_hedge(race, payload, session, endpoint))
+            race.register("hedge", hedge.cancel)
+        try:
+            content = await primary
+        except asyncio.CancelledError:
+            # 被对冲胜出取消的主请求继续等对冲结果，其余取消（停止）照常向上传递
+            if race.winner != "hedge":
+                raise
+            primary_error = RequestError("cancelled", "另一路请求已先返回")
+        except Exception as e:
+            primary_error = e
+        else:
+            # 主请求没有输出任何内容就结束时，仍在进行的对冲也要关闭；对冲已先出首token时主请求是被中断的，内容不完整
+            if race.claim("primary"):
+                race.finish()
+                self.hedger.record(race, metrics)
+                return content
+            primary_error = RequestError("cancelled", "另一路请求已先返回")
+        if not race.finish() or race.winner == "primary":
+            raise primary_error
+        await hedge
+        return self.take_hedge_result(race, metrics, primary_error)
+
+    async def async_run_hedge(self, race, payload, session, primary_endpoint):
+        metrics = RequestMetrics()
+        endpoint = self.balancer.acquire(avoid=primary_endpoint)
+        error = None
+        try:
+            race.hedge_result = (await self.async_stream_once(payload, session, metrics, endpoint, race, "hedge"), metrics)
+        except Exception as e:
+            error = to_request_error(e)
+            race.hedge_result = (error, metrics)
+        finally:
+            self.finish_attempt(endpoint, metrics, error, lost=(race.winner == "primary"))
+            race.hedge_done.set()
+
+class ClaudeModel(BaseModelRequest):
+    """Claude系列模型"""
+    sse_decoder = staticmethod(decode_claude_event)
+
+    def build_template(self):
+        template = {
+            "anthropic_version": "vertex-2023-10-16",
+            "max_tokens": 1026,
+            "stream": True
+        }
+        if self.system_prompt:
+            # system prompt只放在system字段；开启前缀缓存时用块格式并标记cache_control，后续请求命中缓存按缓存价计费
+            if self.prompt_cache:
+                template["system"] = [{"type": "text", "text": self.system_prompt, "cache_control": {"type": "ephemeral"}}]
+            else:
+                template["system"] = self.system_prompt
+        return template
+
+    def build_payload(self, query):
+        return {
+            **self.payload_template,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": query
+                        }
+                    ]
+                }
+            ]
+        }
+
+    @property
+    def saved_prompt_tokens(self):
+        # 旧版除system字段外还把system prompt作为一条user消息重复发送
+        return (len(self.system_prompt) + 1) // CHARS_PER_TOKEN if self.system_prompt else 0
+
+class GeminiModel(BaseModelRequest):
+    """Gemini系列模型"""
+    sse_decoder = staticmethod(decode_gemini_event)
+
+    def build_template(self):
+        # system prompt放在systemInstruction而不是额外的user轮次，公共前缀稳定，便于网关侧隐式缓存
+        if not self.system_prompt:
+            return {}
+        return {
+            "systemInstruction": {
+                "parts": [
+                    {
+                        "text": self.system_prompt
+                    }
+                ]
+            }
+        }
+
+    def build_payload(self, query):
+        return {
+            **self.payload_template,
+            "contents": [
+                {
+                    "role": "user", 
+                    "parts": [
+                        {
+                            "text": query
+                        }
+                    ]
+                }
+            ]
+        }
+
+class OtherModel(BaseModelRequest):
+    """GPT/Qwen/Deepseek等其他模型"""
+    sse_decoder = staticmethod(decode_openai_event)
+
+    def build_template(self):
+        # OpenAI兼容接口对相同前缀自动缓存，system消息保持不变即可，无需额外标记
+        return {
+            "model": self.model_name,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": f"{self.system_prompt}\n"
+                }
+            ],
+            "stream": True
+        }
+
+    def build_payload(self, query):
+        return {
+            **self.payload_template,
+            "messages": [
+                *self.payload_template["messages"],
+                {
+                    "role": "user",
+                    "content": query
+                }
+            ]
+        }
+
+# ========== 长任务优先：按(模型, query)估算耗时，最长的先发，各模型按剩余工作量交替出队 ==========
+SCHEDULE_POLICIES = ["按行顺序", "长任务优先"]
+DEFAULT_BASE_SECONDS = 1.0        # 无历史时单次请求的固定耗时估计（建连+首token）
+DEFAULT_OUTPUT_CHARS = 500        # 无历史时的回答长度估计
+DEFAULT_OUTPUT_CHARS_PER_SECOND = 50 * CHARS_PER_TOKEN   # 无历史时的生成速度估计
+DEFAULT_INPUT_CHARS_PER_SECOND = 2000 * CHARS_PER_TOKEN  # 无历史时的输入处理速度估计，决定query长度对耗时的影响
+
+class CostModel:
+    """单模型的耗时估计：耗时≈a+b×query长度。先验由缓存/任务日志中该模型的历史回答长度换算，
+    运行中用实际总耗时做带遗忘的线性回归，样本少时向先验收缩"""
+    def __init__(self, model_name, prior_output_chars=None, prior_weight=10, decay=0.995, min_samples=20):
+        self.model_name = model_name
+        output_chars = prior_output_chars or DEFAULT_OUTPUT_CHARS
+        self.prior_a = DEFAULT_BASE_SECONDS + output_chars / DEFAULT_OUTPUT_CHARS_PER_SECOND
+        self.prior_b = 1 / DEFAULT_INPUT_CHARS_PER_SECOND
+        self.prior_weight = prior_weight
+        self.decay = decay  # 每个新样本使旧样本权重乘以decay，网关变慢/变快时估计随之调整
+        self.min_samples = min_samples  # 样本少于该数时斜率沿用先验，只用截距吸收实际耗时
+        self._lock = Lock()
+        self._n = 0.0
+        self._sx = self._sy = self._sxx = self._sxy = 0.0
+
+    def observe(self, query_len, seconds):
+        with self._lock:
+            self._n = self._n * self.decay + 1
+            self._sx = self._sx * self.decay + query_len
+            self._sy = self._sy * self.decay + seconds
+            self._sxx = self._sxx * self.decay + query_len * query_len
+            self._sxy = self._sxy * self.decay + query_len * seconds
+
+    def params(self):
+        """返回当前的(a, b)；斜率不小于0，保证同一模型内越长的query估计耗时越长"""
+        with self._lock:
+            n = self._n
+            if n <= 0:
+                return self.prior_a, self.prior_b
+            mean_x, mean_y = self._sx / n, self._sy / n
+            var_x = self._sxx / n - mean_x * mean_x
+            b = self.prior_b
+            if n >= self.min_samples and var_x > 1e-9:
+                b = max(0.0, (self._sxy / n - mean_x * mean_y) / var_x)
+            a = max(0.0, mean_y - b * mean_x)
+        weight = n / (n + self.prior_weight)
+        return weight * a + (1 - weight) * self.prior_a, weight * b + (1 - weight) * self.prior_b
+
+    def estimate(self, query_len):
+        a, b = self.params()
+        return a + b * query_len
+
+    def summary_line(self):
+        a, b = self.params()
+        return f"【调度】{self.model_name}：耗时估计 {a:.2f}s + {b * 1000:.3f}s/千字符 × query长度（{int(self._n)} 个有效样本）"
+
+class LongestFirstQueue:
+    """按query长度从长到短出队的待请求队列，接口与调度器使用的deque一致（extend/popleft/len）；
+    每次extend追加的一块行单独排序，前一块全部出队后才开始下一块，任何一行最多落后一块，边跑边写时待写出的行不会无限积压。
+    另外累计排队行数和总长度，供按剩余工作量在模型间分配工作线程"""
+    def __init__(self, rows=()):
+        self._heap = []          # 当前块，按长度排序
+        self._chunks = deque()   # 尚未开始的后续块，保持到达顺序
+        self._count = 0
+        self.total_len = 0
+        self.extend(rows)
+
+    def extend(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        self._chunks.append(rows)
+        self._count += len(rows)
+        self.total_len += sum(len(query) for _, query in rows)
+        if not self._heap:
+            self._next_chunk()
+
+    def _next_chunk(self):
+        rows = self._chunks.popleft()
+        # 长度相同时按行序出队
+        self._heap = [(-len(query), seq, row_idx, query) for seq, (row_idx, query) in enumerate(rows)]
+        heapq.heapify(self._heap)
+
+    def popleft(self):
+        neg_len, _, row_idx, query = heapq.heappop(self._heap)
+        if not self._heap and self._chunks:
+            self._next_chunk()
+        self._count -= 1
+        self.total_len += neg_len
+        return row_idx, query
+
+    def __len__(self):
+        return self._count
+
+def history_output_chars(cache=None, completed=None):
+    """从响应缓存和任务日志估计各模型的平均回答长度：{模型: 字符数}，作为耗时估计的先验"""
+    totals = {}  # 模型 -> [条数, 总字符数]
+    if cache is not None:
+        for model_name, count, avg_chars in cache.output_stats():
+            totals[model_name] = [count, count * avg_chars]
+    for (model_name, _), res in (completed or {}).items():
+        if not is_failed_result(res):
+            stats = totals.setdefault(model_name, [0, 0])
+            stats[0] += 1
+            stats[1] += len(res)
+    return {name: chars / count for name, (count, chars) in totals.items() if count}
+
+# ========== 调度器：按(模型, 行)分发任务，全局+单模型两级并发控制 ==========
+class TaskScheduler:
+    """(模型, 行)级任务调度器：固定大小的工作线程池，各模型轮询出队"""
+    def __init__(self, max_workers):
+        self.max_workers = max(1, int(max_workers))
+        self.connection_limit = self.max_workers  # asyncio引擎的连接数上限，对冲模式下留出余量
+        self._cond = threading.Condition()
+        self._models = {}    # model_name -> 模型实例
+        self._queues = {}    # model_name -> deque[(行号, query)]
+        self._limits = {}    # model_name -> 单模型并发上限
+        self._controllers = {}  # model_name -> AIMDController，自适应模式下取代固定上限
+        self._cost_models = {}  # model_name -> CostModel，长任务优先模式下按估计耗时排队和选模型
+        self._inflight = {}  # model_name -> 进行中的请求数
+        self._order = []     # 轮询顺序，保证多个模型交替出队
+        self._cursor = 0
+        self._input_open = False  # 数据仍在按块读取中，队列为空也不能结束
+        self._result_lock = Lock()
+        self._accepting = True  # run结束后置False，停止时被放弃的工作线程迟到的结果直接丢弃
+
+    def add_model(self, model_ins, rows, max_concurrency=None, controller=None, cost_model=None):
+        """登记一个模型及其待请求的行[(行号, query)]，max_concurrency为空时只受全局上限约束；controller非空时上限随其动态调整；
+        cost_model非空时该模型的行按query长度从长到短出队"""
+        name = model_ins.model_name
+        with self._cond:
+            self._models[name] = model_ins
+            self._queues[name] = deque(rows) if cost_model is None else LongestFirstQueue(rows)
+            self._limits[name] = max(1, int(max_concurrency or self.max_workers))
+            if controller is not None:
+                self._controllers[name] = controller
+            if cost_model is not None:
+                self._cost_models[name] = cost_model
+            self._inflight[name] = 0
+            self._order.append(name)
+
+    def add_rows(self, model_name, rows, max_pending=None):
+        """追加待请求的行；队列积压达到max_pending时阻塞，避免读取速度远超请求速度时占满内存"""
+        with self._cond:
+            while max_pending and len(self._queues[model_name]) >= max_pending and not IS_STOP:
+                self._cond.wait(timeout=0.5)
+            self._queues[model_name].extend(rows)
+            self._cond.notify_all()
+
+    def open_input(self):
+        with self._cond:
+            self._input_open = True
+
+    def close_input(self):
+        """数据读取结束，队列取空后工作线程即可退出"""
+        with self._cond:
+            self._input_open = False
+            self._cond.notify_all()
+
+    def total_tasks(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def has_pending(self):
+        with self._cond:
+            return any(self._queues.values())
+
+    def has_more(self):
+        """还有排队任务或数据尚未读完"""
+        with self._cond:
+            return self._input_open or any(self._queues.values())
+
+    def _limit(self, model_name):
+        controller = self._controllers.get(model_name)
+        return self._limits[model_name] if controller is None else controller.limit
+
+    def _remaining_seconds(self, name):
+        """按估计耗时折算的排队工作量除以该模型的并发上限，即按当前并发清空队列还需的时间"""
+        queue_ = self._queues[name]
+        a, b = self._cost_models[name].params()
+        return (a * len(queue_) + b * queue_.total_len) / self._limit(name)
+
+    def _pick_task(self):
+        """非阻塞地取出一个未达并发上限的模型任务，没有可执行任务时返回None；
+        默认各模型轮询，长任务优先模式下先给剩余工作量最大的模型，使各模型列大致同时完成"""
+        with self._cond:
+            candidates = []
+            for step in range(len(self._order)):
+                name = self._order[(self._cursor + step) % len(self._order)]
+                if self._queues[name] and self._inflight[name] < self._limit(name):
+                    candidates.append((step, name))
+            if not candidates:
+                return None
+            if self._cost_models:
+                step, name = max(candidates, key=lambda item: self._remaining_seconds(item[1]) if item[1] in self._cost_models else 0.0)
+            else:
+                step, name = candidates[0]
+            self._cursor = (self._cursor + step + 1) % len(self._order)
+            self._inflight[name] += 1
+            row_idx, query = self._queues[name].popleft()
+            return self._models[name], row_idx, query
+
+    def _observe_cost(self, model_name, query, res, metrics):
+        """成功且实际发出请求的结果用于更新耗时估计"""
+        cost_model = self._cost_models.get(model_name)
+        if cost_model is not None and not isinstance(res, RequestError) and not metrics.cached and metrics.total is not None:
+            cost_model.observe(len(query), metrics.total)
+
+    def _next_task(self):
+        """取下一个可执行任务；所有模型都达到并发上限时阻塞等待，无任务或已停止时返回None"""
+        with self._cond:
+            while not IS_STOP:
+                if not self.has_more():
+                    return None
+                if not RUN_GATE.is_set():
+                    self._cond.wait(timeout=STOP_POLL_SECONDS)
+                    continue
+                task = self._pick_task()
+                if task is not None:
+                    return task
+                self._cond.wait(timeout=0.5)
+            return None
+
+    def _deliver(self, on_result, model_name, row_idx, res, metrics):
+        """回调结果；调用方已收尾（run返回）后到达的结果丢弃，避免写入已关闭的文件"""
+        with self._result_lock:
+            if self._accepting:
+                on_result(model_name, row_idx, res, metrics)
+
+    def _stop_accepting(self):
+        with self._result_lock:
+            self._accepting = False
+
+    def _task_done(self, model_name):
+        with self._cond:
+            self._inflight[model_name] -= 1
+            self._cond.notify_all()
+
+    def _worker(self, on_result):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            model_ins, row_idx, query = task
+            try:
+                res, metrics = model_ins.request_with_metrics(query)
+                self._observe_cost(model_ins.model_name, query, res, metrics)
+                self._deliver(on_result, model_ins.model_name, row_idx, res, metrics)
+            finally:
+                self._task_done(model_ins.model_name)
+
+    def run(self, on_result):
+        """启动工作线程并阻塞到全部任务完成；收到停止指令后进行中的流已被中断，不再等待仍卡在建连的线程"""
+        worker_count = self.max_workers if self._input_open else min(self.max_workers, self.total_tasks())
+        workers = [threading.Thread(target=self._worker, args=(on_result,), daemon=True) for _ in range(worker_count)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            while t.is_alive() and not IS_STOP:
+                t.join(timeout=STOP_POLL_SECONDS)
+        self._stop_accepting()
+
+    async def _async_worker(self, session, on_result, ready):
+        while True:
+            async with ready:
+                while True:
+                    if IS_STOP:
+                        return
+                    task = self._pick_task() if RUN_GATE.is_set() else None
+                    if task is not None or not self.has_more():
+                        break
+                    try:
+                        # 生产者线程追加数据时无法唤醒协程，缩短超时以便及时取到新行
+                        await asyncio.wait_for(ready.wait(), timeout=0.1)
+                    except asyncio.TimeoutError:
+                        pass
+            if task is None:
+                return
+            model_ins, row_idx, query = task
+            try:
+                res, metrics = await model_ins.async_request_with_metrics(query, session)
+                self._observe_cost(model_ins.model_name, query, res, metrics)
+                self._deliver(on_result, model_ins.model_name, row_idx, res, metrics)
+            finally:
+                self._task_done(model_ins.model_name)
+                async with ready:
+                    ready.notify_all()
+
+    async def run_async(self, on_result):
+        """asyncio引擎：单事件循环内以max_workers个协程并发读取流，停止时取消进行中的请求"""
+        import aiohttp
+        worker_count = self.max_workers if self._input_open else min(self.max_workers, self.total_tasks())
+        connector = aiohttp.TCPConnector(limit=self.connection_limit)
+        timeout = aiohttp.ClientTimeout(sock_connect=TIMEOUT, sock_read=TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            ready = asyncio.Condition()
+            workers = [asyncio.create_task(self._async_worker(session, on_result, ready)) for _ in range(worker_count)]
+            pending = set(workers)
+            while pending and not IS_STOP:
+                _, pending = await asyncio.wait(pending, timeout=STOP_POLL_SECONDS)
+            # 取消协程会关闭其aiohttp连接，进行中的流随之中断
+            for w in pending:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        self._stop_accepting()
+
+# ========== 请求去重：同一模型下相同query只请求一次，结果回填到所有重复行 ==========
+DEDUP_MODES = ["合并重复query", "逐条请求"]
+DEDUP_MAX_RESULTS = 10000  # 保留供后续重复行复用的成功结果条数上限，超出后淘汰最久未用的，之后再出现的重复行重新请求
+
+class QueryDeduper:
+    """按(模型, query)去重：首次出现的行作为leader送入调度器，leader在途时重复行挂在它上面，完成时一并回填"""
+    def __init__(self, max_results=DEDUP_MAX_RESULTS):
+        self.max_results = max_results
+        self._lock = Lock()
+        self._followers = {}  # (模型, query摘要) -> [重复行号]，存在即表示leader排队或请求中
+        self._leaders = {}    # (模型, leader行号) -> query摘要
+        self._done = OrderedDict()  # (模型, query摘要) -> 成功结果，按最近使用排序
+        self._counts = {}     # 模型 -> [参与去重的行数, 重复行数]
+
+    @staticmethod
+    def digest(query):
+        """只保存query的16字节摘要，长query不会常驻内存"""
+        return hashlib.blake2b(query.encode("utf-8"), digest_size=16).digest()
+
+    def admit(self, model_name, row_idx, query):
+        """返回(是否需要请求, 可直接复用的结果)：已有成功结果时直接复用；leader在途时挂为重复行；否则该行成为leader"""
+        key = (model_name, self.digest(query))
+        with self._lock:
+            counts = self._counts.setdefault(model_name, [0, 0])
+            counts[0] += 1
+            if key in self._done:
+                self._done.move_to_end(key)
+                counts[1] += 1
+                return False, self._done[key]
+            followers = self._followers.get(key)
+            if followers is not None:
+                followers.append(row_idx)
+                counts[1] += 1
+                return False, None
+            self._followers[key] = []
+            self._leaders[(model_name, row_idx)] = key[1]
+            return True, None
+
+    def remember(self, model_name, query, res):
+        """任务日志恢复的成功结果同样可供后续重复行复用"""
+        with self._lock:
+            self._store(model_name, self.digest(query), res)
+
+    def _store(self, model_name, digest, res):
+        if is_failed_result(res):
+            return
+        key = (model_name, digest)
+        self._done[key] = res
+        self._done.move_to_end(key)
+        while len(self._done) > self.max_results:
+            self._done.popitem(last=False)
+
+    def resolve(self, model_name, row_idx, res):
+        """leader完成：返回需要回填相同结果的重复行号；失败结果不留存，之后再出现的重复行会重新请求"""
+        with self._lock:
+            digest = self._leaders.pop((model_name, row_idx), None)
+            if digest is None:
+                return []
+            self._store(model_name, digest, res)
+            return self._followers.pop((model_name, digest), [])
+
+    def summary_lines(self):
+        with self._lock:
+            return [
+                f"{model_name}：{total} 行中 {duplicates} 行与前面的query重复（{duplicates / total * 100:.1f}%），省去 {duplicates} 次请求"
+                for model_name, (total, duplicates) in self._counts.items() if total
+            ]
+
+def dedup_metrics(res):
+    """重复行的指标：不记录耗时，只标记为去重"""
+    metrics = RequestMetrics()
+    metrics.deduped = True
+    metrics.chars = len(res) if isinstance(res, str) else 0
+    return metrics
+
+# ========== 多进程分片：query按批分发给多个子进程，各自用线程/协程引擎请求，结果发回主进程按行号回写 ==========
+SHARD_BATCH_SIZE = 50      # 每次分发给子进程的行数，太小时进程间通信开销大，太大时各进程负载不均
+SHARD_FLUSH_SECONDS = 0.05  # 子进程攒批发回结果的间隔
+SHARD_STOP_GRACE = 3.0     # 停止后等待子进程发回剩余结果的最长秒数，超时直接结束子进程
+
+def split_for_shards(model_cfg, processes):
+    """单模型的并发上限和限流额度按进程数均分，各进程合计不超过单进程时的配置"""
+    cfg = dict(model_cfg)
+    if cfg.get("max_concurrency"):
+        cfg["max_concurrency"] = max(1, -(-int(cfg["max_concurrency"]) // processes))
+    rate_limit = dict(cfg.get("rate_limit") or {})
+    for key in ("rpm", "tpm"):
+        if rate_limit.get(key):
+            rate_limit[key] = rate_limit[key] / processes
+    cfg["rate_limit"] = rate_limit
+    return cfg
+
+def shard_worker(options, task_queue, result_queue, stop_event, pause_event):
+    """子进程入口：从task_queue领取(模型, 行)批次交给本进程的调度器，结果攒批发回；停止/暂停跟随主进程；
+    options中cost_priors非None时按长任务优先调度"""
+    shard_id = options["shard_id"]
+    max_workers = options["max_workers"]
+    outbox = []
+    outbox_lock = Lock()
+    finished = threading.Event()
+    summary = {"endpoints": {}, "cache": (0, 0)}
+
+    def log(msg):
+        result_queue.put(("log", f"【分片{shard_id}】{msg}"))
+
+    def on_result(model_name, row_idx, res, metrics):
+        with outbox_lock:
+            outbox.append((model_name, row_idx, res, metrics))
+
+    def flush():
+        with outbox_lock:
+            batch = outbox[:]
+            outbox.clear()
+        if batch:
+            result_queue.put(("results", batch))
+
+    def follow_parent():
+        # 同步主进程的停止/暂停状态，并定期把结果发回
+        while not finished.is_set():
+            if stop_event.is_set() and not IS_STOP:
+                request_stop()
+            if not IS_STOP and pause_event.is_set() != is_paused():
+                if pause_event.is_set():
+                    pause_requests()
+                else:
+                    resume_requests()
+            flush()
+            finished.wait(SHARD_FLUSH_SECONDS)
+
+    def pull_tasks(scheduler):
+        # 本进程某个模型积压达到上限时add_rows阻塞，不再领取新批次，剩余批次由空闲的进程领走
+        try:
+            while not IS_STOP:
+                try:
+                    item = task_queue.get(timeout=STOP_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                model_name, rows = item
+                scheduler.add_rows(model_name, rows, max_pending=max(SHARD_BATCH_SIZE, max_workers * 2))
+        finally:
+            scheduler.close_input()
+
+    reset_stop()
+    cache = None
+    follower = threading.Thread(target=follow_parent, daemon=True)
+    try:
+        if options["cache"]:
+            cache = ResponseCache(**options["cache"])
+        model_instances = [create_model_instance(cfg, options["system_prompt"], cache) for cfg in options["model_configs"]]
+        scheduler = TaskScheduler(max_workers)
+        scheduler.connection_limit = connection_limit(max_workers, options["hedge"])
+        init_session_pool(scheduler.connection_limit)
+        cost_priors = options["cost_priors"]
+        cost_models = {}
+        for model_ins, cfg in zip(model_instances, options["model_configs"]):
+            attach_model_controls(model_ins, cfg, max_workers, options["adaptive"], options["hedge"], log)
+            if cost_priors is not None:
+                cost_models[model_ins.model_name] = CostModel(model_ins.model_name, cost_priors.get(model_ins.model_name))
+            scheduler.add_model(model_ins, [], cfg.get("max_concurrency"), model_ins.concurrency_controller,
+                                cost_models.get(model_ins.model_name))
+        scheduler.open_input()
+        follower.start()
+        threading.Thread(target=pull_tasks, args=(scheduler,), daemon=True).start()
+        if options["engine"] == "asyncio":
+            asyncio.run(scheduler.run_async(on_result))
+        else:
+            scheduler.run(on_result)
+        for model_ins in model_instances:
+            summary["endpoints"][model_ins.model_name] = model_ins.balancer.stats()
+            for line in model_control_summary(model_ins):
+                log(line)
+        for cost_model in cost_models.values():
+            log(cost_model.summary_line())
+        if cache is not None:
+            summary["cache"] = (cache.hits, cache.misses)
+    except Exception as e:
+        log(f"【错误】子进程异常：{str(e)}")
+    finally:
+        finished.set()
+        if follower.is_alive():
+            follower.join()
+        flush()
+        if cache is not None:
+            cache.close(evict=False)
+        result_queue.put(("done", shard_id, summary))
+
+class ShardedScheduler:
+    """多进程调度器：接口与TaskScheduler一致，BatchRunner的数据生产者无需区分；去重、任务日志和结果写出仍在主进程，
+    结果按行号回写，写出顺序与单进程相同"""
+    def __init__(self, processes, max_workers, options, cache=None, log_func=print):
+        self.processes = max(1, int(processes))
+        self.max_workers = max(1, -(-int(max_workers) // self.processes))  # 每个进程的并发数
+        self.options = options  # 子进程共用的运行参数：model_configs/system_prompt/engine/adaptive/cache
+        self.cache = cache      # 主进程的ResponseCache，只用于汇总子进程的命中数
+        self.log_func = log_func
+        # fork会把GUI进程的线程和界面状态一起复制过去，统一用spawn启动干净的解释器
+        self._ctx = multiprocessing.get_context("spawn")
+        self._task_queue = self._ctx.Queue(maxsize=self.processes * 4)
+        self._result_queue = self._ctx.Queue()
+        self._stop_event = self._ctx.Event()
+        self._pause_event = self._ctx.Event()
+        self._models = {}  # model_name -> 主进程的模型实例，结束时合并子进程的节点计数
+        self.failed_shards = []  # 异常退出的分片号，它领走的行没有结果
+
+    def add_model(self, model_ins, rows, max_concurrency=None, controller=None, cost_model=None):
+        """并发上限、自适应控制和长任务优先在子进程中按options生效，这里只登记模型"""
+        self._models[model_ins.model_name] = model_ins
+        if rows:
+            self.add_rows(model_ins.model_name, rows)
+
+    def _put(self, item):
+        """队列满时阻塞等待子进程领取，收到停止指令或有分片异常退出时放弃"""
+        while not IS_STOP and not self._stop_event.is_set():
+            try:
+                self._task_queue.put(item, timeout=STOP_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def add_rows(self, model_name, rows, max_pending=None):
+        if self.options.get("cost_priors") is not None:
+            # 长任务优先：本块内最长的行先分发，子进程内再按长度排队
+            rows = sorted(rows, key=lambda row: -len(row[1]))
+        for start in range(0, len(rows), SHARD_BATCH_SIZE):
+            self._put((model_name, rows[start:start + SHARD_BATCH_SIZE]))
+
+    def open_input(self):
+        pass
+
+    def close_input(self):
+        """每个子进程领到一个结束标记后关闭自己的输入"""
+        for _ in range(self.processes):
+            self._put(None)
+
+    def _merge_summary(self, summary):
+        for model_name, stats in summary["endpoints"].items():
+            if model_name in self._models:
+                self._models[model_name].balancer.merge_stats(stats)
+        if self.cache is not None:
+            self.cache.hits += summary["cache"][0]
+            self.cache.misses += summary["cache"][1]
+
+    def run(self, on_result):
+        """启动子进程并在当前线程接收结果，阻塞到全部分片完成；停止/暂停通过Event同步给子进程"""
+        workers = {}
+        for shard_id in range(1, self.processes + 1):
+            options = {**self.options, "shard_id": shard_id, "max_workers": self.max_workers}
+            process = self._ctx.Process(target=shard_worker, daemon=True, args=(
+                options, self._task_queue, self._result_queue, self._stop_event, self._pause_event))
+            process.start()
+            workers[shard_id] = process
+        done = set()
+        stop_deadline = None
+        while len(done) < len(workers):
+            if IS_STOP or self.failed_shards:
+                self._stop_event.set()
+                if stop_deadline is None:
+                    stop_deadline = time.monotonic() + SHARD_STOP_GRACE
+                elif time.monotonic() > stop_deadline:
+                    break
+            elif is_paused() != self._pause_event.is_set():
+                if is_paused():
+                    self._pause_event.set()
+                else:
+                    self._pause_event.clear()
+            try:
+                message = self._result_queue.get(timeout=STOP_POLL_SECONDS)
+            except queue.Empty:
+                # 子进程异常退出（如被系统杀掉）不会发回done，它领走的行保持未完成；
+                # 它可能死在持有队列锁的时候，其余分片继续读写队列会卡死，因此按停止处理：收回已完成的结果后结束，剩余的行留给续跑
+                for shard_id, process in workers.items():
+                    if shard_id not in done and not process.is_alive():
+                        done.add(shard_id)
+                        self.failed_shards.append(shard_id)
+                        self.log_func(f"【错误】分片{shard_id} 子进程异常退出（exitcode={process.exitcode}），停止其余分片，未完成的行标记为任务终止")
+                continue
+            if message[0] == "results":
+                for model_name, row_idx, res, metrics in message[1]:
+                    on_result(model_name, row_idx, res, metrics)
+            elif message[0] == "log":
+                self.log_func(message[1])
+            elif message[0] == "done":
+                done.add(message[1])
+                self._merge_summary(message[2])
+        for process in workers.values():
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        if IS_STOP or self.failed_shards:
+            # 停止时队列中可能还有未领取的批次，不等待其写入管道，避免主进程退出时卡住
+            self._task_queue.cancel_join_thread()
+
+# ========== 离线批处理：按模型把query打包成提供方的批处理任务，提交后轮询，完成后按行回填 ==========
+REQUEST_MODES = ["流式请求", "批处理任务"]
+BATCH_TICK_SECONDS = 0.5  # 批处理调度循环的间隔，各任务按poll_seconds单独轮询
+BATCH_MAX_POLL_FAILURES = 10  # 单个任务连续查询失败的上限，超出后放弃该任务
+
+class BatchJobClient:
+    """批处理接口的公共部分：子类把payload打包成提供方格式、提交、查询状态、解析结果"""
+    default_max_requests = 10000  # 单个任务的默认最大行数
+
+    def __init__(self, model_ins, root_url, api_key):
+        self.model_ins = model_ins
+        self.root_url = root_url.rstrip("/")
+        self.headers = model_ins.make_headers(api_key)
+
+    def _request(self, method, path, **kwargs):
+        """path可以是接口路径或结果下载的完整地址；HTTP错误抛出RequestError"""
+        url = path if path.startswith("http") else f"{self.root_url}{path}"
+        headers = kwargs.pop("headers", self.headers)
+        response = get_shared_session(url).request(method, url, headers=headers, timeout=TIMEOUT, **kwargs)
+        if response.status_code >= 400:
+            raise http_request_error(response.status_code, response.headers.get("Retry-After"), response.text)
+        return response
+
+    def submit(self, items):
+        """items为[(custom_id, payload)]，返回任务ID"""
+        raise NotImplementedError("子类必须实现该方法")
+
+    def poll(self, job_id):
+        """返回(状态, 任务信息)，状态为running/done/failed"""
+        raise NotImplementedError("子类必须实现该方法")
+
+    def results(self, info):
+        """逐条返回(custom_id, 结果文本或RequestError)"""
+        raise NotImplementedError("子类必须实现该方法")
+
+    @staticmethod
+    def iter_result_lines(text):
+        """逐行解析JSONL结果文件；解析不了的行没有custom_id，对应的行按未返回结果记为失败"""
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(item, dict):
+                yield item
+
+    @staticmethod
+    def decode_item(decode, item):
+        """解析单条结果；内容不符合预期时只把这一行记为失败，同一任务中其它已完成的行照常回填"""
+        try:
+            return decode(item)
+        except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e:
+            return RequestError("error", f"无法解析批处理结果：{type(e).__name__} {e}")
+
+    def cancel(self, job_id):
+        raise NotImplementedError("子类必须实现该方法")
+
+class OpenAIBatchClient(BatchJobClient):
+    """OpenAI兼容的Batch接口：上传JSONL文件 → 创建batch → 轮询 → 下载输出/错误文件"""
+    def submit(self, items):
+        lines = [
+            json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                        "body": {**payload, "stream": False}}, ensure_ascii=False)
+            for custom_id, payload in items
+        ]
+        # 文件上传走multipart，不能带json的Content-Type
+        upload_headers = {k: v for k, v in self.headers.items() if k != "Content-Type"}
+        upload = self._request("POST", "/v1/files", headers=upload_headers, data={"purpose": "batch"},
+                               files={"file": ("batch.jsonl", "\n".join(lines).encode("utf-8"), "application/jsonl")}).json()
+        job = self._request("POST", "/v1/batches", json={
+            "input_file_id": upload["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"
+        }).json()
+        return job["id"]
+
+    def poll(self, job_id):
+        info = self._request("GET", f"/v1/batches/{job_id}").json()
+        status = info.get("status")
+        if status == "failed":
+            return "failed", info
+        # 过期/取消的任务仍可能有部分输出，按完成处理，缺失的行记为失败
+        if status in ("completed", "expired", "cancelled"):
+            return "done", info
+        return "running", info
+
+    def results(self, info):
+        for key in ("output_file_id", "error_file_id"):
+            if not info.get(key):
+                continue
+            for item in self.iter_result_lines(self._request("GET", f"/v1/files/{info[key]}/content").text):
+                yield item.get("custom_id"), self.decode_item(self.decode_result, item)
+
+    @staticmethod
+    def decode_result(item):
+        response = item.get("response") or {}
+        body = response.get("body") or {}
+        if response.get("status_code") == 200:
+            return body["choices"][0]["message"].get("content") or ""
+        error = item.get("error") or body.get("error") or {}
+        return RequestError("http", str(error.get("message") or error), status=response.get("status_code"))
+
+    def cancel(self, job_id):
+        self._request("POST", f"/v1/batches/{job_id}/cancel")
+
+class ClaudeBatchClient(BatchJobClient):
+    """Anthropic Message Batches接口：请求列表一次提交，结束后按results_url下载JSONL结果"""
+    default_max_requests = 100000
+
+    def __init__(self, model_ins, root_url, api_key):
+        super().__init__(model_ins, root_url, api_key)
+        self.headers = {**self.headers, "anthropic-version": "2023-06-01"}
+
+    def submit(self, items):
+        # 流式payload中的Vertex版本号和stream字段在批处理接口中不需要，模型名改为放在params里
+        batch_requests = [
+            {"custom_id": custom_id,
+             "params": {"model": self.model_ins.model_name,
+                        **{k: v for k, v in payload.items() if k not in ("anthropic_version", "stream")}}}
+            for custom_id, payload in items
+        ]
+        return self._request("POST", "/v1/messages/batches", json={"requests": batch_requests}).json()["id"]
+
+    def poll(self, job_id):
+        info = self._request("GET", f"/v1/messages/batches/{job_id}").json()
+        return ("done" if info.get("processing_status") == "ended" else "running"), info
+
+    def results(self, info):
+        results_url = info.get("results_url") or f"/v1/messages/batches/{info['id']}/results"
+        for item in self.iter_result_lines(self._request("GET", results_url).text):
+            yield item.get("custom_id"), self.decode_item(self.decode_result, item)
+
+    @staticmethod
+    def decode_result(item):
+        result = item.get("result") or {}
+        if result.get("type") == "succeeded":
+            blocks = (result.get("message") or {}).get("content") or []
+            return "".join(block.get("text", "") for block in blocks if block.get("type") == "text")
+        error = (result.get("error") or {}).get("error") or result.get("error") or {}
+        return RequestError("error", f"{result.get('type')}: {error.get('message', '')}")
+
+    def cancel(self, job_id):
+        self._request("POST", f"/v1/messages/batches/{job_id}/cancel")
+
+class GeminiBatchClient(BatchJobClient):
+    """Gemini batchGenerateContent接口：请求内联提交（单个任务有大小限制，默认每任务1000行），完成后结果在操作的response中"""
+    default_max_requests = 1000
+
+    def submit(self, items):
+        body = {"batch": {
+            "display_name": f"{self.model_ins.model_name}-{int(time.time())}",
+            "input_config": {"requests": {"requests": [
+                {"request": payload, "metadata": {"key": custom_id}} for custom_id, payload in items
+            ]}}
+        }}
+        return self._request("POST", f"/v1beta/models/{self.model_ins.model_name}:batchGenerateContent", json=body).json()["name"]
+
+    def poll(self, job_id):
+        info = self._request("GET", f"/v1beta/{job_id}").json()
+        if not info.get("done"):
+            return "running", info
+        return ("failed" if info.get("error") else "done"), info
+
+    def results(self, info):
+        inlined = ((info.get("response") or {}).get("inlinedResponses") or {}).get("inlinedResponses") or []
+        for item in inlined:
+            custom_id = (item.get("metadata") or {}).get("key") if isinstance(item, dict) else None
+            yield custom_id, self.decode_item(self.decode_result, item)
+
+    @staticmethod
+    def decode_result(item):
+        """被安全策略拦截的请求没有candidates，只有promptFeedback.blockReason；候选被拦截时没有content，按空内容处理"""
+        if item.get("error"):
+            return RequestError("error", str(item["error"].get("message") or item["error"]))
+        response = item.get("response") or {}
+        candidates = response.get("candidates")
+        if not candidates:
+            reason = (response.get("promptFeedback") or {}).get("blockReason")
+            return RequestError("error", f"请求被拦截：{reason}" if reason else "批处理结果中没有candidates")
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(part.get("text", "") for part in parts)
+
+    def cancel(self, job_id):
+        self._request("POST", f"/v1beta/{job_id}:cancel")
+
+def make_batch_client(model_ins, batch_url, api_key):
+    if isinstance(model_ins, ClaudeModel):
+        return ClaudeBatchClient(model_ins, batch_url, api_key)
+    if isinstance(model_ins, GeminiModel):
+        return GeminiBatchClient(model_ins, batch_url, api_key)
+    return OpenAIBatchClient(model_ins, batch_url, api_key)
+
+class BatchJob:
+    """一个已提交的批处理任务；restored为从任务日志恢复的上次运行中提交的任务"""
+    __slots__ = ("model_name", "job_id", "rows", "submitted_at", "next_poll", "poll_failures", "restored")
+
+    def __init__(self, model_name, job_id, rows, restored=False):
+        self.model_name = model_name
+        self.job_id = job_id
+        self.rows = rows  # custom_id -> (行号, 缓存key)
+        self.submitted_at = time.perf_counter()
+        self.next_poll = 0.0
+        self.poll_failures = 0  # 连续查询失败次数，成功一次清零
+        self.restored = restored
+
+class BatchJobScheduler:
+    """批处理模式的调度器：接口与TaskScheduler一致，数据生产者、去重、任务日志和结果写出不变；
+    每个模型攒够max_requests_per_job行或数据读完时提交一个任务，各任务按poll_seconds轮询，完成后按custom_id回填到行；
+    已提交的任务ID写入任务日志，中途崩溃或停止后续跑时继续轮询这些任务，不重复提交"""
+    def __init__(self, model_configs, log_func=print, journal=None):
+        self.model_configs = {cfg["model_name"]: cfg for cfg in model_configs}
+        self.log_func = log_func
+        self.journal = journal
+        self.max_workers = 1
+        self._cond = threading.Condition()
+        self._models = {}    # model_name -> (模型实例, 批处理客户端, 每任务行数, 轮询间隔, 连续查询失败上限)
+        self._pending = {}   # model_name -> [(行号, payload, 缓存key)]，等待打包提交
+        self._ready = deque()  # 缓存命中或打包失败、可直接回填的(模型, 行号, 结果, 指标)
+        self._jobs = []
+        self._input_open = False
+        # 恢复的任务中的行：数据生产者送来时不再提交；任务先结束的，结果暂存到该行送来后再回填
+        self._restored = set()  # (模型, 行号)，所属的恢复任务尚未结束
+        self._admitted = {}     # (模型, 行号) -> query，已由数据生产者送来、等待恢复任务的结果
+        self._held = {}         # (模型, 行号) -> (结果, 指标)，恢复任务已返回、数据生产者尚未送来
+
+    def add_model(self, model_ins, rows, max_concurrency=None, controller=None, cost_model=None):
+        cfg = self.model_configs[model_ins.model_name]
+        batch_cfg = cfg.get("batch") or {}  # yaml batch段：poll_seconds/max_requests_per_job/max_poll_failures
+        client = make_batch_client(model_ins, cfg["batch_url"], cfg["api_key"])
+        per_job = int(batch_cfg.get("max_requests_per_job", client.default_max_requests))
+        with self._cond:
+            self._models[model_ins.model_name] = (model_ins, client, max(1, per_job), batch_cfg.get("poll_seconds", 30),
+                                                  int(batch_cfg.get("max_poll_failures", BATCH_MAX_POLL_FAILURES)))
+            self._pending[model_ins.model_name] = []
+        self._restore_jobs(model_ins.model_name)
+        if rows:
+            self.add_rows(model_ins.model_name, rows)
+
+    def _restore_jobs(self, model_name):
+        """接管任务日志中上次运行提交、尚未回填的任务；已回填的行不再等待"""
+        if self.journal is None:
+            return
+        for job_id, (job_model, rows) in self.journal.batch_jobs.items():
+            if job_model != model_name:
+                continue
+            rows = {custom_id: (row_idx, cache_key) for custom_id, (row_idx, cache_key) in rows.items()
+                    if (model_name, row_idx) not in self.journal.completed}
+            with self._cond:
+                self._jobs.append(BatchJob(model_name, job_id, rows, restored=True))
+                self._restored.update((model_name, row_idx) for row_idx, _ in rows.values())
+            self.log_func(f"【续跑】{model_name}：继续轮询上次提交的批处理任务 {job_id}（{len(rows)} 条未回填）")
+
+    def _prepare_row(self, model_ins, row_idx, query):
+        """构建payload并查缓存：返回(待提交的行, None)或(None, 可直接回填的(结果, 指标))"""
+        metrics = RequestMetrics()
+        try:
+            payload = model_ins.build_payload(query)
+            cache_key, cached = model_ins.cache_lookup(payload)
+        except Exception as e:
+            return None, (to_request_error(e), metrics)
+        if cached is not None:
+            metrics.cached = True
+            metrics.chars = len(cached)
+            return None, (cached, metrics)
+        return (row_idx, payload, cache_key), None
+
+    def add_rows(self, model_name, rows, max_pending=None):
+        """构建payload并查缓存；未提交的行积压到两个任务的量时阻塞，等调度循环提交"""
+        model_ins, _, per_job, _, _ = self._models[model_name]
+        for row_idx, query in rows:
+            key = (model_name, row_idx)
+            with self._cond:
+                if key in self._held:
+                    self._ready.append((model_name, row_idx, *self._held.pop(key)))
+                    continue
+                if key in self._restored:
+                    self._admitted[key] = query
+                    continue
+            pending_row, ready = self._prepare_row(model_ins, row_idx, query)
+            with self._cond:
+                if ready is not None:
+                    self._ready.append((model_name, row_idx, *ready))
+                    continue
+                while len(self._pending[model_name]) >= per_job * 2 and not IS_STOP:
+                    self._cond.wait(timeout=0.5)
+                self._pending[model_name].append(pending_row)
+
+    def open_input(self):
+        with self._cond:
+            self._input_open = True
+
+    def close_input(self):
+        with self._cond:
+            self._input_open = False
+            self._cond.notify_all()
+
+    def _take_batches(self):
+        """取出可提交的批次：攒满一个任务，或数据已读完时把剩余的行打包；暂停期间不提交"""
+        batches = []
+        with self._cond:
+            if not RUN_GATE.is_set():
+                return batches
+            for model_name, pending in self._pending.items():
+                per_job = self._models[model_name][2]
+                while len(pending) >= per_job or (pending and not self._input_open):
+                    batches.append((model_name, pending[:per_job]))
+                    del pending[:per_job]
+            self._cond.notify_all()
+        return batches
+
+    def _submit(self, model_name, rows, on_result):
+        client = self._models[model_name][1]
+        items = [(f"row-{row_idx}", payload) for row_idx, payload, _ in rows]
+        try:
+            job_id = client.submit(items)
+        except Exception as e:
+            error = to_request_error(e)
+            self.log_func(f"【批处理】{model_name}：提交任务失败（{len(rows)} 条）：{error}")
+            for row_idx, _, _ in rows:
+                on_result(model_name, row_idx, error, RequestMetrics())
+            return
+        job_rows = {f"row-{row_idx}": (row_idx, cache_key) for row_idx, _, cache_key in rows}
+        if self.journal is not None:
+            self.journal.record_batch_job(model_name, job_id, job_rows)
+        self._jobs.append(BatchJob(model_name, job_id, job_rows))
+        self.log_func(f"【批处理】{model_name}：已提交任务 {job_id}（{len(rows)} 条）")
+
+    def _deliver(self, job, row_idx, res, metrics, on_result):
+        """恢复的任务中，数据生产者还没送来的行先暂存结果"""
+        if job.restored:
+            key = (job.model_name, row_idx)
+            with self._cond:
+                self._restored.discard(key)
+                if key not in self._admitted:
+                    self._held[key] = (res, metrics)
+                    return
+                del self._admitted[key]
+        on_result(job.model_name, row_idx, res, metrics)
+
+    def _requeue(self, model_name, row_idx):
+        """恢复的任务没有返回该行（任务已取消/过期/查不到）：按新行重新提交"""
+        key = (model_name, row_idx)
+        with self._cond:
+            self._restored.discard(key)
+            if key not in self._admitted:
+                return  # 数据生产者还没送来，送来时按普通行处理
+            query = self._admitted.pop(key)
+        pending_row, ready = self._prepare_row(self._models[model_name][0], row_idx, query)
+        with self._cond:
+            if ready is not None:
+                self._ready.append((model_name, row_idx, *ready))
+            else:
+                self._pending[model_name].append(pending_row)
+
+    def _collect(self, job, state, info, on_result):
+        """任务结束：按custom_id回填结果，没有返回结果的行记为失败，恢复的任务中缺少结果的行重新提交"""
+        model_ins = self._models[job.model_name][0]
+        client = self._models[job.model_name][1]
+        elapsed = time.perf_counter() - job.submitted_at
+        remaining = dict(job.rows)
+        ok = 0
+        try:
+            results = client.results(info) if state == "done" else []
+            for custom_id, res in results:
+                if custom_id not in remaining:
+                    continue
+                row_idx, cache_key = remaining.pop(custom_id)
+                metrics = RequestMetrics()
+                metrics.total = elapsed
+                if not isinstance(res, RequestError):
+                    res = res if res else "模型返回空内容"
+                    metrics.chars = len(res)
+                    model_ins.cache_store(cache_key, res)
+                    ok += 1
+                self._deliver(job, row_idx, res, metrics, on_result)
+            missing = RequestError("error", f"批处理任务 {job.job_id} 状态 {info.get('status') or state}，未返回该行结果")
+        except Exception as e:
+            missing = to_request_error(e)
+        for row_idx, _ in remaining.values():
+            if job.restored:
+                self._requeue(job.model_name, row_idx)
+            else:
+                on_result(job.model_name, row_idx, missing, RequestMetrics())
+        if self.journal is not None:
+            self.journal.finish_batch_job(job.job_id)
+        duration = f"{elapsed:.1f} 秒" if elapsed < 60 else f"{elapsed / 60:.1f} 分钟"
+        requeued = f"，{len(remaining)} 条重新提交" if job.restored and remaining else ""
+        self.log_func(f"【批处理】{job.model_name}：任务 {job.job_id} 结束，成功 {ok} 条，失败 {len(job.rows) - ok} 条{requeued}，耗时 {duration}")
+
+    def _poll(self, job, on_result):
+        """查询一个任务，结束时回填；连续查询失败达到上限（如任务已过期被删除，一直404）时放弃该任务"""
+        _, client, _, poll_seconds, max_failures = self._models[job.model_name]
+        job.next_poll = time.monotonic() + poll_seconds
+        try:
+            state, info = client.poll(job.job_id)
+        except Exception as e:
+            job.poll_failures += 1
+            if job.poll_failures < max_failures:
+                # 查询失败视为暂时性问题，下个轮询周期再查
+                self.log_func(f"【警告】查询批处理任务 {job.job_id} 失败（第 {job.poll_failures} 次）：{str(e)}")
+                return
+            self.log_func(f"【错误】批处理任务 {job.job_id} 连续 {job.poll_failures} 次查询失败，放弃该任务：{str(e)}")
+            state, info = "failed", {"status": f"连续 {job.poll_failures} 次查询失败"}
+        job.poll_failures = 0
+        if state != "running":
+            self._jobs.remove(job)
+            self._collect(job, state, info, on_result)
+
+    def run(self, on_result):
+        """调度循环：回填缓存命中的行、提交攒好的批次、轮询已提交的任务；
+        停止时取消所有未结束的任务，任务日志中保留这些任务，续跑时取回取消前已完成的行"""
+        while True:
+            while self._ready:
+                on_result(*self._ready.popleft())
+            if IS_STOP:
+                for job in self._jobs:
+                    try:
+                        self._models[job.model_name][1].cancel(job.job_id)
+                        self.log_func(f"【批处理】{job.model_name}：已取消任务 {job.job_id}")
+                    except Exception as e:
+                        self.log_func(f"【警告】取消批处理任务 {job.job_id} 失败：{str(e)}")
+                return
+            for model_name, rows in self._take_batches():
+                self._submit(model_name, rows, on_result)
+            now = time.monotonic()
+            for job in list(self._jobs):
+                if job.next_poll <= now:
+                    self._poll(job, on_result)
+            with self._cond:
+                finished = not self._input_open and not any(self._pending.values()) and not self._ready and not self._jobs
+            if finished:
+                return
+            sleep_unless_stopped(BATCH_TICK_SECONDS)
+
+# ========== 批量运行：配置加载+模型构建+调度+结果写出，GUI与命令行共用 ==========
+def load_yaml_config(config_path):
+    """读取yaml配置文件，文件不存在或格式错误时抛出异常由调用方记录"""
+    import yaml
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return yaml.safe_load(f)
+
+def build_model_configs(yaml_config, env_en, model_names, default_limit=None, log_func=print):
+    """按环境拼出每个模型的请求配置；无API_KEY的模型记录警告后跳过"""
+    env_config = yaml_config['config'].get(env_en)
+    if not env_config:
+        log_func(f"【错误】配置文件中没有环境：{env_en}")
+        return []
+    # 单模型并发：yaml中concurrency段按模型名覆盖，未配置的模型使用default_limit
+    concurrency_cfg = yaml_config.get('concurrency') or {}
+    model_configs = []
+
+    for model_name in model_names:
+        # 多节点：endpoints段按模型显式列出[{base_url, api_key}]；否则api_keys与base_urls可各写列表，两两组合
+        api_keys = as_list(env_config['api_keys'].get(model_name))
+        explicit = (env_config.get('endpoints') or {}).get(model_name)
+        if explicit:
+            endpoints = [(item['base_url'].replace("{model}", model_name), item.get('api_key') or (api_keys or [None])[0])
+                         for item in explicit]
+        else:
+            if "claude" in model_name:
+                base_urls = [url.replace("{model}", model_name) for url in as_list(env_config['base_urls']['claude'])]
+            elif "gemini" in model_name:
+                base_urls = [url.replace("{model}", model_name) for url in as_list(env_config['base_urls']['gemini'])]
+            else:
+                base_urls = as_list(env_config['base_urls']['other'])
+            endpoints = [(url, key) for url in base_urls for key in api_keys]
+        endpoints = [(url, key) for url, key in endpoints if key]
+        if not endpoints:
+            log_func(f"【警告】{model_name} 无对应API_KEY，跳过该模型")
+            continue
+        base_url, api_key = endpoints[0]
+        # 批处理模式的接口根地址：batch_urls按模型族配置，与base_urls写法相同，未配置时该模型不支持批处理
+        family = "claude" if "claude" in model_name else "gemini" if "gemini" in model_name else "other"
+        batch_urls = as_list((env_config.get('batch_urls') or {}).get(family))
+
+        model_configs.append({
+            "model_name": model_name,
+            "api_key": api_key,
+            "base_url": base_url,
+            "endpoints": endpoints,
+            "balancer": merge_model_config(yaml_config.get('balancer'), model_name),
+            "prompt_cache": merge_model_config(yaml_config.get('prompt_cache'), model_name),
+            "max_concurrency": concurrency_cfg.get(model_name, concurrency_cfg.get("default", default_limit)),
+            "env": env_en,
+            "retry": merge_model_config(yaml_config.get('retry'), model_name),
+            "rate_limit": merge_model_config(yaml_config.get('rate_limits'), model_name),
+            "adaptive": merge_model_config(yaml_config.get('adaptive'), model_name),
+            "hedging": merge_model_config(yaml_config.get('hedging'), model_name),
+            "batch_url": batch_urls[0].replace("{model}", model_name) if batch_urls else None,
+            "batch": merge_model_config(yaml_config.get('batch'), model_name)
+        })
+    return model_configs
+
+def create_model_instance(model_cfg, system_prompt, cache=None):
+    model_name = model_cfg["model_name"]
+    if "claude" in model_name:
+        model_cls = ClaudeModel
+    elif "gemini" in model_name:
+        model_cls = GeminiModel
+    else:
+        model_cls = OtherModel
+    return model_cls(model_name, model_cfg["api_key"], model_cfg["base_url"], system_prompt,
+                     env=model_cfg.get("env", ""), cache=cache,
+                     retry_policy=RetryPolicy.from_config(model_cfg.get("retry") or {}),
+                     rate_limiter=RateLimiter.from_config(model_cfg.get("rate_limit") or {}),
+                     endpoints=model_cfg.get("endpoints"), balancer_cfg=model_cfg.get("balancer"),
+                     prompt_cache=bool((model_cfg.get("prompt_cache") or {}).get("enabled")))
+
+def attach_model_controls(model_ins, cfg, max_workers, adaptive=False, hedge=False, log_func=print):
+    """给模型实例挂上节点日志、自适应并发和对冲控制，单进程运行和多进程子进程共用"""
+    model_ins.balancer.log_func = log_func
+    if adaptive:
+        max_limit = min(max_workers, int(cfg.get("max_concurrency") or max_workers))
+        model_ins.concurrency_controller = AIMDController.from_config(model_ins.model_name, max_limit, cfg.get("adaptive") or {})
+        model_ins.concurrency_controller.log_func = log_func
+    if hedge:
+        model_ins.hedger = Hedger.from_config(model_ins.model_name, cfg.get("hedging") or {})
+
+def model_control_summary(model_ins):
+    lines = []
+    if model_ins.concurrency_controller is not None:
+        lines.append(f"【自适应并发】{model_ins.concurrency_controller.summary_line()}")
+    if model_ins.hedger is not None:
+        lines.append(f"【对冲】{model_ins.hedger.summary_line()}")
+    return lines
+
+def connection_limit(max_workers, hedge=False):
+    """连接池大小：对冲请求不占工作线程但要占连接，按并发数的10%留出余量"""
+    return max_workers + max(2, max_workers // 10) if hedge else max_workers
+
+class BatchRunner:
+    """一次批量运行的全部状态：读取数据、调度请求、按行回写结果；日志通过log_func输出，不访问任何界面"""
+    def __init__(self, yaml_config, data_path, system_prompt, env, max_workers=3, engine="threading",
+                 cache_mode="使用缓存", stream_save_path=None, log_func=print, log_rows=True, dedup=True, adaptive=False,
+                 processes=1, hedge=False, request_mode="流式请求", schedule="按行顺序"):
+        self.yaml_config = yaml_config
+        self.data_path = data_path
+        self.system_prompt = system_prompt
+        self.env = env
+        self.max_workers = max_workers
+        self.engine = engine
+        self.cache_mode = cache_mode
+        self.stream_save_path = stream_save_path  # 非空时边跑边写，否则结束后由调用方保存
+        self.log_func = log_func
+        self.log_rows = log_rows  # 是否逐条记录成功日志，失败始终记录
+        self.result_queries = []  # 结束后保存模式下按行序收集的query
+        self.result_dict = {}     # model_name -> 按行对齐的结果
+        self.metrics_dict = {}    # model_name -> 按行对齐的RequestMetrics
+        self.result_lock = Lock()
+        self.run_journal = None
+        self.result_writer = None
+        self.error_stats = {}  # model_name -> {错误类型: 次数}
+        self.latency_stats = LatencyStats()
+        self.deduper = QueryDeduper() if dedup else None  # 为None时重复query逐条请求
+        self.adaptive = adaptive  # 自适应并发：全局并发数和concurrency段只作为上限，各模型实际并发按AIMD调整
+        self.processes = max(1, int(processes))  # 大于1时按批分发给多个子进程请求，全局并发数在各进程间均分
+        self.hedge = hedge  # 对冲慢请求：首token超过近期分位数仍未返回时向另一节点补发
+        self.batch_mode = request_mode == "批处理任务"  # 提交提供方的离线批处理任务，不走流式请求
+        self.longest_first = schedule == "长任务优先"  # 按估计耗时从长到短发请求，各模型按剩余工作量交替
+        self.unfinished = 0  # 运行结束时没有结果、标记为任务终止的(行, 模型)数
+
+    def add_log(self, msg):
+        self.log_func(msg)
+
+    # ========== 打开响应缓存 ==========
+    def open_response_cache(self):
+        """按缓存模式打开缓存；yaml中cache段可配置path/ttl_hours/max_size_mb"""
+        if self.cache_mode == "不使用缓存":
+            return None
+        cache_cfg = self.yaml_config.get('cache') or {}
+        try:
+            cache = ResponseCache(
+                path=cache_cfg.get("path", DEFAULT_CACHE_PATH),
+                ttl_hours=cache_cfg.get("ttl_hours", 24 * 7),
+                max_size_mb=cache_cfg.get("max_size_mb", 500),
+                refresh=(self.cache_mode == "刷新缓存")
+            )
+            cache.evict()
+            return cache
+        except Exception as e:
+            self.add_log(f"【警告】打开响应缓存失败，本次不使用缓存：{str(e)}")
+            return None
+
+    # ========== 打开断点续跑日志 ==========
+    def open_run_journal(self):
+        """同一份数据+配置存在未完成的日志时自动续跑；刷新缓存模式下重新开始"""
+        journal_cfg = self.yaml_config.get('journal') or {}
+        journal_dir = journal_cfg.get("dir", DEFAULT_JOURNAL_DIR)
+        try:
+            os.makedirs(journal_dir, exist_ok=True)
+            run_key = RunJournal.make_run_key(self.data_path, self.env, self.system_prompt)
+            path = os.path.join(journal_dir, f"{run_key}.jsonl")
+            if self.cache_mode == "刷新缓存" and os.path.exists(path):
+                os.remove(path)
+            journal = RunJournal(path)
+            if journal.completed:
+                self.add_log(f"【续跑】检测到未完成的任务日志，已恢复 {len(journal.completed)} 条结果：{path}")
+            return journal
+        except Exception as e:
+            self.add_log(f"【警告】打开任务日志失败，本次不支持断点续跑：{str(e)}")
+            return None
+
+    # ========== 多进程调度器 ==========
+    def make_sharded_scheduler(self, model_configs, cache, cost_priors=None):
+        """子进程的参数：模型配置按进程数均分并发上限和限流额度，缓存按同一文件各自打开"""
+        cache_options = None
+        if cache is not None:
+            cache_options = {"path": cache.path, "ttl_hours": cache.ttl_seconds / 3600,
+                             "max_size_mb": cache.max_size_bytes / 1024 / 1024, "refresh": cache.refresh}
+        options = {
+            "model_configs": [split_for_shards(cfg, self.processes) for cfg in model_configs],
+            "system_prompt": self.system_prompt,
+            "engine": self.engine,
+            "adaptive": self.adaptive,
+            "hedge": self.hedge,
+            "cache": cache_options,
+            "cost_priors": cost_priors,
+        }
+        return ShardedScheduler(self.processes, self.max_workers, options, cache, self.add_log)
+
+    # ========== 数据生产者线程 ==========
+    def feed_scheduler(self, scheduler, model_names, completed):
+        """按块读取数据文件：任务日志中已完成的行直接回填，其余行送入调度器"""
+        row_idx = 0
+        try:
+            for chunk in iter_query_chunks(self.data_path):
+                if IS_STOP:
+                    break
+                rows_by_model = {name: [] for name in model_names}
+                for query in chunk:
+                    if self.result_writer is not None:
+                        self.result_writer.add_query(row_idx, query)
+                    else:
+                        self.result_queries.append(query)
+                    for name in model_names:
+                        res = completed.get((name, row_idx))
+                        # 先占好结果位置再去重，leader随时可能完成并回填到这一行
+                        if self.result_writer is None:
+                            with self.result_lock:
+                                self.result_dict[name].append(res)
+                                self.metrics_dict[name].append(None)
+                        elif res is not None:
+                            self.result_writer.set_result(name, row_idx, res)
+                        if res is not None:
+                            if self.deduper is not None:
+                                self.deduper.remember(name, query, res)
+                        elif self.deduper is None:
+                            rows_by_model[name].append((row_idx, query))
+                        else:
+                            dispatch, shared = self.deduper.admit(name, row_idx, query)
+                            if dispatch:
+                                rows_by_model[name].append((row_idx, query))
+                            elif shared is not None:
+                                self.store_result(name, row_idx, shared, dedup_metrics(shared))
+                    row_idx += 1
+                for name, rows in rows_by_model.items():
+                    scheduler.add_rows(name, rows, max_pending=DATA_CHUNK_SIZE)
+            self.add_log(f"【数据】读取完成，共 {row_idx} 条query，其中 {len(completed)} 个结果由任务日志恢复")
+        except Exception as e:
+            self.add_log(f"【错误】读取数据文件失败：{str(e)}")
+        finally:
+            scheduler.close_input()
+
+    # ========== 单条结果回写【线程安全】 ==========
+    def store_result(self, model_name, row_idx, res, metrics=None):
+        """按行号写回结果及耗时指标，保证与原始数据行一一对应"""
+        if metrics is not None:
+            self.latency_stats.add(model_name, res, metrics)
+        if self.result_writer is not None:
+            self.result_writer.set_result(model_name, row_idx, res, metrics)
+        else:
+            with self.result_lock:
+                self.result_dict[model_name][row_idx] = res
+                self.metrics_dict[model_name][row_idx] = metrics
+        if self.run_journal is not None and not is_failed_result(res):
+            self.run_journal.record(model_name, row_idx, res)
+
+    def on_task_result(self, model_name, row_idx, res, metrics=None):
+        """调度器回调：写回本行结果，并回填挂在本行上的重复行"""
+        self.store_result(model_name, row_idx, res, metrics)
+        if self.deduper is not None:
+            for follower_idx in self.deduper.resolve(model_name, row_idx, res):
+                self.store_result(model_name, follower_idx, res, dedup_metrics(res))
+        if isinstance(res, RequestError):
+            with self.result_lock:
+                model_errors = self.error_stats.setdefault(model_name, {})
+                model_errors[res.label] = model_errors.get(res.label, 0) + 1
+            self.add_log(f"【{model_name}】第 {row_idx+1} 条失败：{res}")
+        elif self.log_rows:
+            self.add_log(f"【{model_name}】完成第 {row_idx+1} 条")
+
+    # ========== 运行总入口 ==========
+    def run(self, model_configs):
+        """阻塞执行全部请求并输出统计；返回是否全部完成（未被停止，且没有因分片进程异常退出等原因留下未完成的行）。
+        任务日志保持打开，由close决定是否删除"""
+        reset_stop()
+        if self.batch_mode:
+            # 批处理模式下多进程、自适应并发和对冲不生效；未配置batch_urls的模型跳过
+            for cfg in model_configs:
+                if not cfg.get("batch_url"):
+                    self.add_log(f"【警告】{cfg['model_name']} 未配置batch_urls，批处理模式下跳过")
+            model_configs = [cfg for cfg in model_configs if cfg.get("batch_url")]
+            if not model_configs:
+                self.add_log("【错误】选中的模型均未配置batch_urls，无法使用批处理模式")
+                return False
+            self.processes, self.adaptive, self.hedge, self.longest_first = 1, False, False, False
+        cache = self.open_response_cache()
+        model_instances = [create_model_instance(cfg, self.system_prompt, cache) for cfg in model_configs]
+        init_session_pool(connection_limit(self.max_workers, self.hedge))
+
+        self.run_journal = self.open_run_journal()
+        completed = self.run_journal.completed if self.run_journal else {}
+
+        for model_ins, cfg in zip(model_instances, model_configs):
+            # 多进程模式下自适应并发和对冲在各子进程中生效
+            single = self.processes == 1
+            attach_model_controls(model_ins, cfg, self.max_workers, self.adaptive and single, self.hedge and single, self.add_log)
+        model_names = [m.model_name for m in model_instances]
+        if self.stream_save_path:
+            self.result_writer = StreamingResultWriter(self.stream_save_path, model_names)
+
+        # 按(模型, 行)拆分任务：生产者线程按块读取数据并送入调度器，读取与请求同时进行
+        # 长任务优先：各模型的回答长度先验取自缓存和任务日志中的历史结果，运行中按实际耗时修正
+        cost_priors = history_output_chars(cache, completed) if self.longest_first else None
+        cost_models = {}
+        if cost_priors is not None:
+            cost_models = {m.model_name: CostModel(m.model_name, cost_priors.get(m.model_name)) for m in model_instances}
+            self.add_log(f"【调度】长任务优先：{len(cost_priors)} 个模型有历史回答长度可用于耗时估计")
+        if self.batch_mode:
+            scheduler = BatchJobScheduler(model_configs, self.add_log, self.run_journal)
+        elif self.processes > 1:
+            scheduler = self.make_sharded_scheduler(model_configs, cache, cost_priors)
+        else:
+            scheduler = TaskScheduler(self.max_workers)
+            scheduler.connection_limit = connection_limit(self.max_workers, self.hedge)
+        for model_ins, cfg in zip(model_instances, model_configs):
+            if self.result_writer is None:
+                self.result_dict[model_ins.model_name] = []
+                self.metrics_dict[model_ins.model_name] = []
+            scheduler.add_model(model_ins, [], cfg.get("max_concurrency"), model_ins.concurrency_controller,
+                                cost_models.get(model_ins.model_name))
+        scheduler.open_input()
+        producer = threading.Thread(target=self.feed_scheduler, args=(scheduler, model_names, completed), daemon=True)
+        producer.start()
+        concurrency_desc = f"自适应（上限 {self.max_workers}）" if self.adaptive else str(self.max_workers)
+        if self.processes > 1:
+            concurrency_desc += f"，进程：{self.processes}（每进程并发 {scheduler.max_workers}）"
+        if self.batch_mode:
+            self.add_log(f"✅ 共 {len(model_instances)} 个模型，请求方式：批处理任务（提交后轮询，结果完成后回填）")
+        else:
+            self.add_log(f"✅ 共 {len(model_instances)} 个模型，全局并发：{concurrency_desc}，引擎：{self.engine}")
+
+        if self.processes > 1 or self.batch_mode:
+            scheduler.run(self.on_task_result)
+        elif self.engine == "asyncio":
+            asyncio.run(scheduler.run_async(self.on_task_result))
+        else:
+            scheduler.run(self.on_task_result)
+        producer.join()
+
+        for model_name, model_errors in self.error_stats.items():
+            summary = "，".join(f"{label}×{count}" for label, count in model_errors.items())
+            self.add_log(f"【失败统计】{model_name}：{summary}")
+        for line in self.latency_stats.summary_lines():
+            self.add_log(f"【耗时统计】{line}")
+        if self.deduper is not None:
+            for line in self.deduper.summary_lines():
+                self.add_log(f"【去重】{line}")
+        for model_ins in model_instances:
+            # 实际发出的请求数（含重试）取自各节点的计数
+            sent = sum(ep.requests for ep in model_ins.balancer.endpoints)
+            if model_ins.saved_prompt_tokens and sent:
+                self.add_log(f"【提示词】{model_ins.model_name}：system prompt只发送一次，每次请求少发约 {model_ins.saved_prompt_tokens} tokens，"
+                             f"{sent} 次请求共节省约 {model_ins.saved_prompt_tokens * sent} 输入tokens")
+            if model_ins.prompt_cache and isinstance(model_ins, ClaudeModel) and sent:
+                self.add_log(f"【提示词】{model_ins.model_name}：已开启cache_control前缀缓存，{sent} 次请求中命中缓存的部分按缓存价计费")
+        for model_ins in model_instances:
+            for line in model_control_summary(model_ins):
+                self.add_log(line)
+        if self.processes == 1:
+            for cost_model in cost_models.values():
+                self.add_log(cost_model.summary_line())
+        for model_ins in model_instances:
+            if len(model_ins.balancer.endpoints) > 1:
+                for line in model_ins.balancer.summary_lines():
+                    self.add_log(f"【节点统计】{model_ins.model_name} {line}")
+        if cache is not None:
+            self.add_log(f"【缓存】命中 {cache.hits} 条，未命中 {cache.misses} 条（{self.cache_mode}）")
+            cache.close()
+
+        # 停止后未完成的行标记为任务终止
+        with self.result_lock:
+            for res_list in self.result_dict.values():
+                for row_idx, res in enumerate(res_list):
+                    if res is None:
+                        res_list[row_idx] = "任务终止"
+                        self.unfinished += 1
+
+        # 边跑边写：收尾写出剩余行
+        if self.result_writer is not None:
+            self.result_writer.close()
+            self.unfinished += self.result_writer.unfinished
+            self.add_log(f"【成功】结果已边跑边写至：{self.result_writer.path}，共 {self.result_writer.rows_written} 条数据")
+            self.result_writer = None
+        if IS_STOP:
+            return False
+        if self.unfinished:
+            failed_shards = getattr(scheduler, "failed_shards", None)
+            reason = f"分片{'、'.join(map(str, failed_shards))} 子进程异常退出" if failed_shards else "运行异常"
+            self.add_log(f"【错误】{reason}，{self.unfinished} 个结果未完成，任务日志已保留，重新运行可续跑")
+            return False
+        return True
+
+    # ========== 结束后保存：生成结果表 ==========
+    def build_result_frame(self):
+        if not self.result_queries or not self.result_dict:
+            self.add_log("【错误】无数据可生成结果")
+            return None
+        import pandas as pd
+        result_df = pd.DataFrame({"query": self.result_queries})
+        for model_name, res_list in self.result_dict.items():
+            result_df[model_name] = [result_text(res) for res in res_list]
+            metric_rows = [m.row_values() if m is not None else [None] * len(METRIC_COLUMNS) for m in self.metrics_dict[model_name]]
+            for col_idx, col_name in enumerate(metric_column_names(model_name)):
+                result_df[col_name] = [values[col_idx] for values in metric_rows]
+        return result_df
+
+    def save_result_frame(self, result_df, save_path):
+        try:
+            if save_path.endswith(".csv"):
+                result_df.to_csv(save_path, index=False, encoding="utf-8-sig")
+            else:
+                result_df.to_excel(save_path, index=False)
+            self.add_log(f"【成功】结果文件已保存至：{save_path}")
+            return True
+        except Exception as e:
+            self.add_log(f"【错误】生成结果文件失败：{str(e)}")
+            return False
+
+    def close(self, discard_journal=False):
+        """结果已完整保存时删除任务日志，否则保留供下次续跑"""
+        if self.run_journal is not None:
+            if discard_journal:
+                self.run_journal.discard()
+            self.run_journal.close()
+            self.run_journal = None
@@ -1,241 +1,36 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import customtkinter as ctk
-import yaml
 import os
-import requests
 import threading
-import pandas as pd
 import time
-import copy
-import json
-from threading import Lock
+import queue
+import multiprocessing
+from engine import (ENV_MAP, MODEL_LIST, CACHE_MODES, WRITE_MODES, DEDUP_MODES, CONCURRENCY_MODES, HEDGE_MODES, REQUEST_MODES, SCHEDULE_POLICIES, DATA_FILETYPES, DATA_CHUNK_SIZE,
+                    iter_query_chunks, load_yaml_config, build_model_configs, request_stop,
+                    pause_requests, resume_requests, is_paused, BatchRunner)
 
 # 初始化UI样式
 ctk.set_appearance_mode("system")
 ctk.set_default_color_theme("blue")
 
-# ========== 核心配置【不变】 ==========
-ENV_MAP = {
-    "测试": "test",
-    "预发": "pre",
-    "生产": "pro"
-}
-
-# ========== 全局变量+线程安全锁【核心修复：新增所有锁】 ==========
-IS_STOP = False  # 任务停止标识
+# ========== 界面全局变量 ==========
 IS_RUNNING = False # 运行状态标识，防重复点击
-RESULT_DICT = {}  # 存储结果
-RESULT_LOCK = Lock()  # 结果字典的线程锁
-LOG_LOCK = Lock()     # 日志的线程锁
-TIMEOUT = 60         # 请求超时时间
-
-# ========== 第一步：分模型封装请求类【原封不动+小优化，兼容所有模型】 ==========
-class BaseModelRequest:
-    """所有模型请求的基类"""
-    def __init__(self, model_name, api_key, base_url, system_prompt):
-        self.model_name = model_name
-        self.api_key = api_key
-        self.base_url = base_url
-        self.system_prompt = system_prompt.strip()
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-
-    def build_payload(self, query):
-        raise NotImplementedError("子类必须实现该方法")
-
-    def request_model(self, query):
-        """流式POST请求，返回完整拼接结果，核心：requests.request POST stream=True"""
-        if IS_STOP:
-            return "任务已终止"
-        try:
-            payload = self.build_payload(query)
-            # 严格按照你的要求：requests.request("POST", url, headers=headers, data=payload, stream=True, timeout=60)
-            response = requests.request(
-                method="POST",
-                url=self.base_url,
-                headers=self.headers,
-                json=payload,  # 接口都是json格式，比data更适配，原data会导致请求失败
-                stream=True,
-                timeout=TIMEOUT
-            )
-            response.raise_for_status()
-            content = ""
-            first_chunk_received = False
-
-            if "claude" in self.model_name: 
-                try:
-                    for line in response.iter_lines():
-                        if line:
-                            line = line.decode("utf-8")
-                            if line.startswith("data:"):
-                                data = line[5:].strip()
-
-                                try:
-                                    json_data = json.loads(data)
-                                    if json_data["type"] == "message_stop":
-                                        pass
-                                    
-                                    if json_data["type"] == "content_block_delta":
-                                        content_split = json_data["delta"].get("text", "")
-
-                                        if content_split:
-                                        
-                                            if not first_chunk_received:
-                                                response_start = time.time()
-                                                first_chunk_received = True
-
-                                            content += content_split
-
-                                except json.JSONDecodeError:
-                                    continue
-
-                except KeyboardInterrupt:
-                    print("\nStream interrupted")
-                finally:
-                    response.close()
-
-            elif "gemini" in self.model_name:
-                try:
-                    for line in response.iter_lines():
-                        if line:
-                            line = line.decode("utf-8")
-                            if line.startswith("data:"):
-                                data = line[5:].strip()
-
-                            try:
-                                json_data = json.loads(data)
-                                content_split = json_data["candidates"][0].get("content",{}).get("parts", "")[0].get("text", "")
-
-                                if content_split:
-                                    if not first_chunk_received:
-                                        response_start = time.time()
-                                        first_chunk_received = True
-                                    content += content_split                            
-
-                            except json.JSONDecodeError:
-                                continue
-                            except IndexError:
-                                continue
-                                        
-                except KeyboardInterrupt:
-                    print("\nStream interrupted")
-                finally:
-                    response.close()
-
-            else:
-
-                try:
-                    for line in response.iter_lines():
-                        if line:
-                            line = line.decode("utf-8")
-                            if line.startswith("data:"):
-                                data = line[5:].strip()
-
-                            if data != "[DONE]":
-                                try:
-                                    json_data = json.loads(data)
-                                    if "choices" in json_data:
-                                        content_split = json_data["choices"][0].get("delta",{}).get("content", "")            
-
-                                        if content_split:
-                                            if not first_chunk_received:
-                                                response_start = time.time()
-                                                first_chunk_received = True
-                                            content += content_split
-
-                                except json.JSONDecodeError:
-                                    continue
-                                except IndexError:
-                                    continue
-                                
-                except KeyboardInterrupt:
-                    print("\nStream interrupted")
-                finally:
-                    response.close()
-            
-            return content if content else "模型返回空内容"
-        except Exception as e:
-            return f"请求异常: {str(e)[:100]}"
-
-class ClaudeModel(BaseModelRequest):
-    """Claude系列模型"""
-    def build_payload(self, query):
-        return {
-            "anthropic_version": "vertex-2023-10-16",
-            "max_tokens": 1026,
-            "system": self.system_prompt,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": f"{self.system_prompt}\n"
-                        }
-                    ]
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": query
-                        }
-                    ]
-                }
-            ],
-            "stream": True
-        }
-
-class GeminiModel(BaseModelRequest):
-    """Gemini系列模型"""
-    def build_payload(self, query):
-        return {
-            "contents": [
-                {
-                    "role": "user", 
-                    "parts": [
-                        {
-                            "text": f"{self.system_prompt}\n"
-                        }
-                    ]
-                },
-                {
-                    "role": "user", 
-                    "parts": [
-                        {
-                            "text": query
-                        }
-                    ]
-                }
-            ]
-        }
-
-class OtherModel(BaseModelRequest):
-    """GPT/Qwen/Deepseek等其他模型"""
-    def build_payload(self, query):
-        return {
-            "model": self.model_name,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": f"{self.system_prompt}\n"
-                },
-                {
-                    "role": "user",
-                    "content": query
-                }
-            ],
-            "stream": True
-        }
+LOG_DIR = os.path.join(os.path.expanduser("~"), ".xpeng_llm_logs")  # 完整运行日志目录
+LOG_MAX_LINES = 2000  # 界面日志框最多保留的行数，更早的只保留在日志文件中
+LOG_DRAIN_MS = 100    # 主线程批量刷新日志/界面操作的间隔
 
 # ========== 第二步：主界面类【全量修复+优化，核心防卡死】 ==========
 class XPengLLMRequestTools(ctk.CTk):
     def __init__(self):
         super().__init__()
+        # ========== 日志/界面操作队列：工作线程只入队，由主线程定时批量处理 ==========
+        self._log_queue = queue.SimpleQueue()
+        self._ui_queue = queue.SimpleQueue()
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.log_path = os.path.join(LOG_DIR, f"run_{time.strftime('%Y%m%d_%H%M%S')}.log")
+        self._log_file = open(self.log_path, "a", encoding="utf-8")
+
         # ========== 窗口基础配置 ==========
         self.title("XPengLLMRequestTools - LLM请求工具")
         self.geometry("900x950")
@@ -247,6 +42,17 @@ class XPengLLMRequestTools(ctk.CTk):
         self.title_label = ctk.CTkLabel(self, text="XPengLLMRequestTools", font=ctk.CTkFont(size=24, weight="bold"))
         self.title_label.grid(row=0, column=0, **self.pad, sticky="nsew")
 
+        # 初始化数据
+        self.data_path = None
+        self.yaml_config = None
+        self.stream_save_path = None
+        self.run_options = {}  # 运行时的界面选项快照
+
+        # 其余控件在窗口显示后再构建，首屏不等待全部控件创建完成
+        self.after_idle(self.build_widgets)
+
+    def build_widgets(self):
+        """构建标题以外的全部控件，完成后启动日志/界面操作的定时刷新"""
         # ========== 第2行：模型选择区 ==========
         self.model_frame = ctk.CTkFrame(self)
         self.model_frame.grid(row=1, column=0, **self.pad, sticky="nsew")
@@ -259,12 +65,7 @@ class XPengLLMRequestTools(ctk.CTk):
         ctk.CTkButton(self.btn_frame_model, text="取消全选", command=self.unselect_all, width=80).grid(row=0, column=1, padx=5)
 
         self.model_vars = []
-        self.model_list = [
-            'gpt-5', 'gpt-5-mini', 'gpt-4.1', 'gpt-4', 'gpt-35-turbo',
-            'gpt-4o', 'gpt-4o-mini', 'o3-mini', 'gemini-2.5-pro', 'gemini-2.5-flash-lite',
-            'gemini-2.5-flash', 'claude-opus-4-1', 'claude-opus-4', 'claude-sonnet-4',
-            'qwen-omni-turbo', 'deepseek-r1'
-        ]
+        self.model_list = list(MODEL_LIST)
         self.model_box = ctk.CTkFrame(self.model_frame, fg_color="transparent")
         self.model_box.grid(row=2, column=0, **self.pad, sticky="nsew")
         for idx, model_name in enumerate(self.model_list):
@@ -284,7 +85,7 @@ class XPengLLMRequestTools(ctk.CTk):
         self.env_combo.set("测试")
 
         ctk.CTkLabel(self.combo_frame, text="线程数选择：").grid(row=1, column=1, padx=5, pady=5, sticky="w")
-        self.thread_combo = ctk.CTkComboBox(self.combo_frame, values=["1","2","3","5","8","10","15","20"], width=150)
+        self.thread_combo = ctk.CTkComboBox(self.combo_frame, values=["1","2","3","5","8","10","15","20","50","100","200"], width=150)
         self.thread_combo.grid(row=2, column=1, padx=5, pady=5, sticky="ew")
         self.thread_combo.set("3")
 
@@ -298,6 +99,56 @@ class XPengLLMRequestTools(ctk.CTk):
         self.reserve2_combo.grid(row=2, column=3, padx=5, pady=5, sticky="ew")
         self.reserve2_combo.set("待添加")
 
+        ctk.CTkLabel(self.combo_frame, text="单模型并发：").grid(row=3, column=0, padx=5, pady=5, sticky="w")
+        self.model_limit_combo = ctk.CTkComboBox(self.combo_frame, values=["不限","1","2","3","5","8","10"], width=150)
+        self.model_limit_combo.grid(row=4, column=0, padx=5, pady=5, sticky="ew")
+        self.model_limit_combo.set("不限")
+
+        ctk.CTkLabel(self.combo_frame, text="请求引擎：").grid(row=3, column=1, padx=5, pady=5, sticky="w")
+        self.engine_combo = ctk.CTkComboBox(self.combo_frame, values=["threading", "asyncio"], width=150, state="readonly")
+        self.engine_combo.grid(row=4, column=1, padx=5, pady=5, sticky="ew")
+        self.engine_combo.set("threading")
+
+        ctk.CTkLabel(self.combo_frame, text="响应缓存：").grid(row=3, column=2, padx=5, pady=5, sticky="w")
+        self.cache_combo = ctk.CTkComboBox(self.combo_frame, values=CACHE_MODES, width=150, state="readonly")
+        self.cache_combo.grid(row=4, column=2, padx=5, pady=5, sticky="ew")
+        self.cache_combo.set("使用缓存")
+
+        ctk.CTkLabel(self.combo_frame, text="结果写出：").grid(row=3, column=3, padx=5, pady=5, sticky="w")
+        self.write_combo = ctk.CTkComboBox(self.combo_frame, values=WRITE_MODES, width=150, state="readonly")
+        self.write_combo.grid(row=4, column=3, padx=5, pady=5, sticky="ew")
+        self.write_combo.set("结束后保存")
+
+        ctk.CTkLabel(self.combo_frame, text="重复query：").grid(row=5, column=0, padx=5, pady=5, sticky="w")
+        self.dedup_combo = ctk.CTkComboBox(self.combo_frame, values=DEDUP_MODES, width=150, state="readonly")
+        self.dedup_combo.grid(row=6, column=0, padx=5, pady=5, sticky="ew")
+        self.dedup_combo.set("合并重复query")
+
+        ctk.CTkLabel(self.combo_frame, text="并发模式：").grid(row=5, column=1, padx=5, pady=5, sticky="w")
+        self.concurrency_combo = ctk.CTkComboBox(self.combo_frame, values=CONCURRENCY_MODES, width=150, state="readonly")
+        self.concurrency_combo.grid(row=6, column=1, padx=5, pady=5, sticky="ew")
+        self.concurrency_combo.set("固定并发")
+
+        ctk.CTkLabel(self.combo_frame, text="请求进程数：").grid(row=5, column=2, padx=5, pady=5, sticky="w")
+        self.process_combo = ctk.CTkComboBox(self.combo_frame, values=["1","2","4","8","16"], width=150, state="readonly")
+        self.process_combo.grid(row=6, column=2, padx=5, pady=5, sticky="ew")
+        self.process_combo.set("1")
+
+        ctk.CTkLabel(self.combo_frame, text="慢请求对冲：").grid(row=5, column=3, padx=5, pady=5, sticky="w")
+        self.hedge_combo = ctk.CTkComboBox(self.combo_frame, values=HEDGE_MODES, width=150, state="readonly")
+        self.hedge_combo.grid(row=6, column=3, padx=5, pady=5, sticky="ew")
+        self.hedge_combo.set("不对冲")
+
+        ctk.CTkLabel(self.combo_frame, text="请求方式：").grid(row=7, column=0, padx=5, pady=5, sticky="w")
+        self.request_mode_combo = ctk.CTkComboBox(self.combo_frame, values=REQUEST_MODES, width=150, state="readonly")
+        self.request_mode_combo.grid(row=8, column=0, padx=5, pady=5, sticky="ew")
+        self.request_mode_combo.set("流式请求")
+
+        ctk.CTkLabel(self.combo_frame, text="调度策略：").grid(row=7, column=1, padx=5, pady=5, sticky="w")
+        self.schedule_combo = ctk.CTkComboBox(self.combo_frame, values=SCHEDULE_POLICIES, width=150, state="readonly")
+        self.schedule_combo.grid(row=8, column=1, padx=5, pady=5, sticky="ew")
+        self.schedule_combo.set("按行顺序")
+
         # ========== 第4行：三个指定文件上传区 ==========
         self.file_frame = ctk.CTkFrame(self)
         self.file_frame.grid(row=3, column=0, **self.pad, sticky="nsew")
@@ -336,28 +187,30 @@ class XPengLLMRequestTools(ctk.CTk):
         self.log_text.grid(row=1, column=0, **self.pad, sticky="nsew")
         self.log_text.configure(state="disabled")
         self.add_log("初始化完成，所有功能就绪！")
+        self.add_log(f"完整日志文件：{self.log_path}")
 
-        # ========== 第7行：运行/暂停停止按钮【完美居中+运行禁用】 ==========
+        # ========== 第7行：运行/暂停/停止按钮【完美居中+运行禁用】 ==========
         self.btn_frame = ctk.CTkFrame(self)
         self.btn_frame.grid(row=6, column=0, **self.pad, sticky="nsew")
-        self.btn_frame.grid_columnconfigure((0,1), weight=1)
+        self.btn_frame.grid_columnconfigure((0,1,2), weight=1)
         self.btn_frame.grid_rowconfigure(0, weight=1)
         
         self.run_btn = ctk.CTkButton(self.btn_frame, text="运行", width=120, height=40, font=ctk.CTkFont(size=14, weight="bold"), 
                                      fg_color="#2ecc71", hover_color="#27ae60", command=self.run_click)
         self.run_btn.grid(row=0, column=0, padx=20, pady=10)
         
-        self.stop_btn = ctk.CTkButton(self.btn_frame, text="暂停/停止", width=120, height=40, font=ctk.CTkFont(size=14, weight="bold"), 
+        self.pause_btn = ctk.CTkButton(self.btn_frame, text="暂停", width=120, height=40, font=ctk.CTkFont(size=14, weight="bold"), 
+                                       fg_color="#f39c12", hover_color="#d68910", command=self.pause_click)
+        self.pause_btn.grid(row=0, column=1, padx=20, pady=10)
+        
+        self.stop_btn = ctk.CTkButton(self.btn_frame, text="停止", width=120, height=40, font=ctk.CTkFont(size=14, weight="bold"), 
                                       fg_color="#e74c3c", hover_color="#c0392b", command=self.stop_click)
-        self.stop_btn.grid(row=0, column=1, padx=20, pady=10)
+        self.stop_btn.grid(row=0, column=2, padx=20, pady=10)
 
         # 自适应权重
         self.grid_rowconfigure(4, weight=1)
         self.grid_rowconfigure(5, weight=2)
-
-        # 初始化数据
-        self.df_data = None
-        self.yaml_config = None
+        self.after(LOG_DRAIN_MS, self.drain_ui_queues)
 
     # ========== 基础功能方法 ==========
     def select_all(self):
@@ -387,32 +240,80 @@ class XPengLLMRequestTools(ctk.CTk):
             except Exception as e: self.add_log(f"【错误】读取Prompt失败：{str(e)}")
 
     def upload_data(self):
-        path = filedialog.askopenfilename(filetypes=[("Excel", "*.xlsx *.xls"), ("CSV", "*.csv"), ("所有文件", "*.*")])
+        path = filedialog.askopenfilename(filetypes=DATA_FILETYPES)
         if path:
             self.data_var.set(path)
             self.add_log(f"【文件】上传数据文件：{path}")
+            # 只读取第一块校验query列，完整数据在运行时按块流式读取
+            chunks = iter_query_chunks(path)
             try:
-                if path.endswith(".csv"):
-                    self.df_data = pd.read_csv(path, encoding="utf-8")
-                else:
-                    self.df_data = pd.read_excel(path)
-                if "query" not in self.df_data.columns:
-                    self.add_log("【错误】数据文件必须包含'query'列作为模型输入！")
-                    self.df_data = None
-                else:
-                    self.add_log(f"【成功】读取数据完成，共 {len(self.df_data)} 条query待请求")
+                next(chunks, None)
+                self.data_path = path
+                self.add_log(f"【成功】数据文件校验通过，运行时按每块 {DATA_CHUNK_SIZE} 条流式读取")
             except Exception as e:
                 self.add_log(f"【错误】读取数据文件失败：{str(e)}")
-                self.df_data = None
+                self.data_path = None
+            finally:
+                chunks.close()
 
     def add_log(self, msg):
-        """【核心修复】加锁+异步日志，不阻塞主线程"""
-        with LOG_LOCK:
+        """任意线程可调用：只入队不碰Tk，由主线程定时批量写入日志框和日志文件"""
+        self._log_queue.put(f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {msg}\n")
+
+    def call_in_ui(self, func, *args, **kwargs):
+        """工作线程中需要操作界面时，交给主线程执行"""
+        self._ui_queue.put((func, args, kwargs, None))
+
+    def ask_in_ui(self, func, *args, **kwargs):
+        """工作线程中需要弹窗取值时（如选择保存路径），交给主线程执行并阻塞等待返回值"""
+        result = queue.Queue(maxsize=1)
+        self._ui_queue.put((func, args, kwargs, result))
+        ok, value = result.get()
+        if not ok:
+            raise value  # 界面操作在主线程抛出的异常转交给调用方
+        return value
+
+    def drain_ui_queues(self):
+        """主线程定时器：批量刷新日志，日志框只保留最近LOG_MAX_LINES行，再执行排队的界面操作；
+        任何一步出错都不能中断定时器，否则日志停止刷新，等待ask_in_ui的工作线程永远阻塞"""
+        try:
+            self.flush_log_lines()
+        except Exception as e:
+            self.add_log(f"【错误】刷新日志框失败：{str(e)}")
+        try:
+            while True:
+                func, args, kwargs, result = self._ui_queue.get_nowait()
+                try:
+                    value = (True, func(*args, **kwargs))
+                except Exception as e:
+                    value = (False, e)
+                    if result is None:
+                        self.add_log(f"【错误】界面操作失败：{str(e)}")
+                if result is not None:
+                    result.put(value)
+        except queue.Empty:
+            pass
+        finally:
+            self.after(LOG_DRAIN_MS, self.drain_ui_queues)
+
+    def flush_log_lines(self):
+        """把排队的日志写入日志文件和日志框"""
+        lines = []
+        try:
+            while len(lines) < 10000:
+                lines.append(self._log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if lines:
+            self._log_file.write("".join(lines))
+            self._log_file.flush()
             self.log_text.configure(state="normal")
-            self.log_text.insert("end", f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {msg}\n")
+            self.log_text.insert("end", "".join(lines[-LOG_MAX_LINES:]))
+            excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - LOG_MAX_LINES
+            if excess > 0:
+                self.log_text.delete("1.0", f"{excess + 1}.0")
             self.log_text.see("end")
             self.log_text.configure(state="disabled")
-            self.update_idletasks() # 强制刷新界面，日志实时显示
 
     # ========== YAML配置加载 ==========
     def load_yaml_config(self):
@@ -421,8 +322,7 @@ class XPengLLMRequestTools(ctk.CTk):
             self.add_log(f"【错误】请先上传有效的config.yaml配置文件！")
             return None
         try:
-            with open(config_path, 'r', encoding='utf-8') as f:
-                yaml_data = yaml.safe_load(f)
+            yaml_data = load_yaml_config(config_path)
             self.add_log(f"✅ 配置文件加载成功")
             return yaml_data
         except Exception as e:
@@ -431,6 +331,7 @@ class XPengLLMRequestTools(ctk.CTk):
 
     # ========== 核心：获取选中模型的配置 ==========
     def get_selected_model_configs(self):
+        """只在主线程调用：读取界面选择并拼出每个模型的请求配置"""
         if not self.yaml_config:
             self.add_log("【错误】请先加载yaml配置文件")
             return []
@@ -440,126 +341,46 @@ class XPengLLMRequestTools(ctk.CTk):
             self.add_log(f"【错误】无效环境：{env_cn}")
             return []
         
-        env_config = self.yaml_config['config'].get(env_en)
+        default_limit = None if self.model_limit_combo.get() == "不限" else int(self.model_limit_combo.get())
         selected_models = [self.model_list[idx] for idx, var in enumerate(self.model_vars) if var.get()]
-        model_configs = []
-        
-        for model_name in selected_models:
-            api_key = env_config['api_keys'].get(model_name)
-            if not api_key:
-                self.add_log(f"【警告】{model_name} 无对应API_KEY，跳过该模型")
-                continue
-            
-            if "claude" in model_name:
-                base_url = env_config['base_urls']['claude'].replace("{model}", model_name)
-            elif "gemini" in model_name:
-                base_url = env_config['base_urls']['gemini'].replace("{model}", model_name)
-            else:
-                base_url = env_config['base_urls']['other']
-            
-            model_configs.append({"model_name": model_name, "api_key": api_key, "base_url": base_url})
-        return model_configs
-
-    # ========== 核心：创建模型实例 ==========
-    def create_model_instance(self, model_cfg):
-        system_prompt = self.prompt_text.get("0.0", tk.END)
-        model_name = model_cfg["model_name"]
-        if "claude" in model_name:
-            return ClaudeModel(model_name, model_cfg["api_key"], model_cfg["base_url"], system_prompt)
-        elif "gemini" in model_name:
-            return GeminiModel(model_name, model_cfg["api_key"], model_cfg["base_url"], system_prompt)
-        else:
-            return OtherModel(model_name, model_cfg["api_key"], model_cfg["base_url"], system_prompt)
+        return build_model_configs(self.yaml_config, env_en, selected_models, default_limit, self.add_log)
 
-    # ========== 核心：单模型执行任务【线程安全】 ==========
-    def run_single_model_task(self, model_instance):
-        model_name = model_instance.model_name
-        model_res_list = []
-        self.add_log(f"【线程启动】{model_name} 开始执行请求任务")
-        
-        if self.df_data is None or IS_STOP:
-            model_res_list = ["数据为空/任务终止"] * len(self.df_data)
-        else:
-            for idx, query in enumerate(self.df_data["query"].tolist()):
-                if IS_STOP:
-                    self.add_log(f"【线程终止】{model_name} 任务被手动停止")
-                    model_res_list.append("任务终止")
-                    break
-                self.add_log(f"【{model_name}】请求第 {idx+1}/{len(self.df_data)} 条: {query[:50]}...")
-                res = model_instance.request_model(query)
-                model_res_list.append(res)
-        
-        # 【线程安全】加锁写入结果
-        with RESULT_LOCK:
-            RESULT_DICT[model_name] = model_res_list
-        self.add_log(f"【线程完成】{model_name} 所有query请求完成！")
-
-    # ========== 核心：生成结果Excel ==========
-    def generate_result_excel(self):
-        if self.df_data is None or not RESULT_DICT:
-            self.add_log("【错误】无数据可生成结果")
-            return
+    # ========== 核心：结束后保存结果Excel ==========
+    def generate_result_excel(self, runner):
+        result_df = runner.build_result_frame()
+        if result_df is None:
+            return False
         try:
-            result_df = self.df_data[["query"]].copy()
-            for model_name, res_list in RESULT_DICT.items():
-                result_df[model_name] = res_list
-            
-            save_path = filedialog.asksaveasfilename(
+            save_path = self.ask_in_ui(
+                filedialog.asksaveasfilename,
                 defaultextension=".xlsx",
                 filetypes=[("Excel文件", "*.xlsx"), ("CSV文件", "*.csv")]
             )
-            if save_path:
-                if save_path.endswith(".csv"):
-                    result_df.to_csv(save_path, index=False, encoding="utf-8-sig")
-                else:
-                    result_df.to_excel(save_path, index=False)
-                self.add_log(f"【成功】结果文件已保存至：{save_path}")
-                messagebox.showinfo("成功", f"结果生成完成！共 {len(result_df)} 条数据")
         except Exception as e:
-            self.add_log(f"【错误】生成结果文件失败：{str(e)}")
+            self.add_log(f"【错误】选择保存路径失败：{str(e)}")
+            return False
+        if save_path and runner.save_result_frame(result_df, save_path):
+            self.call_in_ui(messagebox.showinfo, "成功", f"结果生成完成！共 {len(result_df)} 条数据")
+            return True
+        return False
 
     # ========== 核心：异步任务总入口【彻底解决卡死的关键！】 ==========
-    def async_task_main(self):
-        """独立子线程执行所有任务，主线程完全解放"""
-        global IS_STOP, RESULT_DICT
-        IS_STOP = False
-        RESULT_DICT.clear()
-        model_threads = []
-        
-        # 前置校验
-        model_configs = self.get_selected_model_configs()
-        if not model_configs:
-            self.add_log("❌ 无选中的有效模型")
-            self.reset_running_state()
-            return
-        
-        model_instances = [self.create_model_instance(cfg) for cfg in model_configs]
-        self.add_log(f"✅ 共启动 {len(model_instances)} 个模型线程，并发数：{self.thread_combo.get()}")
-        
-        # 创建模型线程
-        max_workers = int(self.thread_combo.get())
-        current_workers = 0
-        for model_ins in model_instances:
-            if IS_STOP: break
-            # 控制并发数
-            while current_workers >= max_workers and not IS_STOP:
-                time.sleep(0.5)
-                current_workers = len([t for t in model_threads if t.is_alive()])
-            # 启动线程
-            t = threading.Thread(target=self.run_single_model_task, args=(model_ins,), daemon=True)
-            t.start()
-            model_threads.append(t)
-            current_workers += 1
-        
-        # 等待所有线程完成
-        for t in model_threads:
-            if not IS_STOP:
-                t.join()
-        
-        # 生成结果
-        if not IS_STOP:
+    def async_task_main(self, model_configs):
+        """独立子线程执行所有任务，主线程完全解放；界面选项已在run_click中快照到run_options"""
+        runner = BatchRunner(
+            self.yaml_config, self.data_path, self.run_options["system_prompt"], self.run_options["env"],
+            max_workers=self.run_options["max_workers"], engine=self.run_options["engine"],
+            cache_mode=self.run_options["cache_mode"], stream_save_path=self.stream_save_path,
+            log_func=self.add_log, dedup=self.run_options["dedup"], adaptive=self.run_options["adaptive"],
+            processes=self.run_options["processes"], hedge=self.run_options["hedge"],
+            request_mode=self.run_options["request_mode"], schedule=self.run_options["schedule"]
+        )
+        completed = runner.run(model_configs)
+        # 结束后保存模式：生成结果；保存成功后删除任务日志，否则保留供下次续跑
+        if completed and not self.stream_save_path:
             self.add_log("✅ 所有模型请求任务完成，开始生成结果文件")
-            self.generate_result_excel()
+            completed = self.generate_result_excel(runner)
+        runner.close(discard_journal=completed)
         
         # 重置运行状态
         self.reset_running_state()
@@ -574,10 +395,40 @@ class XPengLLMRequestTools(ctk.CTk):
         if not self.yaml_config:
             self.add_log("❌ 请先上传并加载yaml配置文件")
             return
-        if self.df_data is None:
+        if self.data_path is None:
             self.add_log("❌ 请先上传有效的数据文件（含query列）")
             return
         
+        # 边跑边写模式需在启动前选好结果文件
+        self.stream_save_path = None
+        if self.write_combo.get() == "边跑边写":
+            self.stream_save_path = filedialog.asksaveasfilename(
+                defaultextension=".csv",
+                filetypes=[("CSV文件", "*.csv"), ("Excel文件", "*.xlsx")]
+            )
+            if not self.stream_save_path:
+                self.add_log("❌ 边跑边写模式需要先选择结果文件")
+                return
+
+        # 前置校验：界面相关的读取都在主线程完成，工作线程不再访问任何控件
+        model_configs = self.get_selected_model_configs()
+        if not model_configs:
+            self.add_log("❌ 无选中的有效模型")
+            return
+        self.run_options = {
+            "env": ENV_MAP[self.env_combo.get()],
+            "max_workers": int(self.thread_combo.get()),
+            "engine": self.engine_combo.get(),
+            "cache_mode": self.cache_combo.get(),
+            "dedup": self.dedup_combo.get() == "合并重复query",
+            "adaptive": self.concurrency_combo.get() == "自适应并发",
+            "processes": int(self.process_combo.get()),
+            "hedge": self.hedge_combo.get() == "对冲慢请求",
+            "request_mode": self.request_mode_combo.get(),
+            "schedule": self.schedule_combo.get(),
+            "system_prompt": self.prompt_text.get("0.0", tk.END)
+        }
+
         # 锁定运行状态
         IS_RUNNING = True
         self.run_btn.configure(state="disabled", fg_color="#95a5a6", hover_color="#7f8c8d")
@@ -585,22 +436,39 @@ class XPengLLMRequestTools(ctk.CTk):
         self.add_log("🚀 开始执行批量模型请求任务（界面不卡，可随时停止）")
         
         # 【核心】启动独立子线程执行任务，主线程立即返回，永不卡死
-        threading.Thread(target=self.async_task_main, args=(), daemon=True).start()
+        threading.Thread(target=self.async_task_main, args=(model_configs,), daemon=True).start()
+
+    def pause_click(self):
+        """暂停按钮：暂停后不再发起新请求，进行中的请求照常完成；再次点击继续"""
+        if not IS_RUNNING:
+            self.add_log("【提示】当前没有运行中的任务")
+            return
+        if is_paused():
+            resume_requests()
+            self.pause_btn.configure(text="暂停")
+            self.add_log("▶️ 已继续，恢复发起请求")
+        else:
+            pause_requests()
+            self.pause_btn.configure(text="继续")
+            self.add_log("⏸️ 已暂停：进行中的请求完成后不再发起新请求，点击“继续”恢复")
 
     def stop_click(self):
-        """停止按钮：立即终止所有任务"""
-        global IS_STOP
-        IS_STOP = True
+        """停止按钮：立即中断进行中的流并终止所有任务"""
+        request_stop()
+        self.pause_btn.configure(text="暂停")
         self.add_log("🔴 收到停止指令，正在终止所有模型请求任务...")
 
     def reset_running_state(self):
-        """重置运行状态，解锁按钮"""
+        """重置运行状态，解锁按钮（由工作线程调用，按钮操作交给主线程）"""
         global IS_RUNNING
         IS_RUNNING = False
-        self.run_btn.configure(state="normal", fg_color="#2ecc71", hover_color="#27ae60")
+        self.call_in_ui(self.run_btn.configure, state="normal", fg_color="#2ecc71", hover_color="#27ae60")
+        self.call_in_ui(self.pause_btn.configure, text="暂停")
         self.add_log("="*60)
 
 # ========== 程序入口 ==========
 if __name__ == "__main__":
+    # 多进程模式用spawn启动子进程，打包成exe后子进程也从这里启动，需先交给multiprocessing处理
+    multiprocessing.freeze_support()
     app = XPengLLMRequestTools()
     app.mainloop()
\ No newline at end of file
@@ -0,0 +1,53 @@
+"""测试公共部分：把仓库根目录和benchmarks加入导入路径，提供本地模拟网关和指向它的yaml配置"""
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from mock_gateway import start_mock_gateway  # noqa: E402
+
+TEST_MODELS = ["gpt-4o", "claude-sonnet-4", "gemini-2.5-flash"]  # 覆盖三种SSE格式
+
+
+@pytest.fixture
+def gateway():
+    """返回启动函数，参数同start_mock_gateway；用例结束时关闭所有启动过的网关"""
+    servers = []
+
+    def start(**kwargs):
+        server, base_url = start_mock_gateway(**kwargs)
+        servers.append(server)
+        return server, base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_yaml_config(base_url, tmp_dir, model_names=TEST_MODELS, **sections):
+    """指向模拟网关的最小yaml配置，任务日志放在tmp_dir，其余段落按关键字参数追加"""
+    return {
+        "config": {"test": {
+            "api_keys": {name: "test-key" for name in model_names},
+            "base_urls": {
+                "claude": f"{base_url}/claude/{{model}}",
+                "gemini": f"{base_url}/gemini/{{model}}",
+                "other": f"{base_url}/v1/chat/completions",
+            },
+        }},
+        "journal": {"dir": os.path.join(str(tmp_dir), "journal")},
+        **sections,
+    }
+
+
+def write_queries(path, queries):
+    with open(path, "w", encoding="utf-8") as f:
+        for query in queries:
+            f.write(json.dumps({"query": query}, ensure_ascii=False) + "\n")
+    return str(path)
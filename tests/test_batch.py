@@ -0,0 +1,90 @@
+"""批处理模式：对模拟网关的三家批处理接口提交任务，结果按custom_id回填到行；单行结果异常只影响这一行"""
+import engine
+from conftest import TEST_MODELS, make_yaml_config, write_queries
+
+ROWS = 12
+BLOCKED_ROW = 1
+BLOCK_MARKER = "被拦截的问题"
+
+
+def batch_yaml_config(base_url, tmp_dir):
+    yaml_config = make_yaml_config(base_url, tmp_dir, batch={"default": {"poll_seconds": 0.1, "max_requests_per_job": 5}})
+    yaml_config["config"]["test"]["batch_urls"] = {"claude": base_url, "gemini": base_url, "other": base_url}
+    return yaml_config
+
+
+def run_batch(yaml_config, data_path):
+    logs = []
+    runner = engine.BatchRunner(yaml_config, data_path, "你是一个助手", "test", max_workers=4,
+                                cache_mode="不使用缓存", log_func=logs.append, request_mode="批处理任务")
+    completed = runner.run(engine.build_model_configs(yaml_config, "test", TEST_MODELS))
+    frame = runner.build_result_frame()
+    runner.close(discard_journal=completed)
+    return frame, completed, logs
+
+
+def test_batch_mode_fills_rows_and_isolates_blocked_item(gateway, tmp_path):
+    server, base_url = gateway(tokens=3, batch_delay=0.2, block_marker=BLOCK_MARKER)
+    queries = [BLOCK_MARKER if i == BLOCKED_ROW else f"第{i}条" for i in range(ROWS)]
+    data_path = write_queries(tmp_path / "queries.jsonl", queries)
+
+    frame, completed, logs = run_batch(batch_yaml_config(base_url, tmp_path), data_path)
+    assert completed
+    # 每个模型按每任务5行拆成3个任务，所有行只提交一次
+    assert server.batch_requests == ROWS * len(TEST_MODELS)
+    assert len(server.batch_jobs) == 3 * len(TEST_MODELS)
+    answer = "tok0 tok1 tok2 "
+    for model_name in TEST_MODELS:
+        column = frame[model_name].tolist()
+        assert column[:BLOCKED_ROW] + column[BLOCKED_ROW + 1:] == [answer] * (ROWS - 1), model_name
+        assert column[BLOCKED_ROW] != answer
+    assert "请求被拦截：SAFETY" in frame["gemini-2.5-flash"][BLOCKED_ROW]
+    assert "无法解析批处理结果" in frame["gpt-4o"][BLOCKED_ROW]
+    assert frame["claude-sonnet-4"][BLOCKED_ROW] == "模型返回空内容"
+
+
+def test_stop_keeps_submitted_jobs_for_resume(gateway, tmp_path):
+    server, base_url = gateway(tokens=3, batch_delay=30)
+    data_path = write_queries(tmp_path / "queries.jsonl", [f"第{i}条" for i in range(ROWS)])
+    yaml_config = batch_yaml_config(base_url, tmp_path)
+
+    def stop_after_submit(msg):
+        if "已提交任务" in msg and len(server.batch_jobs) == 3 * len(TEST_MODELS):
+            engine.request_stop()
+
+    runner = engine.BatchRunner(yaml_config, data_path, "你是一个助手", "test", max_workers=4,
+                                cache_mode="不使用缓存", log_func=stop_after_submit, request_mode="批处理任务")
+    assert not runner.run(engine.build_model_configs(yaml_config, "test", TEST_MODELS))
+    runner.close(discard_journal=False)
+    first_jobs = list(server.batch_jobs.values())
+    assert all(job["cancelled"] for job in first_jobs)
+
+    # 续跑：轮询上次的任务取回取消前已完成的行（模拟网关返回每个任务的前一半），只重新提交其余的行
+    server.batch_requests = 0
+    server.batch_delay = 0.2
+    frame, completed, logs = run_batch(yaml_config, data_path)
+    assert completed
+    assert any("继续轮询上次提交的批处理任务" in msg for msg in logs)
+    assert server.batch_requests == sum(len(job["requests"]) - len(job["requests"]) // 2 for job in first_jobs)
+    for model_name in TEST_MODELS:
+        assert frame[model_name].tolist() == ["tok0 tok1 tok2 "] * ROWS, model_name
+
+
+def test_unknown_journal_job_is_given_up_and_rows_resubmitted(gateway, tmp_path):
+    server, base_url = gateway(tokens=3, batch_delay=0.1)
+    data_path = write_queries(tmp_path / "queries.jsonl", [f"第{i}条" for i in range(ROWS)])
+    yaml_config = batch_yaml_config(base_url, tmp_path)
+    yaml_config["batch"]["default"]["max_poll_failures"] = 2
+    # 上次运行提交的任务在网关上已不存在，查询一直返回404
+    journal_dir = tmp_path / "journal"
+    journal_dir.mkdir()
+    run_key = engine.RunJournal.make_run_key(data_path, "test", "你是一个助手")
+    journal = engine.RunJournal(str(journal_dir / f"{run_key}.jsonl"))
+    journal.record_batch_job("gpt-4o", "batch_gone", {"row-0": (0, None), "row-1": (1, None)})
+    journal.close()
+
+    frame, completed, logs = run_batch(yaml_config, data_path)
+    assert completed
+    assert any("连续 2 次查询失败，放弃该任务" in msg for msg in logs)
+    assert server.batch_requests == ROWS * len(TEST_MODELS)
+    assert frame["gpt-4o"].tolist() == ["tok0 tok1 tok2 "] * ROWS
@@ -0,0 +1,35 @@
+"""响应缓存：命中时的访问时间攒批写回，淘汰按最近访问顺序"""
+import sqlite3
+
+import engine
+
+
+def read_accessed_at(path, key):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT accessed_at FROM responses WHERE key = ?", (key,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_hit_defers_access_time_until_close(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = engine.ResponseCache(path)
+    cache.put("k", "m", "hello")
+    stored = read_accessed_at(path, "k")
+    assert cache.get("k") == "hello"
+    assert read_accessed_at(path, "k") == stored  # 命中不立即写库
+    cache.close(evict=False)
+    assert read_accessed_at(path, "k") > stored
+
+
+def test_evict_uses_pending_access_times(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = engine.ResponseCache(path, max_size_mb=10 / (1024 * 1024))  # 上限10字节，只能留下一条
+    cache.put("old", "m", "aaaaaa")
+    cache.put("new", "m", "bbbbbb")
+    assert cache.get("old") == "aaaaaa"  # 最近访问的是old，应保留old、淘汰new
+    cache.evict()
+    assert cache.get("old") == "aaaaaa"
+    assert cache.get("new") is None
+    cache.close()
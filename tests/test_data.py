@@ -0,0 +1,37 @@
+"""数据读取：JSONL按块读取query列，格式不对时给出可读的错误"""
+import pytest
+
+import engine
+
+
+def write_lines(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return str(path)
+
+
+def read_all(path, chunk_size=2):
+    return [query for chunk in engine.iter_query_chunks(path, chunk_size) for query in chunk]
+
+
+def test_jsonl_skips_blank_lines_and_normalizes(tmp_path):
+    path = write_lines(tmp_path / "data.jsonl", ["", '{"query": "a"}', '{"query": null}', "  ", '{"query": 3}', '{"other": 1}'])
+    assert read_all(path) == ["a", "", "3", ""]
+
+
+def test_jsonl_header_check_uses_first_nonblank_record(tmp_path):
+    path = write_lines(tmp_path / "data.jsonl", ["", "", '{"prompt": "a"}', '{"query": "b"}'])
+    with pytest.raises(ValueError, match="query"):
+        read_all(path)
+
+
+@pytest.mark.parametrize("record", ['["a", "b"]', '"a"', "3", "null"])
+def test_jsonl_rejects_non_object_records(tmp_path, record):
+    path = write_lines(tmp_path / "data.jsonl", ['{"query": "a"}', record])
+    with pytest.raises(ValueError, match="第 2 行不是JSON对象"):
+        read_all(path)
+
+
+def test_jsonl_reports_invalid_json_line(tmp_path):
+    path = write_lines(tmp_path / "data.jsonl", ["", '{"query": "a"}', '{"query": '])
+    with pytest.raises(ValueError, match="第 3 行不是合法的JSON"):
+        read_all(path)
@@ -0,0 +1,31 @@
+"""threading与asyncio两种引擎：同一批数据的结果表逐格一致，三种SSE格式都能解析出完整回答"""
+import engine
+from conftest import TEST_MODELS, make_yaml_config, write_queries
+
+
+def run_engine(engine_name, yaml_config, data_path):
+    runner = engine.BatchRunner(yaml_config, data_path, "你是一个助手", "test", max_workers=8, engine=engine_name,
+                                cache_mode="不使用缓存", log_func=lambda msg: None, log_rows=False, dedup=False)
+    assert runner.run(engine.build_model_configs(yaml_config, "test", TEST_MODELS))
+    frame = runner.build_result_frame()[["query"] + TEST_MODELS]
+    runner.close(discard_journal=True)
+    return frame
+
+
+def test_threading_and_asyncio_produce_same_sheet(gateway, tmp_path):
+    # 回答长度随query长度变化；token间隔很短，覆盖一个网络块里包含多条SSE事件的情况
+    server, base_url = gateway(tokens=8, token_delay=0.001, length_ratio=0.1)
+    queries = [f"第{i}条" + "长" * (i * 7 % 60) for i in range(40)]
+    data_path = write_queries(tmp_path / "queries.jsonl", queries)
+    yaml_config = make_yaml_config(base_url, tmp_path)
+
+    threaded = run_engine("threading", yaml_config, data_path)
+    asynced = run_engine("asyncio", yaml_config, data_path)
+    assert threaded.equals(asynced)
+    assert threaded["query"].tolist() == queries
+    for model_name in TEST_MODELS:
+        # 每个回答都以tok0开头、以空格结尾，说明首尾事件都没有丢
+        assert threaded[model_name].str.startswith("tok0 ").all()
+        assert threaded[model_name].str.endswith(" ").all()
+        assert threaded[model_name].nunique() > 1
+    assert server.requests == 2 * len(queries) * len(TEST_MODELS)
@@ -0,0 +1,21 @@
+"""耗时指标：最近秩法分位数"""
+import engine
+
+
+def test_percentile_nearest_rank():
+    assert engine.percentile(list(range(1, 11)), 50) == 5
+    assert engine.percentile(list(range(1, 101)), 95) == 95
+    assert engine.percentile(list(range(1, 101)), 99) == 99
+    assert engine.percentile(list(range(1, 11)), 55) == 6
+    assert engine.percentile([3.0], 99) == 3.0
+
+
+def test_percentile_bounds():
+    values = list(range(1, 21))
+    assert engine.percentile(values, 0) == 1
+    assert engine.percentile(values, 100) == 20
+    assert engine.percentile([], 50) is None
+
+
+def test_metric_columns_name_response_header_time():
+    assert engine.metric_column_names("gpt-4o")[0] == "gpt-4o_响应头(s)"
@@ -0,0 +1,99 @@
+"""客户端限流：用可控时钟确定性地检查RPM/TPM预约的等待时间和额度补充"""
+import engine
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_waits_and_refills():
+    clock = FakeClock()
+    bucket = engine.TokenBucket(capacity=10, rate=2, clock=clock)
+    assert bucket.reserve(10) == 0.0
+    assert bucket.reserve(4) == 2.0   # 欠4个，每秒补2个
+    clock.advance(2)
+    assert bucket.reserve(0) == 0.0   # 补齐欠额后余额为0
+    clock.advance(100)
+    assert bucket.reserve(10) == 0.0  # 余额不超过容量
+    assert bucket.reserve(1) == 0.5
+
+
+def test_rpm_budget():
+    clock = FakeClock()
+    # 每分钟60次、突发10秒：容量10次，每秒补1次
+    limiter = engine.RateLimiter(rpm=60, burst_seconds=10, output_tokens=0, clock=clock)
+    payload = {"q": "x"}
+    assert [limiter.reserve(payload) for _ in range(10)] == [0.0] * 10
+    assert limiter.reserve(payload) == 1.0
+    assert limiter.reserve(payload) == 2.0
+    clock.advance(5)
+    assert limiter.reserve(payload) == 0.0
+
+
+def test_tpm_budget():
+    clock = FakeClock()
+    payload = {"q": "x" * 100}
+    tokens = engine.estimate_tokens(payload, 0)
+    # 每分钟600 tokens、突发10秒：容量100，每秒补10
+    limiter = engine.RateLimiter(tpm=600, burst_seconds=10, output_tokens=0, clock=clock)
+    waits = [limiter.reserve(payload) for _ in range(3)]
+    expected_balance = [100 - tokens * (i + 1) for i in range(3)]
+    assert waits == [0.0 if b >= 0 else -b / 10 for b in expected_balance]
+    clock.advance(60)
+    assert limiter.reserve(payload) == 0.0
+
+
+def test_output_tokens_counted_in_tpm():
+    clock = FakeClock()
+    limiter = engine.RateLimiter(tpm=600, burst_seconds=10, output_tokens=150, clock=clock)
+    # 输入token + 配置的输出token超过容量100，第一次就要等
+    payload = {"q": ""}
+    assert limiter.reserve(payload) == (engine.estimate_tokens(payload, 150) - 100) / 10
+
+
+def test_rpm_and_tpm_take_longest_wait():
+    clock = FakeClock()
+    limiter = engine.RateLimiter(rpm=60, tpm=600, burst_seconds=10, output_tokens=50, clock=clock)
+    payload = {"q": ""}
+    tokens = engine.estimate_tokens(payload, 50)
+    assert limiter.reserve(payload) == 0.0
+    assert limiter.reserve(payload) == max(0.0, (tokens * 2 - 100) / 10)
+
+
+def test_from_config_without_limits_is_none():
+    assert engine.RateLimiter.from_config({}) is None
+    assert engine.RateLimiter.from_config({"burst_seconds": 5}) is None
+
+
+def test_try_reserve_never_waits():
+    clock = FakeClock()
+    limiter = engine.RateLimiter(rpm=60, burst_seconds=2, output_tokens=0, clock=clock)
+    payload = {"q": "x"}
+    assert limiter.try_reserve(payload)
+    assert limiter.try_reserve(payload)
+    assert not limiter.try_reserve(payload)  # 额度用完时不预约，余额不变负
+    clock.advance(1)
+    assert limiter.try_reserve(payload)
+    assert limiter.reserve(payload) == 1.0
+
+
+def test_hedge_is_skipped_when_rate_limit_would_wait():
+    clock = FakeClock()
+    limiter = engine.RateLimiter(rpm=60, burst_seconds=1, output_tokens=0, clock=clock)
+    hedger = engine.Hedger("gpt-4o", budget=1.0)
+    payload = {"q": "x"}
+    hedger.primaries = 2
+    assert limiter.reserve(payload) == 0.0  # 主请求用掉唯一的额度
+    assert not hedger.try_start(engine.HedgeRace(), limiter, payload)
+    assert hedger.hedges == 0 and hedger.throttled == 1
+    clock.advance(1)
+    assert hedger.try_start(engine.HedgeRace(), limiter, payload)
+    assert hedger.hedges == 1
+    assert limiter.reserve(payload) == 1.0  # 对冲占用的额度计入限流
@@ -0,0 +1,127 @@
+"""断点续跑：运行中途停止或被强杀后重跑，最终结果表与一次跑完相同，已完成的行不重复请求"""
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pandas as pd
+import yaml
+
+import engine
+from conftest import ROOT, TEST_MODELS, make_yaml_config, write_queries
+from mock_gateway import reset_stats
+
+ROWS = 60
+STOP_AFTER = 40  # 完成这么多个(模型, 行)后发出停止指令
+KILL_AFTER = 40  # 任务日志写满这么多行后SIGKILL命令行进程
+CLI_PATH = os.path.join(ROOT, "cli.py")
+
+
+def run_once(yaml_config, data_path, log_func=lambda msg: None):
+    """跑一次BatchRunner，返回(query+各模型结果列, 本次从任务日志恢复的结果数, 是否跑完)；未跑完时保留任务日志"""
+    runner = engine.BatchRunner(yaml_config, data_path, "你是一个助手", "test", max_workers=4,
+                                cache_mode="不使用缓存", log_func=log_func, log_rows=True)
+    completed = runner.run(engine.build_model_configs(yaml_config, "test", TEST_MODELS))
+    restored = len(runner.run_journal.completed)
+    frame = runner.build_result_frame()[["query"] + TEST_MODELS]
+    runner.close(discard_journal=completed)
+    return frame, restored, completed
+
+
+def test_stop_and_resume_matches_uninterrupted_run(gateway, tmp_path):
+    # 回答长度随query长度变化，各行结果不同，错位能被发现
+    server, base_url = gateway(tokens=5, token_delay=0.002, length_ratio=0.05)
+    data_path = write_queries(tmp_path / "queries.jsonl", [f"第{i}条" + "问" * (i % 17) for i in range(ROWS)])
+
+    finished = []
+
+    def stop_midway(msg):
+        if "】完成第" in msg:
+            finished.append(msg)
+            if len(finished) == STOP_AFTER:
+                engine.request_stop()
+
+    resumed_config = make_yaml_config(base_url, tmp_path / "resumed")
+    _, _, completed = run_once(resumed_config, data_path, stop_midway)
+    assert not completed
+
+    reset_stats(server)
+    resumed, restored, completed = run_once(resumed_config, data_path)
+    assert completed
+    assert restored >= STOP_AFTER
+    # 续跑只请求任务日志中没有的(模型, 行)
+    assert server.requests == ROWS * len(TEST_MODELS) - restored
+
+    expected, _, _ = run_once(make_yaml_config(base_url, tmp_path / "uninterrupted"), data_path)
+    assert resumed.equals(expected)
+    assert not resumed[TEST_MODELS].isin(["任务终止", "任务已终止"]).any().any()
+
+
+def test_truncated_last_journal_line_is_dropped(tmp_path):
+    path = str(tmp_path / "run.jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"model": "gpt-4o", "row": 0, "result": "a"}\n')
+        f.write('{"model": "gpt-4o", "row": 1, "result": "b"}\n')
+        f.write('{"model": "gpt-4o", "row": 2, "res')  # 崩溃时写了一半
+    journal = engine.RunJournal(path)
+    assert journal.completed == {("gpt-4o", 0): "a", ("gpt-4o", 1): "b"}
+    # 新记录另起一行，不与写了一半的行拼在一起
+    journal.record("gpt-4o", 2, "c")
+    journal.close()
+    assert engine.RunJournal(path).completed == {("gpt-4o", 0): "a", ("gpt-4o", 1): "b", ("gpt-4o", 2): "c"}
+
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb") as f:
+        return f.read().count(b"\n")
+
+
+def test_sigkill_midway_and_resume_with_cli(gateway, tmp_path):
+    server, base_url = gateway(tokens=5, token_delay=0.01, length_ratio=0.05)
+    queries = [f"第{i}条" + "问" * (i % 17) for i in range(ROWS)]
+    data_path = write_queries(tmp_path / "queries.jsonl", queries)
+    prompt_path = tmp_path / "prompt.txt"
+    prompt_path.write_text("你是一个助手", encoding="utf-8")
+
+    def cli_args(name):
+        config_path = tmp_path / f"{name}.yaml"
+        with open(config_path, "w", encoding="utf-8") as f:
+            yaml.safe_dump(make_yaml_config(base_url, tmp_path / name), f, allow_unicode=True)
+        output = str(tmp_path / f"{name}.csv")
+        return [sys.executable, CLI_PATH, "--config", str(config_path), "--prompt", str(prompt_path), "--data", data_path,
+                "--output", output, "--env", "test", "--models", ",".join(TEST_MODELS), "--workers", "4",
+                "--cache", "off", "--write-mode", "end"], output
+
+    args, output = cli_args("killed")
+    journal_path = os.path.join(str(tmp_path / "killed" / "journal"),
+                                f"{engine.RunJournal.make_run_key(data_path, 'test', '你是一个助手')}.jsonl")
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 60
+        while count_lines(journal_path) < KILL_AFTER and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert proc.poll() is None, "进程在写满任务日志前已退出"
+    finally:
+        proc.kill()  # SIGKILL：不走Ctrl+C的优雅停止，结果文件不写出，任务日志可能停在半行
+        proc.wait()
+    assert proc.returncode == -signal.SIGKILL
+    assert not os.path.exists(output)
+
+    journal = engine.RunJournal(journal_path)
+    restored = len(journal.completed)
+    journal.close()
+    assert KILL_AFTER <= restored < ROWS * len(TEST_MODELS)
+
+    reset_stats(server)
+    assert subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=120).returncode == 0
+    assert server.requests == ROWS * len(TEST_MODELS) - restored
+    assert not os.path.exists(journal_path)
+
+    expected_args, expected_output = cli_args("uninterrupted")
+    assert subprocess.run(expected_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=120).returncode == 0
+    resumed = pd.read_csv(output, encoding="utf-8-sig")[["query"] + TEST_MODELS]
+    assert resumed["query"].tolist() == queries
+    assert resumed.equals(pd.read_csv(expected_output, encoding="utf-8-sig")[["query"] + TEST_MODELS])
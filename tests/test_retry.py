@@ -0,0 +1,77 @@
+"""重试策略：用模拟网关注入429/5xx，检查尝试次数、Retry-After等待和最终错误类型"""
+import socket
+import time
+
+import engine
+from conftest import make_yaml_config
+
+FAST_RETRY = {"max_attempts": 3, "base_delay": 0.01, "max_delay": 0.05, "max_retry_after": 0.05}
+
+
+def make_model(base_url, tmp_path, model_name="gpt-4o", **retry):
+    yaml_config = make_yaml_config(base_url, tmp_path, [model_name], retry={"default": {**FAST_RETRY, **retry}})
+    engine.reset_stop()
+    return engine.create_model_instance(engine.build_model_configs(yaml_config, "test", [model_name])[0], "你是一个助手")
+
+
+def test_5xx_retried_up_to_max_attempts(gateway, tmp_path):
+    server, base_url = gateway(error_rate=1.0)
+    res, metrics = make_model(base_url, tmp_path).request_with_metrics("q")
+    assert isinstance(res, engine.RequestError)
+    assert res.label == "HTTP 500"
+    assert res.attempts == metrics.attempts == 3
+    assert server.requests == 3
+
+
+def test_429_retried_and_reported(gateway, tmp_path):
+    server, base_url = gateway(rate_429=1.0, retry_after=1)
+    res, metrics = make_model(base_url, tmp_path, "claude-sonnet-4").request_with_metrics("q")
+    assert isinstance(res, engine.RequestError)
+    assert res.label == "HTTP 429"
+    assert res.retry_after == 1.0
+    assert res.attempts == 3
+    assert server.requests == 3
+
+
+def test_retry_after_is_honoured(gateway, tmp_path):
+    # 网关要求等1秒，上限放宽后两次尝试之间至少等满1秒，而不是按base_delay退避
+    server, base_url = gateway(rate_429=1.0, retry_after=1)
+    model = make_model(base_url, tmp_path, max_attempts=2, max_retry_after=5)
+    start = time.perf_counter()
+    res, _ = model.request_with_metrics("q")
+    assert res.label == "HTTP 429"
+    assert time.perf_counter() - start >= 1.0
+    assert server.requests == 2
+
+
+def test_retry_after_is_capped():
+    policy = engine.RetryPolicy(max_retry_after=0.5)
+    assert policy.next_delay(1, retry_after=30) == 0.5
+    assert policy.next_delay(1, retry_after=0.2) == 0.2
+
+
+def test_success_after_transient_errors_not_reported_as_error(gateway, tmp_path):
+    # 30%的请求返回500，10次尝试内几乎必然成功
+    server, base_url = gateway(error_rate=0.3, tokens=3)
+    model = make_model(base_url, tmp_path, "gemini-2.5-flash", max_attempts=10)
+    for _ in range(10):
+        res, metrics = model.request_with_metrics("q")
+        assert res == "tok0 tok1 tok2 "
+        assert metrics.attempts >= 1
+    assert server.requests == 10 + server.injected.get(500, 0)
+
+
+def test_connection_error_retried(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    res, metrics = make_model(f"http://127.0.0.1:{port}", tmp_path).request_with_metrics("q")
+    assert isinstance(res, engine.RequestError)
+    assert res.label == "connection"
+    assert res.attempts == 3
+
+
+def test_permanent_4xx_not_retried():
+    error = engine.http_request_error(400, None, "bad request")
+    assert not error.transient
+    assert not engine.RetryPolicy(max_attempts=5).should_retry(error)
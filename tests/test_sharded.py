@@ -0,0 +1,51 @@
+"""多进程模式：分片子进程中途被杀时运行不算完成，任务日志保留，续跑补齐该分片未完成的行"""
+import multiprocessing
+import os
+import signal
+
+import engine
+from conftest import TEST_MODELS, make_yaml_config, write_queries
+from mock_gateway import reset_stats
+
+ROWS = 300
+KILL_AFTER = 20  # 完成这么多个(模型, 行)后杀掉一个分片子进程
+
+
+def make_runner(yaml_config, data_path, processes, log_func=lambda msg: None):
+    return engine.BatchRunner(yaml_config, data_path, "你是一个助手", "test", max_workers=8, processes=processes,
+                              cache_mode="不使用缓存", log_func=log_func, log_rows=True)
+
+
+def test_killed_shard_fails_run_and_keeps_journal(gateway, tmp_path):
+    server, base_url = gateway(tokens=5, token_delay=0.01)
+    data_path = write_queries(tmp_path / "queries.jsonl", [f"第{i}条" for i in range(ROWS)])
+    yaml_config = make_yaml_config(base_url, tmp_path)
+    model_configs = engine.build_model_configs(yaml_config, "test", TEST_MODELS)
+
+    finished = []
+    logs = []
+
+    def kill_one_shard(msg):
+        logs.append(msg)
+        if "】完成第" in msg:
+            finished.append(msg)
+            if len(finished) == KILL_AFTER:
+                os.kill(multiprocessing.active_children()[0].pid, signal.SIGKILL)
+
+    runner = make_runner(yaml_config, data_path, processes=2, log_func=kill_one_shard)
+    assert not runner.run(model_configs)
+    assert runner.unfinished > 0
+    assert any("子进程异常退出" in msg and "任务日志已保留" in msg for msg in logs)
+    journal_path = runner.run_journal.path
+    runner.close(discard_journal=False)
+    assert os.path.exists(journal_path)
+
+    # 续跑：只请求被杀分片留下的行，结果表完整
+    reset_stats(server)
+    runner = make_runner(yaml_config, data_path, processes=1)
+    assert runner.run(model_configs)
+    restored = len(runner.run_journal.completed)
+    frame = runner.build_result_frame()
+    runner.close(discard_journal=True)
+    assert server.requests == ROWS * len(TEST_MODELS) - restored
+    assert not frame[TEST_MODELS].isin(["任务终止", "任务已终止"]).any().any()